@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+Benchmarks of Paranoid storage in KBFS.
+
+Benchmark files are written to separate base paths (e.g. /keybase/private/<username>/paranoid-benchmark-split),
+and are left in place afterwards.
+
+Usage:
+
+    python benchmark.py [OPTIONS] COMMAND
+"""
+
+import shlex
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+from cache import ParanoidCache
+from keybase import COMMANDS, ENGINES, KeybaseClient
+from paranoid import FORMAT_CONSOLIDATED, FORMAT_SPLIT, ParanoidManager
+from storage import create_storage
+
+
+@click.group()
+@click.option(
+    '--base-path',
+    default='paranoid-benchmark',
+    help='Prefix of the base paths to write benchmark files to. Defaults to "paranoid-benchmark".',
+)
+@click.option('--keybase-bin', default='keybase', help='Command used to run the Keybase CLI. Defaults to "keybase".')
+@click.option(
+    '--storage',
+    type=click.Choice(['cli', 'mount', 'local']),
+    default='cli',
+    help='Backend used to read and write plain files. Defaults to "cli".',
+)
+@click.option('--storage-root', help='Directory standing in for /keybase, for the "mount" and "local" storage backends.')
+@click.pass_context
+def cli(ctx, base_path, keybase_bin, storage, storage_root):
+    def create_keybase(name, **kwargs):
+        "Creates a Keybase client for a separate base path."
+        keybase = KeybaseClient()
+        keybase.init(
+            base_path='{}-{}'.format(base_path, name),
+            executable=shlex.split(keybase_bin),
+            storage=create_storage(keybase, storage, storage_root),
+            **kwargs,
+        )
+        return keybase
+
+    try:
+        create_keybase('check')
+    except ValueError as e:
+        click.secho('ERROR: {}'.format(e))
+        sys.exit(1)
+
+    ctx.obj = create_keybase
+
+
+@cli.command()
+@click.option('--services', default=20, help='Number of services to create. Defaults to 20.')
+@click.option('--identities', default=3, help='Number of identities per service. Defaults to 3.')
+@click.option('--runs', default=3, help='Number of times to load all services in each format. Defaults to 3.')
+@click.pass_obj
+def formats(create_keybase, services, identities, runs):
+    "Compares the time taken to load all services from a cold cache, in the split and consolidated storage formats."
+
+    for name, version in (('split', FORMAT_SPLIT), ('consolidated', FORMAT_CONSOLIDATED)):
+        keybase = create_keybase(name)
+        keybase.ensure_dir(keybase.get_private(''))
+        keybase.ensure_dir(keybase.get_private('services'))
+
+        # Write all services in the given format
+        paranoid = ParanoidManager(keybase, ParanoidCache())
+        paranoid.init(disable_chat=True)
+        paranoid.set_format_version(version)
+        for i in range(services):
+            origin = 'https:benchmark{}.example.com:443'.format(i)
+            paranoid.set_service(origin, {'origin': origin})
+            paranoid.set_foreign_map(origin, [])
+            for uid in range(identities):
+                paranoid.set_service_identity(origin, str(uid), {
+                    'key': '',
+                    'fields': {
+                        'email': {
+                            'shared_with': [],
+                            'type': 'str'
+                        }
+                    }
+                })
+
+        # Load all services with a new cache each time, counting the Keybase commands run
+        durations = []
+        for _ in range(runs):
+            keybase.metadata.clear()
+            paranoid = ParanoidManager(keybase, ParanoidCache())
+            paranoid.init(disable_chat=True)
+
+            commands = sum(COMMANDS.values.values())
+            start = time.perf_counter()
+            for origin in paranoid.get_origins():
+                paranoid.get_service(origin)
+                paranoid.get_foreign_map(origin)
+                for uid in paranoid.get_service_uids(origin):
+                    paranoid.get_service_identity(origin, uid)
+            durations.append(time.perf_counter() - start)
+            commands = sum(COMMANDS.values.values()) - commands
+
+        click.echo('{:<14} {} services, {} identities each: {:.3f}s mean, {:.3f}s best, {} Keybase commands per load'.format(
+            name, services, identities, sum(durations) / runs, min(durations), commands))
+
+
+@cli.command()
+@click.option('--files', default=16, help='Number of files to decrypt and read in each request. Defaults to 16.')
+@click.option('--requests', default=8, help='Number of concurrent requests. Defaults to 8.')
+@click.option('--workers', default=8, help='Maximum number of Keybase commands running at once. Defaults to 8.')
+@click.pass_obj
+def engines(create_keybase, files, requests, workers):
+    """
+    Compares the threaded and asyncio engines, with concurrent requests which each decrypt and read a
+    number of files at once (as when reading all fields of an identity).
+    """
+
+    keybase = create_keybase('engines')
+    username = keybase.get_username()
+    keybase.ensure_dir(keybase.get_private(''))
+    paths = [keybase.get_private('{}.txt'.format(i)) for i in range(files)]
+    for i, path in enumerate(paths):
+        keybase.encrypt(path, 'value {}'.format(i), [username])
+    keybase.close()
+
+    for engine in ENGINES:
+        keybase = create_keybase('engines', engine=engine, max_workers=workers, max_queue=requests * files * 2,
+                                 decrypt_workers=workers)
+        keybase.get_username()
+
+        # Sample the number of threads while requests are running
+        peak_threads = [threading.active_count()]
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(0.01):
+                peak_threads[0] = max(peak_threads[0], threading.active_count())
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+
+        def request(_):
+            keybase.decrypt_many(paths)
+            keybase.get_many(paths)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=requests) as pool:
+            list(pool.map(request, range(requests)))
+        elapsed = time.perf_counter() - start
+
+        done.set()
+        sampler.join()
+        keybase.close()
+
+        click.echo('{:<8} {} requests of {} files each: {:.3f}s, {:.1f} requests/s, {} threads at peak'.format(
+            engine, requests, files, elapsed, requests / elapsed, peak_threads[0]))
+
+
+if __name__ == '__main__':
+    cli()
@@ -33,15 +33,53 @@ Cache Structure
         }
     ],
     uid_list: {
-        "origin1": []
+        "origin1": {"uid1": None, ...}
     },
-    origin_list: [],
-    decrypted_data_file: {
-        "origin-uid-field_name"
+    origin_list: {"origin1": None, ...},
+    decrypted_data_file: DataFileCache {
+        ("origin", "uid", "field_name", "username"): "value"
     }
 }
+
+Lists of origins and UIDs are kept as insertion-ordered sets (dicts with None values). Each foreign
+map is also indexed by its (uid, field_name, username) triples in the same way, so that mappings can
+be looked up without scanning the whole list.
+Decrypted values are kept in a size-aware LRU, which is bounded by a byte budget.
+
+The time at which each entry was loaded is kept by (section, key), so that stale entries can be
+revalidated (see revalidate.py).
+
+Each entry also has a version, which is taken from a counter shared by all entries whenever the
+entry changes, so that responses built from a set of entries can be tagged with their versions (see
+ETags in main.py). Data files which are known not to exist have a version as well, and are kept in an
+LRU bounded by count. Load times and versions of data files are dropped together with the data files.
+
+The approximate size of each entry in the other sections is kept up to date as it changes, so that
+the size of the cache can be reported without serializing every entry (see stats()).
 """
 
+import copy
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import Counter
+
+# Default byte budget for decrypted values.
+DEFAULT_MAX_DATA_BYTES = 64 * 1024 * 1024
+
+# Maximum number of data files which are remembered not to exist.
+MAX_MISSING_DATA_FILES = 65536
+
+# Sections whose entries are sized by ParanoidCache itself, rather than by DataFileCache.
+SIZED_SECTIONS = ('service_info', 'service_data', 'foreign_map', 'uid_list', 'origin_list')
+
+# Cache lookups by section.
+HITS = Counter('paranoid_cache_hits_total', 'Cache lookups that were served from the cache.', ['section'])
+MISSES = Counter('paranoid_cache_misses_total', 'Cache lookups that missed the cache.', ['section'])
+
 
 class MockCache():
     """
@@ -55,6 +93,115 @@ class MockCache():
         return mock
 
 
+class DataFileCache():
+    """
+    LRU cache for decrypted values, which evicts the least recently used values once the total size
+    of all values exceeds `max_bytes`. Values larger than the budget are not cached at all.
+    `on_evict` is called with the key of each evicted value.
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_DATA_BYTES, on_evict=None):
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        "Returns (data, cache_hit), marking the value as recently used."
+        if key not in self.entries:
+            return None, False
+
+        self.entries.move_to_end(key)
+        return self.entries[key][0], True
+
+    def set(self, key, data):
+        self.remove(key)
+
+        size = DataFileCache.sizeof(data)
+        if size > self.max_bytes:
+            return
+
+        self.entries[key] = (data, size)
+        self.size += size
+
+        # Evict least recently used values until within budget
+        while self.size > self.max_bytes:
+            evicted_key, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            if self.on_evict is not None:
+                self.on_evict(evicted_key)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def items(self):
+        "Returns a list of (key, data) tuples, from least to most recently used."
+        return [(key, data) for key, (data, _) in self.entries.items()]
+
+    @staticmethod
+    def sizeof(data):
+        return len(data.encode('utf-8')) if isinstance(data, str) else len(data)
+
+
+class SingleFlight():
+    """
+    Shares a single in-flight load between all threads that miss the cache on the same key at once.
+    The result of the load, or the exception it raised, is delivered to every waiting thread.
+    """
+    class Call():
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+        def wait(self):
+            self.done.wait()
+            if self.error is not None:
+                raise self.error
+            return self.result
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def begin(self, key):
+        "Returns (call, leader), where leader is True if the current thread should perform the load and finish it."
+        with self.lock:
+            if key in self.calls:
+                return self.calls[key], False
+            call = self.calls[key] = SingleFlight.Call()
+            return call, True
+
+    def finish(self, key, result=None, error=None):
+        "Delivers the result of a load (or the exception it raised) to all waiting threads."
+        with self.lock:
+            call = self.calls.pop(key)
+        call.result = result
+        call.error = error
+        call.done.set()
+
+    def do(self, key, fn, *args):
+        "Calls fn(*args), unless another thread is already doing so for the same key, in which case its result is returned."
+        call, leader = self.begin(key)
+        if not leader:
+            return call.wait()
+
+        try:
+            result = fn(*args)
+        except Exception as e:
+            self.finish(key, error=e)
+            raise
+        self.finish(key, result)
+        return result
+
+
 class ParanoidCache():
     def __init__(self):
         self.cache = {
@@ -63,92 +210,354 @@ class ParanoidCache():
             'foreign_map': {},
             'uid_list': {},
             'origin_list': None,
-            'decrypted_data_file': {}
+            'decrypted_data_file': DataFileCache(on_evict=self.forget_data_file),
         }
+        self.loaded_at = {}
+        self.foreign_map_index = {}
+        self.versions = {}
+        self.version_counter = itertools.count(1)
+        self.missing_data_files = OrderedDict()
+        self.max_missing_data_files = MAX_MISSING_DATA_FILES
+
+        # Approximate size in bytes of each entry by (section, key), and the total size of each section
+        self.entry_sizes = {}
+        self.section_sizes = dict.fromkeys(SIZED_SECTIONS, 0)
+
+        # Guards all sections, so that the cache can be used from many threads. Reentrant, since some
+        # methods call others (e.g. set_service adds to the origin list).
+        self.lock = threading.RLock()
+
+    def init(self, max_data_bytes=DEFAULT_MAX_DATA_BYTES):
+        "Sets the byte budget for decrypted values."
+        with self.lock:
+            self.cache['decrypted_data_file'] = DataFileCache(max_bytes=max_data_bytes, on_evict=self.forget_data_file)
+
+    def dump(self):
+        "Returns the contents of the cache as a JSON-serializable object."
+        with self.lock:
+            origin_list = self.cache['origin_list']
+            return copy.deepcopy({
+                'service_info': self.cache['service_info'],
+                'service_data': self.cache['service_data'],
+                'foreign_map': self.cache['foreign_map'],
+                'uid_list': {origin: list(uids) for origin, uids in self.cache['uid_list'].items()},
+                'origin_list': list(origin_list) if origin_list is not None else None,
+                'decrypted_data_file': [[list(key), data] for key, data in self.cache['decrypted_data_file'].items()],
+            })
+
+    def load(self, dump):
+        "Replaces the contents of the cache with an object returned by dump()."
+        with self.lock:
+            self.cache['service_info'] = dump['service_info']
+            self.cache['service_data'] = dump['service_data']
+            self.cache['foreign_map'] = dump['foreign_map']
+            self.foreign_map_index = {
+                origin: ParanoidCache.index_foreign_map(foreign_map)
+                for origin, foreign_map in dump['foreign_map'].items()
+            }
+            self.cache['uid_list'] = {origin: dict.fromkeys(uids) for origin, uids in dump['uid_list'].items()}
+            self.cache['origin_list'] = dict.fromkeys(dump['origin_list']) if dump['origin_list'] is not None else None
+
+            self.entry_sizes = {}
+            self.section_sizes = dict.fromkeys(SIZED_SECTIONS, 0)
+            for section in ('service_info', 'foreign_map', 'uid_list'):
+                for key, entry in self.cache[section].items():
+                    self.resize(section, key, entry)
+            for origin, uids in self.cache['service_data'].items():
+                for uid, identity in uids.items():
+                    self.resize('service_data', (origin, uid), identity)
+            self.resize('origin_list', None, self.cache['origin_list'])
+
+            data_files = DataFileCache(max_bytes=self.cache['decrypted_data_file'].max_bytes,
+                                       on_evict=self.forget_data_file)
+            for key, data in dump['decrypted_data_file']:
+                data_files.set(tuple(key), data)
+            self.cache['decrypted_data_file'] = data_files
+
+            # Loaded entries have not been checked against KBFS yet
+            self.loaded_at = {}
+            self.versions = {}
+            self.missing_data_files = OrderedDict()
+
+    def stats(self):
+        "Returns a dict of each section to its number of entries and their approximate size in bytes."
+        with self.lock:
+            stats = {}
+            for section in ('service_info', 'foreign_map', 'uid_list'):
+                stats[section] = (len(self.cache[section]), self.section_sizes[section])
+            stats['service_data'] = (sum(len(uids) for uids in self.cache['service_data'].values()),
+                                     self.section_sizes['service_data'])
+            stats['origin_list'] = (len(self.cache['origin_list'] or ()), self.section_sizes['origin_list'])
+
+            data_files = self.cache['decrypted_data_file']
+            stats['decrypted_data_file'] = (len(data_files), data_files.size)
+            return stats
+
+    def resize(self, section, key, entry):
+        "Records the approximate size of an entry which changed, or forgets it if the entry is None."
+        with self.lock:
+            self.section_sizes[section] -= self.entry_sizes.pop((section, key), 0)
+            if entry is not None:
+                size = len(json.dumps(entry))
+                self.entry_sizes[(section, key)] = size
+                self.section_sizes[section] += size
+
+    @staticmethod
+    def count(section, cache_hit):
+        "Counts a cache hit or miss."
+        (HITS if cache_hit else MISSES).inc(section)
+
+    def touch(self, section, key=None):
+        "Marks an entry as freshly loaded."
+        with self.lock:
+            self.loaded_at[(section, key)] = time.monotonic()
+
+    def age(self, section, key=None):
+        "Returns the number of seconds since an entry was loaded, or None if unknown."
+        with self.lock:
+            loaded_at = self.loaded_at.get((section, key))
+            if loaded_at is None:
+                return None
+            return time.monotonic() - loaded_at
+
+    def get_version(self, section, key=None):
+        "Returns (version, cache_hit) for an entry, where the version changes whenever the entry does."
+        with self.lock:
+            version = self.versions.get((section, key))
+            return version, version is not None
+
+    def bump(self, section, key=None, changed=True):
+        "Gives an entry a new version if it changed, or if it does not have one yet."
+        with self.lock:
+            if changed or (section, key) not in self.versions:
+                self.versions[(section, key)] = next(self.version_counter)
+
+    def peek(self, section, key=None):
+        "Returns (data, cache_hit) for an entry, without counting the lookup as a cache hit or miss."
+        with self.lock:
+            if section == 'origin_list':
+                data = self.cache['origin_list']
+                return (list(data), True) if data is not None else (None, False)
+            if section == 'service_data':
+                origin, uid = key
+                uids = self.cache['service_data'].get(origin, {})
+                return uids.get(uid), uid in uids
+            if section == 'decrypted_data_file':
+                data_files = self.cache['decrypted_data_file']
+                return (data_files.entries[key][0], True) if key in data_files else (None, False)
+            return self.cache[section].get(key), key in self.cache[section]
+
+    def invalidate(self, section, key=None):
+        "Removes an entry from the cache."
+        with self.lock:
+            self.loaded_at.pop((section, key), None)
+            self.versions.pop((section, key), None)
+            self.missing_data_files.pop(key, None)
+            if section in SIZED_SECTIONS:
+                self.resize(section, key, None)
+            if section == 'origin_list':
+                self.cache['origin_list'] = None
+            elif section == 'service_data':
+                origin, uid = key
+                self.cache['service_data'].get(origin, {}).pop(uid, None)
+            elif section == 'decrypted_data_file':
+                self.cache['decrypted_data_file'].remove(key)
+            elif section == 'foreign_map':
+                self.cache['foreign_map'].pop(key, None)
+                self.foreign_map_index.pop(key, None)
+            else:
+                self.cache[section].pop(key, None)
 
     def get_origins(self):
-        cache_hit = False
-        data = None
-        if self.cache['origin_list'] != None:
-            data = self.cache['origin_list']
-            cache_hit = True
+        with self.lock:
+            cache_hit = False
+            data = None
+            if self.cache['origin_list'] != None:
+                data = list(self.cache['origin_list'])
+                cache_hit = True
 
-        return data, cache_hit
+            ParanoidCache.count('origin_list', cache_hit)
+            return data, cache_hit
 
     def add_origins(self, origin_list):
-        if self.cache['origin_list'] == None:
-            self.cache['origin_list'] = []
-        for origin in origin_list:
-            if origin not in self.cache['origin_list']:
-                self.cache['origin_list'].append(origin)
+        with self.lock:
+            if self.cache['origin_list'] == None:
+                self.cache['origin_list'] = {}
+            changed = any(origin not in self.cache['origin_list'] for origin in origin_list)
+            self.cache['origin_list'].update(dict.fromkeys(origin_list))
+            if changed:
+                self.resize('origin_list', None, self.cache['origin_list'])
+            self.bump('origin_list', changed=changed)
+
+    def set_origins(self, origin_list):
+        with self.lock:
+            changed = list(self.cache['origin_list'] or []) != list(origin_list)
+            self.cache['origin_list'] = dict.fromkeys(origin_list)
+            if changed or ('origin_list', None) not in self.entry_sizes:
+                self.resize('origin_list', None, self.cache['origin_list'])
+            self.touch('origin_list')
+            self.bump('origin_list', changed=changed)
 
     def set_service(self, origin, info_json):
-        self.add_origins([origin])  #add origin to cache
-        self.cache['service_info'][origin] = info_json
+        with self.lock:
+            self.add_origins([origin])  #add origin to cache
+            changed = self.cache['service_info'].get(origin) != info_json
+            self.cache['service_info'][origin] = info_json
+            if changed or ('service_info', origin) not in self.entry_sizes:
+                self.resize('service_info', origin, info_json)
+            self.touch('service_info', origin)
+            self.bump('service_info', origin, changed=changed)
 
     def get_service(self, origin):
-        cache_hit = False
-        data = None
-        if origin in self.cache['service_info']:
-            data = self.cache['service_info'][origin]
-            cache_hit = True
+        with self.lock:
+            cache_hit = False
+            data = None
+            if origin in self.cache['service_info']:
+                data = self.cache['service_info'][origin]
+                cache_hit = True
 
-        return data, cache_hit
+            ParanoidCache.count('service_info', cache_hit)
+            return data, cache_hit
 
     def get_service_uids(self, origin):
-        cache_hit = False
-        data = None
-        if origin in self.cache['uid_list']:
-            data = self.cache['uid_list'][origin]
-            cache_hit = True
+        with self.lock:
+            cache_hit = False
+            data = None
+            if origin in self.cache['uid_list']:
+                data = list(self.cache['uid_list'][origin])
+                cache_hit = True
 
-        return data, cache_hit
+            ParanoidCache.count('uid_list', cache_hit)
+            return data, cache_hit
 
     def add_service_uids(self, origin, uid_list):
-        if origin not in self.cache['uid_list']:
-            self.cache['uid_list'][origin] = []
-        for uid in uid_list:
-            if uid not in self.cache['uid_list'][origin]:
-                self.cache['uid_list'][origin].append(uid)
+        with self.lock:
+            if origin not in self.cache['uid_list']:
+                self.cache['uid_list'][origin] = {}
+            changed = any(uid not in self.cache['uid_list'][origin] for uid in uid_list)
+            self.cache['uid_list'][origin].update(dict.fromkeys(uid_list))
+            if changed or ('uid_list', origin) not in self.entry_sizes:
+                self.resize('uid_list', origin, self.cache['uid_list'][origin])
+            self.bump('uid_list', origin, changed=changed)
+
+    def set_service_uids(self, origin, uid_list):
+        with self.lock:
+            changed = list(self.cache['uid_list'].get(origin, {})) != list(uid_list)
+            self.cache['uid_list'][origin] = dict.fromkeys(uid_list)
+            if changed or ('uid_list', origin) not in self.entry_sizes:
+                self.resize('uid_list', origin, self.cache['uid_list'][origin])
+            self.touch('uid_list', origin)
+            self.bump('uid_list', origin, changed=changed)
 
     def set_service_identity(self, origin, uid, identity_json):
-        if origin not in self.cache['service_data']:
-            self.cache['service_data'][origin] = {}
+        with self.lock:
+            if origin not in self.cache['service_data']:
+                self.cache['service_data'][origin] = {}
 
-        self.add_service_uids(origin, [uid])  #add uid to uid list
-        self.cache['service_data'][origin][uid] = identity_json
+            self.add_service_uids(origin, [uid])  #add uid to uid list
+            changed = self.cache['service_data'][origin].get(uid) != identity_json
+            self.cache['service_data'][origin][uid] = identity_json
+            if changed or ('service_data', (origin, uid)) not in self.entry_sizes:
+                self.resize('service_data', (origin, uid), identity_json)
+            self.touch('service_data', (origin, uid))
+            self.bump('service_data', (origin, uid), changed=changed)
 
     def get_service_identity(self, origin, uid):
-        cache_hit = False
-        data = None
-        if origin in self.cache['service_data'] and uid in self.cache['service_data'][origin]:
-            data = self.cache['service_data'][origin][uid]
-            cache_hit = True
+        with self.lock:
+            cache_hit = False
+            data = None
+            if origin in self.cache['service_data'] and uid in self.cache['service_data'][origin]:
+                data = self.cache['service_data'][origin][uid]
+                cache_hit = True
 
-        return data, cache_hit
+            ParanoidCache.count('service_data', cache_hit)
+            return data, cache_hit
 
     def set_foreign_map(self, origin, foreign_map_json):
-        self.cache['foreign_map'][origin] = foreign_map_json
+        with self.lock:
+            changed = self.cache['foreign_map'].get(origin) != foreign_map_json
+            self.cache['foreign_map'][origin] = foreign_map_json
+            if changed or ('foreign_map', origin) not in self.entry_sizes:
+                self.resize('foreign_map', origin, foreign_map_json)
+            self.foreign_map_index[origin] = ParanoidCache.index_foreign_map(foreign_map_json)
+            self.touch('foreign_map', origin)
+            self.bump('foreign_map', origin, changed=changed)
 
     def get_foreign_map(self, origin):
-        cache_hit = False
-        data = None
-        if origin in self.cache['foreign_map']:
-            data = self.cache['foreign_map'][origin]
-            cache_hit = True
-
-        return data, cache_hit
-
-    def decrypt_data_file(self, origin, uid, field_name):
-        key = "{}-{}-{}".format(origin, uid, field_name)
-        cache_hit = False
-        data = None
-        if key in self.cache['decrypted_data_file']:
-            data = self.cache['decrypted_data_file'][key]
-            cache_hit = True
-
-        return data, cache_hit
-
-    def encrypt_data_file(self, origin, uid, field_name, data):
-        key = "{}-{}-{}".format(origin, uid, field_name)
-        self.cache['decrypted_data_file'][key] = data
+        with self.lock:
+            cache_hit = False
+            data = None
+            if origin in self.cache['foreign_map']:
+                data = self.cache['foreign_map'][origin]
+                cache_hit = True
+
+            ParanoidCache.count('foreign_map', cache_hit)
+            return data, cache_hit
+
+    def get_foreign_map_index(self, origin):
+        "Returns a copy of the (uid, field_name, username) triples in a foreign map, as an insertion-ordered set."
+        with self.lock:
+            cache_hit = False
+            data = None
+            if origin in self.foreign_map_index:
+                data = dict(self.foreign_map_index[origin])
+                cache_hit = True
+
+            return data, cache_hit
+
+    @staticmethod
+    def index_foreign_map(foreign_map_json):
+        "Indexes a foreign map by (uid, field_name, username) triples, skipping invalid mappings."
+        index = {}
+        for mapping in foreign_map_json:
+            triple = (mapping.get('uid'), mapping.get('field_name'), mapping.get('username'))
+            if all(triple):
+                index[triple] = None
+        return index
+
+    def decrypt_data_file(self, origin, uid, field_name, username=None):
+        with self.lock:
+            data, cache_hit = self.cache['decrypted_data_file'].get((origin, uid, field_name, username))
+            ParanoidCache.count('decrypted_data_file', cache_hit)
+            return data, cache_hit
+
+    def encrypt_data_file(self, origin, uid, field_name, data, username=None):
+        with self.lock:
+            key = (origin, uid, field_name, username)
+            changed = self.cache['decrypted_data_file'].get(key) != (data, True)
+            self.cache['decrypted_data_file'].set(key, data)
+            self.missing_data_files.pop(key, None)
+
+            # Values larger than the budget are not cached
+            if key not in self.cache['decrypted_data_file']:
+                self.forget_data_file(key)
+                return
+
+            self.touch('decrypted_data_file', key)
+            self.bump('decrypted_data_file', key, changed=changed)
+
+    def set_missing_data_file(self, origin, uid, field_name, username=None):
+        "Records that a data file does not exist, so that responses without its value can still be versioned."
+        with self.lock:
+            key = (origin, uid, field_name, username)
+            changed = key not in self.missing_data_files
+            self.cache['decrypted_data_file'].remove(key)
+            self.missing_data_files[key] = None
+            self.missing_data_files.move_to_end(key)
+            self.touch('decrypted_data_file', key)
+            self.bump('decrypted_data_file', key, changed=changed)
+
+            # Forget the least recently recorded missing data files
+            while len(self.missing_data_files) > self.max_missing_data_files:
+                evicted_key, _ = self.missing_data_files.popitem(last=False)
+                self.forget_data_file(evicted_key)
+
+    def forget_data_file(self, key):
+        "Drops the load time and version of a data file which is no longer cached."
+        with self.lock:
+            self.loaded_at.pop(('decrypted_data_file', key), None)
+            self.versions.pop(('decrypted_data_file', key), None)
+
+    def remove_data_file(self, origin, uid, field_name, username=None):
+        with self.lock:
+            self.invalidate('decrypted_data_file', (origin, uid, field_name, username))
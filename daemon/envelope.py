@@ -0,0 +1,120 @@
+"""
+Envelope encryption for data files.
+
+The value of a field is encrypted once under a random per-field data key with AES-GCM, and only
+the data key is encrypted with Keybase for the list of shared users. Sharing or unsharing a field
+then only needs to rewrite the small key file, instead of the whole value.
+
+- File path:
+  /keybase/public/irvinlim/paranoid/ids/<hash>
+- Contents:
+  ```
+  PARANOID ENVELOPE V1
+  {"key_id": "...", "nonce": "...", "tag": "...", "ciphertext": "..."}
+  ```
+
+- File path:
+  /keybase/public/irvinlim/paranoid/ids/<hash>.key
+- Contents:
+  ```
+  BEGIN KEYBASE SALTPACK ENCRYPTED MESSAGE...
+  ```
+  (the base64-encoded data key)
+
+The field hash is bound to the ciphertext as associated data, so that a data file cannot be
+passed off as the value of another field.
+
+The data key is written before the data file (so that the data file is left untouched if the key
+cannot be encrypted for the users), so the two can be read from different writes in between. The
+data file records a digest of its data key as "key_id", so that readers can tell such a pair apart
+from a corrupt data file, and read both again.
+"""
+
+import base64
+import hashlib
+import json
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+ENVELOPE_HEADER = 'PARANOID ENVELOPE V1\n'
+
+# Suffix of the key file, relative to the data file.
+KEY_SUFFIX = '.key'
+
+
+class EnvelopeException(Exception):
+    pass
+
+
+class EnvelopeKeyMismatchException(EnvelopeException):
+    "Raised when a data file was sealed with another data key, e.g. if it was read while being rewritten."
+    pass
+
+
+def generate_key():
+    "Returns a new random 256-bit data key."
+    return get_random_bytes(32)
+
+
+def encode_key(key):
+    return base64.b64encode(key).decode('ascii')
+
+
+def decode_key(encoded):
+    try:
+        return base64.b64decode(encoded.strip())
+    except ValueError:
+        raise EnvelopeException('Malformed data key')
+
+
+def get_key_id(key):
+    "Returns a digest which identifies a data key, without revealing it."
+    return hashlib.sha256(key).hexdigest()[:16]
+
+
+def is_sealed(contents):
+    "Returns True if the contents of a data file are in the envelope format."
+    return contents.startswith(ENVELOPE_HEADER)
+
+
+def seal(key, data, field_hash):
+    "Encrypts a value with a data key, returning the contents of the data file."
+    cipher = AES.new(key, AES.MODE_GCM)
+    cipher.update(field_hash.encode('utf-8'))
+    ciphertext, tag = cipher.encrypt_and_digest(data.encode('utf-8'))
+
+    return ENVELOPE_HEADER + json.dumps({
+        'key_id': get_key_id(key),
+        'nonce': base64.b64encode(cipher.nonce).decode('ascii'),
+        'tag': base64.b64encode(tag).decode('ascii'),
+        'ciphertext': base64.b64encode(ciphertext).decode('ascii'),
+    })
+
+
+def unseal(key, contents, field_hash):
+    "Decrypts the contents of a data file with a data key, returning the value."
+    if not is_sealed(contents):
+        raise EnvelopeException('Data file is not in the envelope format')
+
+    try:
+        sealed = json.loads(contents[len(ENVELOPE_HEADER):])
+        key_id = sealed.get('key_id')
+        if key_id is not None and key_id != get_key_id(key):
+            raise EnvelopeKeyMismatchException('Data file was sealed with another data key')
+
+        cipher = AES.new(key, AES.MODE_GCM, nonce=base64.b64decode(sealed['nonce']))
+        cipher.update(field_hash.encode('utf-8'))
+        ciphertext, tag = base64.b64decode(sealed['ciphertext']), base64.b64decode(sealed['tag'])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise EnvelopeException('Could not decrypt data file')
+
+    try:
+        data = cipher.decrypt_and_verify(ciphertext, tag)
+    except ValueError:
+        # Data files written before key IDs were recorded cannot tell a mismatched data key from corruption
+        if key_id is None:
+            raise EnvelopeKeyMismatchException('Could not decrypt data file')
+        raise EnvelopeException('Could not decrypt data file')
+
+    return data.decode('utf-8')
@@ -0,0 +1,146 @@
+"""
+Stream of changes to Paranoid data, served as Server-Sent Events at /events.
+
+ParanoidManager publishes an event whenever it writes a cache entry, and the revalidator publishes
+one whenever it finds that an entry changed in KBFS (e.g. a value shared by another user). Events
+only say what changed, so that clients can refetch just that:
+
+    event: field
+    id: 3f2a9c1b-42
+    data: {"origin": "https:example.com:443", "uid": "1", "field": "email", "username": "alice", "version": 87}
+
+The version is that of the cache entry (as in ETags), or null if the entry no longer exists (or the
+cache is disabled).
+
+Each client holds on to a server thread for as long as it is connected, so the number of clients is
+capped below the number of server threads, and further clients are turned away.
+
+Recent events are kept in a bounded history, which every client reads from at its own pace. Clients
+which reconnect with a Last-Event-ID are sent the events they missed, or a "reset" event if those are
+no longer in the history (or are from an earlier run of the daemon), after which they should refetch
+everything.
+"""
+
+import json
+import threading
+from collections import deque
+
+# Event types and fields by cache section.
+EVENT_TYPES = {
+    'origin_list': ('services', ()),
+    'service_info': ('service', ('origin', )),
+    'uid_list': ('uids', ('origin', )),
+    'service_data': ('identity', ('origin', 'uid')),
+    'foreign_map': ('foreign_map', ('origin', )),
+    'decrypted_data_file': ('field', ('origin', 'uid', 'field', 'username')),
+}
+
+
+class EventStreamFullException(Exception):
+    def __init__(self):
+        super().__init__('Too many clients are connected to the event stream, please try again later.')
+
+
+class EventStream():
+    def __init__(self, run_id, history=1024, heartbeat=15, max_clients=None):
+        self.run_id = run_id
+        self.history = deque(maxlen=history)
+        self.heartbeat = heartbeat
+        self.max_clients = max_clients
+        self.next_id = 1
+        self.clients = 0
+        self.cond = threading.Condition()
+
+    def init(self, max_clients=None):
+        "Caps the number of clients connected at once, or lifts the cap if None."
+        self.max_clients = max_clients
+
+    def publish(self, section, key=None, version=None):
+        "Publishes a change to a cache entry to all clients."
+        event_type, fields = EVENT_TYPES[section]
+        if len(fields) == 1:
+            key = (key, )
+        data = dict(zip(fields, key or ()), version=version)
+
+        with self.cond:
+            self.history.append((self.next_id, event_type, data))
+            self.next_id += 1
+            self.cond.notify_all()
+
+    def listen(self, last_event_id=None):
+        """
+        Returns an iterable of messages in the event stream format, starting after last_event_id (or from now
+        if None), with a comment every heartbeat seconds so that closed connections are noticed. The client
+        is disconnected once the iterable is closed.
+
+        Raises EventStreamFullException if the maximum number of clients are already connected.
+        """
+
+        with self.cond:
+            if self.max_clients is not None and self.clients >= self.max_clients:
+                raise EventStreamFullException()
+            self.clients += 1
+            position = self.next_id - 1
+            reset = False
+            if last_event_id is not None:
+                run_id, _, event_id = last_event_id.partition('-')
+                oldest = self.history[0][0] if self.history else self.next_id
+                if run_id == self.run_id and event_id.isdigit() and oldest - 1 <= int(event_id) < self.next_id:
+                    position = int(event_id)
+                else:
+                    reset = True
+
+        return Subscription(self, self.messages(position, reset))
+
+    def messages(self, position, reset):
+        "Yields messages for a client which has seen all events up to position, starting with a reset if set."
+        yield 'retry: 3000\n\n'
+        while True:
+            if reset:
+                yield self.format(position, 'reset', {})
+                reset = False
+
+            with self.cond:
+                if self.next_id - 1 == position:
+                    self.cond.wait(self.heartbeat)
+                events = [event for event in self.history if event[0] > position]
+
+                # Events were dropped from the history before this client could read them
+                oldest = self.history[0][0] if self.history else self.next_id
+                if oldest > position + 1:
+                    reset = True
+                    position = self.next_id - 1
+                    continue
+                if events:
+                    position = events[-1][0]
+
+            if not events:
+                yield ': heartbeat\n\n'
+            for event_id, event_type, data in events:
+                yield self.format(event_id, event_type, data)
+
+    def disconnect(self):
+        "Frees up the slot of a client that disconnected."
+        with self.cond:
+            self.clients -= 1
+
+    def format(self, event_id, event_type, data):
+        "Formats an event as a message in the event stream format."
+        return 'event: {}\nid: {}-{}\ndata: {}\n\n'.format(event_type, self.run_id, event_id, json.dumps(data))
+
+
+class Subscription():
+    "Messages for a single client, which frees up its slot when closed (even if it was never iterated)."
+    def __init__(self, stream, messages):
+        self.stream = stream
+        self.messages = messages
+        self.closed = False
+
+    def __iter__(self):
+        return self.messages
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.messages.close()
+            self.stream.disconnect()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""
+Scriptable stand-in for the `keybase` executable, for running the daemon without a real
+Keybase account.
+
+KBFS paths (/keybase/...) are mapped onto a local directory, and "encryption" only records
+the list of recipients alongside the base64-encoded data, so that decryption can be denied
+to users who are not on that list. Nothing about this is secure!
+
+The following environment variables control its behaviour:
+
+- FAKE_KEYBASE_ROOT: Local directory standing in for /keybase. Defaults to ./.fake-keybase.
+- FAKE_KEYBASE_USER: Username of the logged in user. Defaults to "alice".
+- FAKE_KEYBASE_LATENCY: Seconds to sleep before handling each command, to simulate a slow KBFS.
+- FAKE_KEYBASE_FAIL: Shell-style pattern matched against each command line (e.g. "decrypt *"),
+  which makes matching commands fail.
+
+Per-call usage mirrors the real CLI:
+
+    python fake_keybase.py fs read /keybase/private/alice/paranoid/services/...
+
+Session usage speaks the protocol expected by `KeybaseSession`:
+
+    python main.py --keybase-session "python fake_keybase.py --session"
+"""
+
+import base64
+import fnmatch
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+FAKE_SALTPACK_HEADER = 'BEGIN FAKE KEYBASE SALTPACK ENCRYPTED MESSAGE.\n'
+
+# Number of session requests handled at once.
+SESSION_WORKERS = 32
+
+
+class FakeKeybaseError(Exception):
+    def __init__(self, message, returncode=1):
+        super().__init__(message)
+        self.returncode = returncode
+
+
+class FakeKeybase:
+    def __init__(self, root=None, username=None, latency=None, fail=None):
+        env = os.environ
+        self.root = os.path.abspath(root or env.get('FAKE_KEYBASE_ROOT') or '.fake-keybase')
+        self.username = username or env.get('FAKE_KEYBASE_USER') or 'alice'
+        self.latency = float(latency if latency is not None else env.get('FAKE_KEYBASE_LATENCY') or 0)
+        self.fail = fail if fail is not None else env.get('FAKE_KEYBASE_FAIL')
+
+    def run(self, args, inp=None):
+        "Runs a single command, returning (returncode, stdout, stderr)."
+        if self.latency:
+            time.sleep(self.latency)
+
+        try:
+            if self.fail and fnmatch.fnmatch(' '.join(args), self.fail):
+                raise FakeKeybaseError('injected failure')
+            return 0, self._dispatch(args, inp), ''
+        except FakeKeybaseError as e:
+            return e.returncode, '', 'ERROR {}\n'.format(e)
+
+    def local_path(self, path):
+        "Maps a KBFS path onto the local root directory."
+        path = os.path.normpath(path)
+        if path != '/keybase' and not path.startswith('/keybase/'):
+            raise FakeKeybaseError('not a KBFS path: {}'.format(path))
+        return os.path.join(self.root, path[len('/keybase/'):])
+
+    def _dispatch(self, args, inp):
+        if args[:2] == ['id', '--json']:
+            return json.dumps({'username': self.username})
+        if args[:1] == ['fs']:
+            return self._fs(args[1:], inp)
+        if args[:2] == ['encrypt', '-o']:
+            return self._encrypt(args[2], args[3:], inp)
+        if args[:2] == ['decrypt', '-i']:
+            return self._decrypt(args[2])
+        if args[:3] == ['chat', 'send', '--private']:
+            return self._chat(args[3], args[4])
+        raise FakeKeybaseError('unsupported command: {}'.format(' '.join(args)))
+
+    def _fs(self, args, inp):
+        cmd, path = args[0], self.local_path(args[1])
+
+        if cmd == 'stat':
+            if not os.path.exists(path):
+                raise FakeKeybaseError('file does not exist')
+            return '{}\t{}\n'.format('DIR' if os.path.isdir(path) else 'FILE', args[1])
+
+        if cmd == 'read':
+            if not os.path.isfile(path):
+                raise FakeKeybaseError('file does not exist')
+            with open(path) as f:
+                return f.read()
+
+        if cmd == 'write':
+            if not os.path.isdir(os.path.dirname(path)):
+                raise FakeKeybaseError('file does not exist')
+            with open(path, 'w') as f:
+                f.write(inp or '')
+            return ''
+
+        if cmd == 'mkdir':
+            os.makedirs(path, exist_ok=True)
+            return ''
+
+        if cmd == 'ls':
+            if not os.path.isdir(path):
+                raise FakeKeybaseError('file does not exist')
+            return ''.join('{}\n'.format(name) for name in sorted(os.listdir(path)))
+
+        if cmd == 'rm':
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+            return ''
+
+        raise FakeKeybaseError('unsupported fs command: {}'.format(cmd))
+
+    def _encrypt(self, path, users, inp):
+        # Like the real CLI, the sender can always decrypt their own messages unless --no-self is given
+        if '--no-self' in users:
+            users = [user for user in users if user != '--no-self']
+        else:
+            users = users + [self.username]
+
+        self._fs(['write', path], FAKE_SALTPACK_HEADER + json.dumps({
+            'recipients': users,
+            'data': base64.b64encode((inp or '').encode('utf-8')).decode('ascii'),
+        }))
+        return ''
+
+    def _decrypt(self, path):
+        contents = self._fs(['read', path], None)
+        if not contents.startswith(FAKE_SALTPACK_HEADER):
+            raise FakeKeybaseError('not a saltpack message')
+
+        message = json.loads(contents[len(FAKE_SALTPACK_HEADER):])
+        if self.username not in message['recipients']:
+            raise FakeKeybaseError('decryption failed: no suitable key found')
+        return base64.b64decode(message['data']).decode('utf-8')
+
+    def _chat(self, channel, message):
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, 'chat.log'), 'a') as f:
+            f.write(json.dumps({'from': self.username, 'channel': channel, 'message': message}) + '\n')
+        return ''
+
+
+def serve_session(fake):
+    """
+    Serves requests over stdin/stdout until stdin is closed, handling up to SESSION_WORKERS requests at once.
+    Malformed requests are answered with an error reply, without an ID if it could not be read.
+    """
+    write_lock = threading.Lock()
+
+    def reply(request_id, returncode, stdout, stderr):
+        res = json.dumps({'id': request_id, 'returncode': returncode, 'stdout': stdout, 'stderr': stderr})
+        with write_lock:
+            sys.stdout.write(res + '\n')
+            sys.stdout.flush()
+
+    def handle(req):
+        try:
+            reply(req.get('id'), *fake.run(req.get('args') or [], req.get('input')))
+        except Exception as e:
+            reply(req.get('id'), 1, '', 'ERROR malformed request: {}\n'.format(e))
+
+    with ThreadPoolExecutor(max_workers=SESSION_WORKERS) as pool:
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+
+            try:
+                req = json.loads(line)
+                if not isinstance(req, dict):
+                    raise ValueError('expected a JSON object')
+            except ValueError as e:
+                reply(None, 1, '', 'ERROR malformed request: {}\n'.format(e))
+                continue
+
+            pool.submit(handle, req)
+
+
+def main(argv):
+    fake = FakeKeybase()
+
+    if argv[:1] == ['--session']:
+        serve_session(fake)
+        return 0
+
+    inp = None if sys.stdin.isatty() else sys.stdin.read()
+    returncode, stdout, stderr = fake.run(argv, inp)
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    return returncode
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
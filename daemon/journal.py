@@ -0,0 +1,144 @@
+"""
+Write-behind journal for metadata files.
+
+Writes are appended to a local journal file, which is synced to disk before returning, and are
+written to KBFS by a background thread after a short delay. Repeated writes to the same path
+within that window are coalesced into a single KBFS write. Any writes left in the journal by a
+daemon that did not shut down cleanly are replayed on start.
+
+Note that the journal holds metadata in plaintext, so it is only readable by the current user.
+"""
+
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import click
+
+
+class WriteJournal:
+    def __init__(self, keybase, path, delay=1.0):
+        self.keybase = keybase
+        self.path = path
+        self.delay = delay
+        self.pending = OrderedDict()
+        self.file = None
+        self.closed = False
+        self.lock = threading.RLock()
+        self.cond = threading.Condition(self.lock)
+
+        # Serializes flushes, so that an older snapshot of a path is never written after a newer one
+        self.flush_lock = threading.Lock()
+        self.flusher = threading.Thread(target=self._run, name='journal-flusher', daemon=True)
+
+    def start(self):
+        "Replays the journal left behind by a previous run, then starts flushing in the background."
+        os.makedirs(os.path.dirname(self.path) or '.', mode=0o700, exist_ok=True)
+
+        with self.lock:
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # Ignore a partially written last line
+                            continue
+                        self.pending[entry['path']] = entry['data']
+                        self.pending.move_to_end(entry['path'])
+
+            self._compact()
+
+        self.flusher.start()
+
+    def put_file(self, path, data):
+        "Records a write to a file, which will be written to KBFS later."
+        with self.lock:
+            self.file.write(json.dumps({'path': path, 'data': data}) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+            self.pending[path] = data
+            self.pending.move_to_end(path)
+            self.cond.notify_all()
+
+    def get_file(self, path):
+        "Returns the contents of a file that has not been written to KBFS yet, otherwise None."
+        with self.lock:
+            return self.pending.get(path)
+
+    def list_pending(self, path):
+        "Returns the filenames in a directory that have not been written to KBFS yet."
+        path = os.path.normpath(path)
+        with self.lock:
+            return [os.path.basename(p) for p in self.pending if os.path.dirname(os.path.normpath(p)) == path]
+
+    def flush(self):
+        "Writes all pending writes to KBFS, and blocks until done."
+        with self.flush_lock:
+            with self.lock:
+                pending = list(self.pending.items())
+
+            errors = []
+            written = []
+            for path, data in pending:
+                try:
+                    self.keybase.put_file(path, data)
+                    written.append((path, data))
+                except Exception as e:
+                    errors.append(e)
+
+            with self.lock:
+                # Keep any paths which were written to again while flushing
+                for path, data in written:
+                    if self.pending.get(path) == data:
+                        del self.pending[path]
+                self._compact()
+
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        "Flushes all pending writes and stops the background thread."
+        with self.lock:
+            self.closed = True
+            self.cond.notify_all()
+        if self.flusher.is_alive():
+            self.flusher.join()
+
+        self.flush()
+        with self.lock:
+            self.file.close()
+
+    def _compact(self):
+        "Rewrites the journal with only the pending writes. Must be called with the lock held."
+        if self.file is not None:
+            self.file.close()
+
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            for path, data in self.pending.items():
+                f.write(json.dumps({'path': path, 'data': data}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+        self.file = open(self.path, 'a')
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+
+                # Wait for more writes to coalesce before flushing
+                self.cond.wait_for(lambda: self.closed, timeout=self.delay)
+                if self.closed:
+                    return
+
+            try:
+                self.flush()
+            except Exception as e:
+                click.secho(' * Failed to flush write journal, will retry: {}'.format(e), fg='red', err=True)
@@ -1,9 +1,42 @@
+import asyncio
+import contextvars
 import fnmatch
+import heapq
+import io
+import locale
+import itertools
 import json
 import os
+import platform
 import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
 from functools import lru_cache
-import platform
+
+from metrics import Counter, Histogram
+
+# Priority classes for Keybase commands, where lower values are served first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_REENCRYPT = 1
+PRIORITY_PREFETCH = 2
+
+# Engines for running Keybase commands.
+ENGINES = ('threads', 'asyncio')
+
+# Metrics for Keybase commands, by subcommand (e.g. "fs read").
+COMMANDS = Counter('paranoid_keybase_commands_total', 'Keybase commands run.', ['command'])
+COMMAND_FAILURES = Counter('paranoid_keybase_command_failures_total', 'Keybase commands that failed.', ['command'])
+COMMAND_DURATION = Histogram('paranoid_keybase_command_duration_seconds',
+                             'Time taken by Keybase commands, including time spent queued.', ['command'])
+
+# Seconds to wait for a reply from a Keybase session, before giving up on the session as stuck.
+SESSION_TIMEOUT = 60
+
+# Commands which are safe to run again if a Keybase session may have run them already.
+READ_ONLY_COMMANDS = ('id', 'fs read', 'fs ls', 'fs stat', 'decrypt')
 
 
 class KeybaseException(Exception):
@@ -28,9 +61,512 @@ class KeybaseFileNotFoundException(KeybaseException):
         super().__init__('file does not exist: {}'.format(path))
 
 
+class KeybaseSessionException(KeybaseException):
+    "Raised when a Keybase session fails. If sent is True, the session may have run the command already."
+    def __init__(self, message, sent=False):
+        super().__init__(message)
+        self.sent = sent
+
+
+class KeybaseBusyException(KeybaseException):
+    def __init__(self):
+        super().__init__('Too many Keybase commands are queued, please try again later.')
+
+
+class KeybaseExecutor:
+    """
+    Shared gate for all Keybase commands, which caps the number of commands running at once.
+
+    Waiting commands are admitted in priority order, then in order of arrival. Commands run with the
+    priority of the calling thread, which is interactive unless set otherwise using `priority()`.
+    Once `max_queue` commands are waiting, any further commands are rejected with KeybaseBusyException.
+    Prefetch commands always wait, and do not count towards the queue depth.
+    """
+    def __init__(self, max_workers=8, max_queue=64):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.running = 0
+        self.waiting = []
+        self.queued = 0
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.local = threading.local()
+
+    def get_priority(self):
+        "Returns the priority of commands run from the current thread."
+        return getattr(self.local, 'priority', PRIORITY_INTERACTIVE)
+
+    @contextmanager
+    def priority(self, priority):
+        "Runs all commands issued from the current thread within the block with the given priority."
+        previous = self.get_priority()
+        self.local.priority = priority
+        try:
+            yield
+        finally:
+            self.local.priority = previous
+
+    def run(self, fn, *args):
+        "Waits for a free slot, then runs the function in the current thread."
+        priority = self.get_priority()
+
+        with self.cond:
+            counted = priority != PRIORITY_PREFETCH
+            if counted and self.queued >= self.max_queue:
+                raise KeybaseBusyException()
+
+            ticket = (priority, next(self.counter))
+            heapq.heappush(self.waiting, ticket)
+            if counted:
+                self.queued += 1
+            while self.running >= self.max_workers or self.waiting[0] != ticket:
+                self.cond.wait()
+
+            heapq.heappop(self.waiting)
+            if counted:
+                self.queued -= 1
+            self.running += 1
+
+            # Let the next waiter check for a free slot
+            self.cond.notify_all()
+
+        try:
+            return fn(*args)
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.cond.notify_all()
+
+
+class PriorityPool:
+    """
+    Fixed pool of threads for fan-outs of Keybase commands (see `decrypt_many`), which takes work in
+    priority order, then in order of arrival. Otherwise, a batch of interactive work would wait behind
+    all prefetch work that was queued before it, since KeybaseExecutor only orders work that is running.
+    """
+    def __init__(self, max_workers=8, thread_name_prefix='keybase-pool'):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self.queue = []
+        self.counter = itertools.count()
+        self.threads = []
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def submit(self, priority, fn, *args):
+        "Queues a call to fn(*args) with the given priority, and returns a Future for its result."
+        future = Future()
+        with self.cond:
+            if self.closed:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            heapq.heappush(self.queue, (priority, next(self.counter), future, fn, args))
+            if len(self.threads) < self.max_workers:
+                thread = threading.Thread(target=self._work, daemon=True,
+                                          name='{}_{}'.format(self.thread_name_prefix, len(self.threads)))
+                self.threads.append(thread)
+                thread.start()
+            self.cond.notify()
+        return future
+
+    def map(self, fn, items, priority=PRIORITY_INTERACTIVE):
+        "Calls fn for each item with the given priority, and returns the results in order."
+        futures = [self.submit(priority, fn, item) for item in items]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        "Stops the pool once all queued work is done."
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                _, _, future, fn, args = heapq.heappop(self.queue)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+class KeybaseSession:
+    """
+    Long-lived Keybase API process, which accepts one JSON request per line on stdin and
+    writes one JSON reply per line on stdout:
+
+        -> {"id": 1, "args": ["fs", "read", "/keybase/..."], "input": null}
+        <- {"id": 1, "returncode": 0, "stdout": "...", "stderr": ""}
+
+    Replies may arrive in any order, and are matched up to their requests by ID, so that
+    multiple threads can share the same process. A session which does not reply within `timeout`
+    seconds is considered stuck, and is killed so that the next call starts a new one.
+    """
+    def __init__(self, cmd, timeout=SESSION_TIMEOUT):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.process = None
+        self.pending = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        "Spawns the session process if it is not already running."
+        with self.lock:
+            if self.is_alive():
+                return
+
+            try:
+                self.process = subprocess.Popen(
+                    self.cmd,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    stdin=subprocess.PIPE,
+                    text=True,
+                    bufsize=1,
+                )
+            except FileNotFoundError:
+                self.process = None
+                raise KeybaseSessionException('Could not start Keybase session: {}'.format(self.cmd))
+
+            reader = threading.Thread(target=self._read_replies, args=(self.process, ), daemon=True)
+            reader.start()
+
+    def close(self):
+        "Terminates the session process."
+        with self.lock:
+            process, self.process = self.process, None
+        if process is not None:
+            process.stdin.close()
+            process.wait()
+
+    def call(self, args, inp=None):
+        "Sends a request to the session, and blocks until the reply arrives. Returns (returncode, stdout, stderr)."
+        self.start()
+
+        reply = {'event': threading.Event()}
+        with self.lock:
+            self.next_id += 1
+            request_id = self.next_id
+            self.pending[request_id] = reply
+            process = self.process
+            try:
+                process.stdin.write(json.dumps({'id': request_id, 'args': args, 'input': inp}) + '\n')
+                process.stdin.flush()
+            except (OSError, ValueError, AttributeError):
+                del self.pending[request_id]
+                raise KeybaseSessionException('Keybase session is not running')
+
+        if not reply['event'].wait(self.timeout):
+            with self.lock:
+                timed_out = self.pending.pop(request_id, None) is not None
+            if timed_out:
+                # Kill the stuck session, which fails all other requests waiting on it
+                process.kill()
+                raise KeybaseSessionException('Keybase session did not reply within {}s'.format(self.timeout),
+                                              sent=True)
+
+        if 'error' in reply:
+            raise KeybaseSessionException(reply['error'], sent=True)
+
+        return reply['returncode'], reply['stdout'], reply['stderr']
+
+    def _read_replies(self, process):
+        "Dispatches replies from the session process to their waiting callers until it exits."
+        for line in process.stdout:
+            try:
+                res = json.loads(line)
+            except ValueError:
+                continue
+
+            with self.lock:
+                reply = self.pending.pop(res.get('id'), None)
+            if reply is None:
+                continue
+
+            reply['returncode'] = res.get('returncode', 1)
+            reply['stdout'] = res.get('stdout') or ''
+            reply['stderr'] = res.get('stderr') or ''
+            reply['event'].set()
+
+        # Fail all requests that are still waiting on the dead process
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if self.process is process:
+                self.process = None
+        for reply in pending.values():
+            reply['error'] = 'Keybase session exited with return code {}'.format(process.wait())
+            reply['event'].set()
+
+
+class AsyncKeybaseEngine:
+    """
+    Runs Keybase commands as asyncio subprocesses on an event loop in a background thread, so that
+    commands in flight do not each tie up a thread.
+
+    Commands are admitted in the same way as by KeybaseExecutor (in priority order, up to `max_workers`
+    at once, rejecting commands once `max_queue` are waiting). Calls from other threads block until the
+    command is done, while fan-outs (see `map`) run all of their commands from the event loop, bounded
+    by a semaphore. Commands through a Keybase session are sent from the default thread pool instead.
+    """
+    def __init__(self, client, max_workers=8, max_queue=64, concurrency=8):
+        self.client = client
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.concurrency = concurrency
+        self.running = 0
+        self.waiting = []
+        self.queued = 0
+        self.counter = itertools.count()
+        self.cond = None
+
+        # Priority of the commands issued by the current task
+        self.priority = contextvars.ContextVar('priority', default=PRIORITY_INTERACTIVE)
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='keybase-asyncio', daemon=True)
+
+    def start(self):
+        # Before Python 3.12, the default child watcher waits for each subprocess in a thread of its own,
+        # so watch subprocesses with pidfds from the event loop instead where possible
+        if sys.version_info < (3, 12) and hasattr(asyncio, 'PidfdChildWatcher') and hasattr(os, 'pidfd_open'):
+            watcher = asyncio.PidfdChildWatcher()
+            watcher.attach_loop(self.loop)
+            asyncio.set_child_watcher(watcher)
+
+        self.thread.start()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def run(self, coro, priority=PRIORITY_INTERACTIVE):
+        "Runs a coroutine on the event loop with the given command priority, and blocks until it is done."
+
+        async def run():
+            self.priority.set(priority)
+            return await coro
+
+        return asyncio.run_coroutine_threadsafe(run(), self.loop).result()
+
+    def map(self, fn, items, priority=PRIORITY_INTERACTIVE):
+        "Runs a coroutine function for each item concurrently, up to `concurrency` at once, and returns the results in order."
+
+        async def gather():
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def bounded(item):
+                async with semaphore:
+                    return await fn(item)
+
+            return await asyncio.gather(*[bounded(item) for item in items])
+
+        return self.run(gather(), priority)
+
+    async def exec_cmd(self, args, inp=None):
+        "Runs a Keybase command once it is admitted, and returns its output."
+        command = get_command(args)
+        COMMANDS.inc(command)
+        started_at = time.monotonic()
+        try:
+            await self._acquire(self.priority.get())
+            try:
+                if self.client.session is not None:
+                    return await self.loop.run_in_executor(None, self.client._exec_cmd, args, inp)
+                return await self._spawn(args, inp)
+            finally:
+                async with self.cond:
+                    self.running -= 1
+                    self.cond.notify_all()
+        except Exception:
+            COMMAND_FAILURES.inc(command)
+            raise
+        finally:
+            COMMAND_DURATION.observe(time.monotonic() - started_at, command)
+
+    async def _acquire(self, priority):
+        "Waits for a free slot, as in KeybaseExecutor.run. Must be followed by releasing the slot."
+        if self.cond is None:
+            self.cond = asyncio.Condition()
+
+        counted = priority != PRIORITY_PREFETCH
+        if counted and self.queued >= self.max_queue:
+            raise KeybaseBusyException()
+
+        ticket = (priority, next(self.counter))
+        heapq.heappush(self.waiting, ticket)
+        if counted:
+            self.queued += 1
+
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.running < self.max_workers and self.waiting[0] == ticket)
+
+            heapq.heappop(self.waiting)
+            if counted:
+                self.queued -= 1
+            self.running += 1
+
+            # Let the next waiter check for a free slot
+            self.cond.notify_all()
+
+    async def _spawn(self, args, inp=None):
+        try:
+            p = await asyncio.create_subprocess_exec(
+                *(self.client.executable + args),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                stdin=subprocess.PIPE,
+            )
+        except FileNotFoundError:
+            raise KeybaseNotFoundException()
+
+        # Always close stdin, as subprocess does
+        stdout, stderr = await p.communicate(inp.encode(locale.getpreferredencoding(False)) if inp is not None else b'')
+        stdout, stderr = decode_output(stdout), decode_output(stderr)
+        if p.returncode:
+            raise KeybaseCliException(args, p.returncode, stdout, stderr)
+
+        return stdout
+
+
+class MetadataCache:
+    """
+    Remembers whether KBFS paths exist, so that existence checks do not need a Keybase call.
+
+    Entries are either positive (the path exists) or negative (it does not), and expire after `ttl`
+    seconds to pick up changes made outside of this daemon. Listing a directory marks all of its
+    children as present, and every other name in that directory as absent.
+    A TTL of 0 disables the cache.
+    """
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.entries = {}
+        self.listings = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        "Returns True or False if the path is known to exist or not, otherwise None."
+        path = os.path.normpath(path)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+
+            # Fall back to the listing of the parent directory
+            dirname, filename = os.path.split(path)
+            listing = self.listings.get(dirname)
+            if listing is not None and listing[1] > now:
+                return filename in listing[0]
+
+        # Nothing below a path that does not exist can exist either
+        if dirname != path and self.get(dirname) is False:
+            return False
+
+        return None
+
+    def get_listing(self, path):
+        "Returns the list of filenames in a directory if known, otherwise None."
+        path = os.path.normpath(path)
+        with self.lock:
+            listing = self.listings.get(path)
+            if listing is not None and listing[1] > time.monotonic():
+                return sorted(listing[0])
+
+        return None
+
+    def set(self, path, exists):
+        "Records whether a path exists."
+        if not self.ttl:
+            return
+
+        path = os.path.normpath(path)
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            self.entries[path] = (exists, expires)
+
+            # Keep the listing of the parent directory up to date
+            dirname, filename = os.path.split(path)
+            listing = self.listings.get(dirname)
+            if listing is not None:
+                if exists:
+                    listing[0].add(filename)
+                else:
+                    listing[0].discard(filename)
+
+            # Nothing below a path that does not exist can exist either
+            if not exists:
+                self.listings.pop(path, None)
+
+    def set_listing(self, path, filenames):
+        "Records the full list of filenames in a directory."
+        if not self.ttl:
+            return
+
+        path = os.path.normpath(path)
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            self.entries[path] = (True, expires)
+            self.listings[path] = (set(filenames), expires)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.listings.clear()
+
+
 class KeybaseClient:
-    def init(self, base_path='paranoid'):
+    def init(self,
+             base_path='paranoid',
+             executable=None,
+             session_cmd=None,
+             storage=None,
+             decrypt_workers=8,
+             max_workers=8,
+             max_queue=64,
+             metadata_ttl=30,
+             engine='threads'):
         self.base_path = base_path
+        self.executable = executable or ['keybase']
+
+        # Remembers which paths exist, filled in by our own reads, writes and listings
+        self.metadata = MetadataCache(ttl=metadata_ttl)
+
+        # Caps the number of Keybase commands running at once across all threads
+        self.executor = KeybaseExecutor(max_workers=max_workers, max_queue=max_queue)
+
+        # Bounds the number of concurrent commands issued by decrypt_many, get_many and list_many, taking
+        # batches of interactive requests ahead of prefetching
+        self.decrypt_pool = PriorityPool(max_workers=decrypt_workers, thread_name_prefix='keybase-decrypt')
+
+        # Runs all commands as asyncio subprocesses if set, otherwise as blocking subprocesses in the calling thread
+        self.engine = None
+        if engine == 'asyncio':
+            self.engine = AsyncKeybaseEngine(self, max_workers=max_workers, max_queue=max_queue,
+                                             concurrency=decrypt_workers)
+            self.engine.start()
+
+        # Plain file operations go through the storage backend, which defaults to the Keybase CLI
+        if storage is None:
+            from storage import CliStorage
+            storage = CliStorage(self)
+        self.storage = storage
+
+        # Keep a long-lived session process open if configured, otherwise spawn a process per call
+        self.session = None
+        if session_cmd:
+            self.session = KeybaseSession(session_cmd)
 
     @lru_cache()
     def get_username(self):
@@ -45,14 +581,14 @@ class KeybaseClient:
 
     def get_private(self, path):
         if platform.system() == 'Windows':
-            return 'K:' + os.path.join('\private', self.get_username(), self.base_path, path)
+            return 'K:' + os.path.join('\\private', self.get_username(), self.base_path, path)
         return os.path.join('/keybase/private', self.get_username(), self.base_path, path)
 
     def get_public(self, path, username=None):
         if username is None:
             username = self.get_username()
         if platform.system() == 'Windows':
-            return 'K:' + os.path.join('\public', username, self.base_path, path)
+            return 'K:' + os.path.join('\\public', username, self.base_path, path)
         return os.path.join('/keybase/public', username, self.base_path, path)
 
     def ensure_dir(self, path):
@@ -73,6 +609,10 @@ class KeybaseClient:
 
     def exists(self, path):
         "Returns True if the specified path exists."
+        exists = self.metadata.get(path)
+        if exists is not None:
+            return exists
+
         try:
             self.stat(path)
             return True
@@ -80,59 +620,82 @@ class KeybaseClient:
             return False
 
     def get_file(self, path):
-        "Uses the Keybase command-line API to fetch a file."
+        "Fetches a file."
         try:
-            return self._run_cmd(['fs', 'read', path])
-        except KeybaseCliException as e:
-            if 'file does not exist' in e.stderr:
-                raise KeybaseFileNotFoundException(path)
-            raise e
+            data = self.storage.get_file(path)
+        except KeybaseFileNotFoundException:
+            self.metadata.set(path, False)
+            raise
+
+        self.metadata.set(path, True)
+        return data
 
     def get_json(self, path):
-        "Uses the Keybase command-line API to fetch and parse a JSON file."
+        "Fetches and parses a JSON file."
         return json.loads(self.get_file(path))
 
     def put_file(self, path, data):
-        "Uses the Keybase command-line API to write to a file."
-        self._run_cmd(['fs', 'write', path], data)
+        "Writes to a file."
+        self.storage.put_file(path, data)
+        self.metadata.set(path, True)
 
     def mkdir(self, path):
         "Creates a new directory."
-        self._run_cmd(['fs', 'mkdir', path])
+        self.storage.mkdir(path)
+
+        # A directory that was just created is known to be empty
+        self.metadata.set(path, True)
+        self.metadata.set_listing(path, [])
 
     def stat(self, path):
         "Stats a dirent."
         try:
-            self._run_cmd(['fs', 'stat', path])
-        except KeybaseCliException as e:
-            if 'file does not exist' in e.stderr:  # file not found
-                raise KeybaseFileNotFoundException(path)
-            if "doesn't exist" in e.stderr:  # dir not found
-                raise KeybaseFileNotFoundException(path)
-            if 'The system cannot find the file specified.' in e.stderr:  #windows file not found
+            res = self.storage.stat(path)
+        except KeybaseFileNotFoundException:
+            self.metadata.set(path, False)
+            raise
+
+        self.metadata.set(path, True)
+        return res
+
+    def get_mtime(self, path):
+        "Returns the modification time of a dirent, or None if the storage backend does not report them."
+        return self.storage.get_mtime(path)
+
+    def list_dir(self, path, filter=None, cached=False):
+        "Lists a directory's contents. If cached is True, a recent listing may be returned instead."
+        fnames = self.metadata.get_listing(path) if cached else None
+        if fnames is None:
+            if cached and self.metadata.get(path) is False:
                 raise KeybaseFileNotFoundException(path)
-            raise e
 
-    def list_dir(self, path, filter=None):
-        "Uses the Keybase command-line API to list a directory's contents."
-        if platform.system() == 'Windows':
-            path = '\keybase' + path[2:]
+            try:
+                fnames = self.storage.list_dir(path)
+            except KeybaseFileNotFoundException:
+                self.metadata.set(path, False)
+                raise
+
+            self.metadata.set_listing(path, fnames)
+
+        if filter is not None:
+            fnames = fnmatch.filter(fnames, filter)
+        return fnames
+
+    def list_dir_mtimes(self, path):
+        "Lists a directory's contents with modification times, as a dict of filenames to mtimes (or None if unknown)."
         try:
-            res = self._run_cmd(['fs', 'ls', path, '-1', '--nocolor']).strip()
-            if not res:
-                return []
-            fnames = res.split('\n')
-            if filter is not None:
-                fnames = fnmatch.filter(fnames, filter)
-            return fnames
-        except KeybaseCliException as e:
-            if 'file does not exist' in e.stderr:
-                raise KeybaseFileNotFoundException(path)
-            raise e
+            mtimes = self.storage.list_dir_mtimes(path)
+        except KeybaseFileNotFoundException:
+            self.metadata.set(path, False)
+            raise
+
+        self.metadata.set_listing(path, mtimes)
+        return mtimes
 
     def encrypt(self, path, data, users):
         "Encrypts data with per-user keys (PUKs) for the given list of users and writes it to the path."
         self._run_cmd(['encrypt', '-o', path] + users, data)
+        self.metadata.set(path, True)
 
     def decrypt(self, path):
         "Attempts to decrypt data at a path."
@@ -141,14 +704,144 @@ class KeybaseClient:
         except KeybaseCliException:
             return None
 
+    def decrypt_many(self, paths):
+        """
+        Decrypts multiple files concurrently, bounded by the number of decrypt workers.
+        Returns a list of (data, error) tuples in the same order as the paths, where error is the
+        KeybaseException raised for that path, if any. KeybaseBusyException is raised instead, so that
+        the request can be rejected as a whole.
+        """
+        # Decrypt with the priority of the calling thread
+        priority = self.executor.get_priority()
+
+        if self.engine is not None:
+
+            async def decrypt_async(path):
+                try:
+                    return await self.engine.exec_cmd(['decrypt', '-i', path]), None
+                except KeybaseBusyException:
+                    raise
+                except KeybaseException as e:
+                    return None, e
+
+            return self.engine.map(decrypt_async, paths, priority)
+
+        def decrypt(path):
+            try:
+                with self.executor.priority(priority):
+                    return self._run_cmd(['decrypt', '-i', path]), None
+            except KeybaseBusyException:
+                raise
+            except KeybaseException as e:
+                return None, e
+
+        return self.decrypt_pool.map(decrypt, paths, priority)
+
+    def get_many(self, paths):
+        """
+        Fetches multiple files concurrently, bounded by the number of decrypt workers.
+        Returns a list of (data, error) tuples in the same order as the paths.
+        """
+        priority = self.executor.get_priority()
+
+        if self.engine is not None and hasattr(self.storage, 'get_file_async'):
+
+            async def get_async(path):
+                try:
+                    data = await self.storage.get_file_async(path)
+                except KeybaseFileNotFoundException as e:
+                    self.metadata.set(path, False)
+                    return None, e
+                except KeybaseBusyException:
+                    raise
+                except KeybaseException as e:
+                    return None, e
+
+                self.metadata.set(path, True)
+                return data, None
+
+            return self.engine.map(get_async, paths, priority)
+
+        def get(path):
+            try:
+                with self.executor.priority(priority):
+                    return self.get_file(path), None
+            except KeybaseBusyException:
+                raise
+            except KeybaseException as e:
+                return None, e
+
+        return self.decrypt_pool.map(get, paths, priority)
+
+    def list_many(self, paths):
+        """
+        Lists multiple directories concurrently, from recent listings if possible.
+        Returns a list of (filenames, error) tuples in the same order as the paths, where directories
+        that do not exist are listed as empty.
+        """
+        priority = self.executor.get_priority()
+
+        def list_dir(path):
+            try:
+                with self.executor.priority(priority):
+                    return self.list_dir(path, cached=True), None
+            except KeybaseFileNotFoundException:
+                return [], None
+            except KeybaseBusyException:
+                raise
+            except KeybaseException as e:
+                return None, e
+
+        return self.decrypt_pool.map(list_dir, paths, priority)
+
     def send_chat(self, user, message):
         "Sends a markdown-enabled private chat message to a user."
         return self._run_cmd(['chat', 'send', '--private', '{},{}'.format(user, self.get_username()), message])
 
+    def priority(self, priority):
+        "Runs all Keybase commands issued from the current thread within the block with the given priority."
+        return self.executor.priority(priority)
+
+    def close(self):
+        "Closes the Keybase session, if any."
+        self.decrypt_pool.shutdown(wait=False)
+        if self.engine is not None:
+            self.engine.close()
+        if self.session is not None:
+            self.session.close()
+
     def _run_cmd(self, args, inp=None):
+        if self.engine is not None:
+            return self.engine.run(self.engine.exec_cmd(args, inp), self.executor.get_priority())
+
+        command = get_command(args)
+        COMMANDS.inc(command)
+        started_at = time.monotonic()
+        try:
+            return self.executor.run(self._exec_cmd, args, inp)
+        except Exception:
+            COMMAND_FAILURES.inc(command)
+            raise
+        finally:
+            COMMAND_DURATION.observe(time.monotonic() - started_at, command)
+
+    def _exec_cmd(self, args, inp=None):
+        # Prefer the long-lived session, falling back to spawning a new process if the session fails. Commands
+        # which the session may have run already are only run again if that is harmless.
+        if self.session is not None:
+            try:
+                returncode, stdout, stderr = self.session.call(args, inp)
+            except KeybaseSessionException as e:
+                if e.sent and get_command(args) not in READ_ONLY_COMMANDS:
+                    raise
+            else:
+                if returncode:
+                    raise KeybaseCliException(args, returncode, stdout, stderr)
+                return stdout
+
         try:
             p = subprocess.Popen(
-                ['keybase'] + args,
+                self.executable + args,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
                 stdin=subprocess.PIPE,
@@ -162,3 +855,13 @@ class KeybaseClient:
             raise KeybaseCliException(args, p.returncode, stdout, stderr)
 
         return stdout
+
+
+def get_command(args):
+    "Returns the subcommand of a Keybase command line (e.g. \"fs read\"), as used in metrics."
+    return ' '.join(args[:2]) if args[0] in ('fs', 'chat') else args[0]
+
+
+def decode_output(data):
+    "Decodes the output of a command in the same way as subprocess does in text mode."
+    return io.TextIOWrapper(io.BytesIO(data)).read()
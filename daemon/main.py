@@ -13,26 +13,42 @@ in localStorage, it can only depend on the daemon to provide secure storage
 of mappings.
 """
 
+import atexit
+import functools
+import hashlib
 import json
 import os
+import shlex
 import sys
-from threading import Thread
+import time
+import uuid
+from threading import Lock, Thread
 
 import click
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
 
 import auth
-from cache import ParanoidCache
-from keybase import KeybaseClient
-from paranoid import ParanoidException, ParanoidManager
+import server
+from cache import DEFAULT_MAX_DATA_BYTES, ParanoidCache
+from events import EventStream, EventStreamFullException
+from journal import WriteJournal
+from keybase import ENGINES, KeybaseBusyException, KeybaseClient
+from metrics import Counter, Gauge, Histogram, registry
+from outbox import ChatOutbox
+from paranoid import MANIFEST_FILENAME, ParanoidException, ParanoidManager
+from prefetch import AccessLog, Prefetcher
+from profiling import StartupProfile
+from revalidate import DEFAULT_TTLS, Revalidator
+from snapshot import CacheSnapshot
+from storage import create_storage
 from utils import JsonResponse
 
 # Create new Flask app
 app = Flask('paranoid-daemon')
 
-# Enable Cross-Origin Resource Sharing (CORS)
-CORS(app)
+# Enable Cross-Origin Resource Sharing (CORS), allowing the extension to read ETags
+CORS(app, expose_headers=['ETag'])
 
 # Create Keybase client
 keybase = KeybaseClient()
@@ -43,6 +59,175 @@ cache = ParanoidCache()
 # Create Paranoid manager
 paranoid = ParanoidManager(keybase, cache)
 
+# Create access log and prefetcher
+access_log = AccessLog()
+prefetcher = Prefetcher(paranoid, access_log)
+
+# Create cache revalidator
+revalidator = Revalidator(paranoid)
+
+# Request metrics, by route
+REQUESTS = Counter('paranoid_http_requests_total', 'HTTP requests served.', ['method', 'route', 'status'])
+REQUEST_DURATION = Histogram('paranoid_http_request_duration_seconds', 'Time taken to serve HTTP requests.',
+                             ['method', 'route'])
+
+# Cache metrics, by section
+Gauge('paranoid_cache_entries', 'Number of entries in the cache.',
+      lambda: {(section, ): entries for section, (entries, _) in cache.stats().items()}, ['section'])
+Gauge('paranoid_cache_bytes', 'Approximate size of entries in the cache, in bytes.',
+      lambda: {(section, ): size for section, (_, size) in cache.stats().items()}, ['section'])
+
+# Prefetch metrics
+Gauge('paranoid_prefetch_running', 'Whether the cache is being prefetched.',
+      lambda: int(prefetcher.status()['state'] == 'running'))
+Gauge('paranoid_prefetch_items', 'Number of prefetch work items, by state.',
+      lambda: {(state, ): prefetcher.status()[state] for state in ('total', 'done', 'failed')}, ['state'])
+Gauge('paranoid_prefetch_elapsed_seconds', 'Time taken by the current or last prefetch.',
+      lambda: prefetcher.status()['elapsed'])
+
+# Chat outbox, which is created on startup unless chat is disabled
+outbox = None
+
+# Chat outbox metrics
+Gauge('paranoid_outbox_messages', 'Number of chat messages waiting to be sent.',
+      lambda: outbox.status()['messages'] if outbox is not None else 0)
+Gauge('paranoid_outbox_requests', 'Number of share requests waiting to be sent.',
+      lambda: outbox.status()['requests'] if outbox is not None else 0)
+
+# Identifies this run of the daemon in ETags and event IDs, since versions of cache entries start over on every run
+BOOT_ID = uuid.uuid4().hex[:8]
+
+# Create stream of changes to Paranoid data
+events = EventStream(BOOT_ID)
+Gauge('paranoid_event_clients', 'Number of clients connected to the event stream.', lambda: events.clients)
+
+# Tracks the time taken by each phase of startup, and from startup to the first response that was served
+profile = StartupProfile()
+startup = {
+    'first_response': False,
+    'listening_at': None,
+    'ready_at': None,
+    'default_files': 'pending',
+    'default_files_error': None,
+    'cache_enabled': True,
+    'snapshot_loaded': False,
+}
+
+# Serializes initialization of default files, which happens in the background or on the first write
+default_files_lock = Lock()
+
+
+@app.before_request
+def start_timer():
+    g.request_started_at = time.monotonic()
+
+
+@app.after_request
+def log_first_response(response):
+    "Logs how long after startup the first response for Paranoid data was served."
+    if not startup['first_response'] and request.view_args and response.status_code < 400:
+        startup['first_response'] = True
+        now = time.monotonic()
+        click.secho(' * First response served {:.3f}s after startup (took {:.3f}s).'.format(
+            profile.elapsed(now), now - g.request_started_at))
+    return response
+
+
+def require_default_files():
+    """
+    Makes sure that default files exist before the first write, in case it comes before they are initialized in
+    the background. Registered in main() after the token check, so that unauthenticated requests never get here.
+    """
+    if request.method in ('POST', 'PUT', 'DELETE'):
+        ensure_default_files()
+
+
+@app.after_request
+def record_metrics(response):
+    "Records the number of requests and their latency for each route."
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    REQUESTS.inc(request.method, route, str(response.status_code))
+    if 'request_started_at' in g:
+        REQUEST_DURATION.observe(time.monotonic() - g.request_started_at, request.method, route)
+    return response
+
+
+@app.after_request
+def record_access(response):
+    "Records successful accesses to each origin, so that the most visited origins are prefetched first."
+    origin = (request.view_args or {}).get('origin')
+    if origin and response.status_code < 400:
+        access_log.record(origin)
+    return response
+
+
+def get_etag(entries):
+    "Returns an ETag from the versions of a list of (section, key) cache entries, or None if any of them is not cached."
+    if entries is None:
+        return None
+
+    versions = []
+    for section, key in entries:
+        version, cache_hit = paranoid.get_version(section, key)
+        if not cache_hit:
+            return None
+        versions.append(version)
+
+    return '{}-{}'.format(BOOT_ID, hashlib.sha256(json.dumps(versions).encode('utf-8')).hexdigest()[:16])
+
+
+def versioned(get_entries):
+    """
+    Decorator for GET routes whose responses are built from cache entries, which are given by a function of
+    the route arguments (or None if not all of them are cached).
+
+    Responses are tagged with an ETag from the versions of those entries, and requests with a matching
+    If-None-Match header are answered with 304 Not Modified, without reading anything from KBFS.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(**kwargs):
+            entries = get_entries(**kwargs)
+            etag = get_etag(entries)
+            if etag is not None and request.if_none_match.contains_weak(etag):
+                for section, key in entries:
+                    paranoid.check_freshness(section, key)
+                response = Response(status=304)
+            else:
+                response = fn(**kwargs)
+
+                # Only tag the response if none of its entries changed while it was being built
+                if etag is None or get_etag(get_entries(**kwargs)) != etag:
+                    return response
+
+            # Responses hold secrets, so leave caching to the extension instead of the browser
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def get_identity_entries(origin, uid):
+    "Returns the cache entries behind GET /services/<origin>/identities/<uid>."
+    identity, cache_hit = cache.peek('service_data', (origin, uid))
+    if identity is None:
+        return None
+
+    return [('service_data', (origin, uid))] + [('decrypted_data_file', (origin, uid, field_name, None))
+                                                for field_name in identity.get('fields', {})]
+
+
+def get_foreign_map_entries(origin):
+    "Returns the cache entries behind GET /services/<origin>/foreign_map."
+    index, cache_hit = cache.get_foreign_map_index(origin)
+    if not cache_hit:
+        return None
+
+    return [('foreign_map', origin)] + [('decrypted_data_file', (origin, ) + triple) for triple in index]
+
 
 @app.route('/')
 def get_index():
@@ -56,7 +241,85 @@ def get_auth():
     return JsonResponse()
 
 
+@app.route('/ready')
+def get_ready():
+    """
+    Reports whether the daemon is warm, i.e. its default files exist and the cache has been populated,
+    unlike / which only reports that the daemon is listening. Returns 503 until the daemon is warm.
+    """
+    status = get_startup_status()
+    return JsonResponse(status), 200 if status['ready'] else 503
+
+
+def get_startup_status():
+    "Returns the readiness of the daemon, together with the time taken by each phase of startup."
+    prefetch_state = prefetcher.status()['state']
+    if not startup['cache_enabled']:
+        cache_state = 'disabled'
+    elif prefetch_state == 'done':
+        cache_state = 'warm'
+    elif startup['snapshot_loaded']:
+        cache_state = 'snapshot'
+    elif prefetch_state == 'running':
+        cache_state = 'prefetching'
+    else:
+        cache_state = 'cold'
+
+    listening_at, ready_at = startup['listening_at'], startup['ready_at']
+    return {
+        'ready': startup['default_files'] == 'done' and cache_state in ('disabled', 'snapshot', 'warm'),
+        'default_files': startup['default_files'],
+        'default_files_error': startup['default_files_error'],
+        'cache': cache_state,
+        'cache_entries': {section: entries for section, (entries, _) in cache.stats().items()},
+        'listening_after': profile.elapsed(listening_at) if listening_at is not None else None,
+        'warm_after': profile.elapsed(ready_at) if ready_at is not None else None,
+        'phases': profile.status(),
+    }
+
+
+@app.route('/status/prefetch')
+def get_prefetch_status():
+    "Returns the progress of the cache prefetch."
+    return JsonResponse(prefetcher.status())
+
+
+@app.route('/status/outbox')
+def get_outbox_status():
+    "Returns the number of share requests waiting to be sent via Keybase chat."
+    return JsonResponse(outbox.status() if outbox is not None else None)
+
+
+@app.route('/metrics')
+def get_metrics():
+    "Returns metrics in the Prometheus text format."
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/events')
+def get_events():
+    """
+    Streams changes to Paranoid data as Server-Sent Events, so that clients only refetch what changed.
+    Clients which reconnect with a Last-Event-ID header are sent the events they missed.
+    Returns 503 if the maximum number of clients are already connected.
+    """
+    try:
+        messages = events.listen(request.headers.get('Last-Event-ID'))
+    except EventStreamFullException as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 503, {'Retry-After': '5'}
+
+    return Response(messages, mimetype='text/event-stream', headers={'Cache-Control': 'no-store'})
+
+
+@app.route('/flush', methods=['POST'])
+def flush():
+    "Blocks until all metadata writes in the write-behind journal have been written to KBFS."
+    paranoid.flush()
+    return JsonResponse()
+
+
 @app.route('/services', methods=['GET'])
+@versioned(lambda: [('origin_list', None)])
 def get_services():
     "Fetches a list of services."
 
@@ -65,6 +328,7 @@ def get_services():
 
 
 @app.route('/services/<origin>', methods=['GET'])
+@versioned(lambda origin: [('service_info', origin), ('uid_list', origin)])
 def get_service(origin):
     "Fetches a service by origin, as well as a list of UIDs (corresponding to unique identities)."
 
@@ -80,12 +344,60 @@ def get_service(origin):
     })
 
 
+@app.route('/services/<origin>/bundle', methods=['GET'])
+@versioned(lambda origin: [('bundle', origin)])
+def get_service_bundle(origin):
+    """
+    Fetches the values of all fields of both our own and foreign identities for a service, as a map of
+    uid -> field name -> value, so that a page can be rendered with a single request.
+    """
+
+    bundle, errors = paranoid.get_bundle(origin)
+    return JsonResponse(bundle, errors=errors)
+
+
 @app.route('/services/<origin>/foreign_map', methods=['GET'])
+@versioned(get_foreign_map_entries)
 def get_service_foreign_map(origin):
     "Fetches a foreign map for a service."
 
-    foreign_map = paranoid.resolve_foreign_map(origin)
-    return JsonResponse(foreign_map)
+    foreign_map, errors = paranoid.resolve_foreign_map(origin)
+    return JsonResponse(foreign_map, errors=errors)
+
+
+@app.route('/services/<origin>/foreign_map', methods=['POST'])
+def add_foreign_maps(origin):
+    """
+    Adds multiple foreign map mappings for an origin at once.
+    Expects a JSON list of mappings, e.g. [{"uid": "1", "field_name": "first_name", "username": "alice"}].
+    """
+
+    paranoid.update_foreign_map(origin, add=get_foreign_mappings())
+    return JsonResponse()
+
+
+@app.route('/services/<origin>/foreign_map', methods=['DELETE'])
+def remove_foreign_maps(origin):
+    "Deletes multiple foreign map mappings for an origin at once, given a JSON list of mappings."
+
+    paranoid.update_foreign_map(origin, remove=get_foreign_mappings())
+    return JsonResponse()
+
+
+def get_foreign_mappings():
+    "Returns the list of (uid, field_name, username) mappings in the request body."
+    data = request.get_json()
+    if not isinstance(data, list):
+        raise ParanoidException('Expected a list of mappings')
+
+    mappings = []
+    for mapping in data:
+        triple = (mapping.get('uid'), mapping.get('field_name'), mapping.get('username')) if isinstance(mapping, dict) else ()
+        if len(triple) != 3 or not all(isinstance(value, str) and value for value in triple):
+            raise ParanoidException('Invalid mapping: {}'.format(json.dumps(mapping)))
+        mappings.append(triple)
+
+    return mappings
 
 
 @app.route('/services/<origin>/foreign_map/<uid>/<field_name>/<username>', methods=['POST'])
@@ -115,6 +427,7 @@ def put_service(origin):
 
 
 @app.route('/services/<origin>/identities/<uid>', methods=['GET'])
+@versioned(get_identity_entries)
 def get_service_identity(origin, uid):
     "Fetches a list of fields and their values for a service identity."
 
@@ -123,10 +436,12 @@ def get_service_identity(origin, uid):
     if info is None:
         return JsonResponse()
 
-    # Read individual service identity field mappings
-    info['map'] = {}
-    for field in info.get('fields'):
-        data = paranoid.decrypt_data_file(origin, uid, field)
+    # Read all service identity field mappings at once.
+    # Copy the identity first so that the decrypted values do not end up in the cached metadata.
+    info = dict(info, map={})
+    fields = list(info.get('fields'))
+    values = paranoid.decrypt_data_files(origin, [(uid, field, None) for field in fields])
+    for field, data in zip(fields, values):
         if data is not None:
             info['map'][field] = data
 
@@ -233,11 +548,62 @@ def share_service_identity_mapping(origin, uid, field_name, username):
     # Send a share request.
     # We send the full origin (stored in the service) instead of the origin key.
     full_origin = service.get('origin')
-    paranoid.send_share_request(full_origin, uid, field_name, username)
+    paranoid.send_share_request(full_origin, uid, [field_name], username)
 
     return JsonResponse()
 
 
+@app.route('/services/<origin>/shares/<uid>', methods=['POST'])
+def share_service_identity_mappings(origin, uid):
+    """
+    Shares multiple fields with multiple Keybase users at once.
+    Expects a JSON object with a list of fields and a list of usernames, e.g. {"fields": ["email"], "usernames": ["alice"]}.
+    Each field is re-encrypted once, and each user receives a single share request for all fields newly shared with them.
+    """
+
+    # Read service
+    service = paranoid.get_service(origin)
+    if service is None:
+        raise ParanoidException('Service does not exist for origin {}'.format(origin))
+
+    field_names, usernames = get_share_lists()
+    shared, errors = paranoid.update_shares(origin, uid, field_names, usernames)
+
+    # Send a single share request per user, for the fields which were shared successfully.
+    # We send the full origin (stored in the service) instead of the origin key.
+    full_origin = service.get('origin')
+    for username, shared_fields in shared.items():
+        paranoid.send_share_request(full_origin, uid, shared_fields, username)
+
+    return JsonResponse(shared, errors=errors)
+
+
+@app.route('/services/<origin>/shares/<uid>', methods=['DELETE'])
+def unshare_service_identity_mappings(origin, uid):
+    "Unshares multiple fields with multiple Keybase users at once, given the same JSON object as for sharing."
+
+    field_names, usernames = get_share_lists()
+    unshared, errors = paranoid.update_shares(origin, uid, field_names, usernames, share=False)
+
+    return JsonResponse(unshared, errors=errors)
+
+
+def get_share_lists():
+    "Returns the lists of fields and usernames in the request body."
+    data = request.get_json()
+    if not isinstance(data, dict):
+        raise ParanoidException('Expected an object with "fields" and "usernames"')
+
+    lists = []
+    for key in ('fields', 'usernames'):
+        values = data.get(key)
+        if not isinstance(values, list) or not all(isinstance(value, str) and value for value in values):
+            raise ParanoidException('Expected "{}" to be a list of strings'.format(key))
+        lists.append(values)
+
+    return lists
+
+
 @app.route('/services/<origin>/identities/<uid>/<field_name>/share/<username>', methods=['DELETE'])
 def unshare_service_identity_mapping(origin, uid, field_name, username):
     "Unshares a field with a Keybase user."
@@ -281,6 +647,13 @@ def internal_error(error):
     return jsonify(res), 500
 
 
+@app.errorhandler(KeybaseBusyException)
+def keybase_busy(error):
+    "Returns 503 when too many Keybase commands are queued, so that clients back off instead of piling on."
+    res = jsonify({'status': 'error', 'error': str(error)})
+    return res, 503, {'Retry-After': '1'}
+
+
 def init_default_files():
     dirs = {'private': ['services'], 'public': ['ids']}
 
@@ -294,16 +667,85 @@ def init_default_files():
         if keybase.ensure_dir(fullpath):
             click.echo('Initialized {} on first run'.format(fullpath))
 
+    if paranoid.ensure_manifest():
+        click.echo('Updated {} from {}'.format(keybase.get_public(MANIFEST_FILENAME), keybase.get_public('ids')))
+
 
-def prefetch():
+def ensure_default_files():
+    "Initializes default files, unless this has already been done."
+    with default_files_lock:
+        if startup['default_files'] == 'done':
+            return
+
+        try:
+            init_default_files()
+        except Exception as e:
+            startup.update(default_files='failed', default_files_error=str(e))
+            raise
+        startup.update(default_files='done', default_files_error=None)
+
+
+def warm_up(prefetch_cache=True, revalidate=False, print_profile=False):
+    """
+    Initializes default files and populates the cache, which is done in the background after the server
+    starts listening, so that requests can be served meanwhile.
+    """
+    try:
+        with profile.phase('default files', background=True):
+            ensure_default_files()
+    except Exception as e:
+        click.secho(' * Could not initialize default files, retrying on the first write: {}'.format(e), fg='red',
+                    err=True)
+        prefetch_cache = False
+
+    if prefetch_cache:
+        with profile.phase('revalidate snapshot' if revalidate else 'prefetch', background=True):
+            prefetch(revalidate=revalidate)
+
+    if startup['default_files'] == 'done':
+        startup['ready_at'] = time.monotonic()
+    if print_profile:
+        click.secho(' * Startup profile ({:.3f}s until warm):\n{}'.format(profile.elapsed(), profile.format()))
+
+
+def prefetch(revalidate=False):
     "Prefetch to populate cache"
-    click.secho(" * Populating cache...")
-    paranoid.prefetch()
-    click.secho(" * Prefetch complete.", fg='green')
+    click.secho(" * Revalidating cache..." if revalidate else " * Populating cache...")
+    prefetcher.run(revalidate=revalidate)
+    status = prefetcher.status()
+    click.secho(
+        " * Prefetch complete: {done} items in {elapsed}s ({items_per_second}/s), {failed} failed.".format(**status),
+        fg='green',
+    )
 
 
 @click.command()
 @click.option('--port', help='Port to start the server on. Defaults to 5000.', type=int)
+@click.option(
+    '--server',
+    'server_type',
+    type=click.Choice(server.SERVERS),
+    default='dev',
+    help='HTTP server to run the daemon with. "cheroot" is a multi-threaded production server which keeps '
+    'connections alive and resumes TLS sessions, and requires cheroot to be installed. Defaults to "dev", '
+    'the Flask development server.',
+)
+@click.option(
+    '--server-threads',
+    default=16,
+    help='Number of threads serving requests, for production servers. Defaults to 16.',
+)
+@click.option(
+    '--keep-alive-timeout',
+    default=30,
+    help='Seconds to keep idle connections open, for production servers. Defaults to 30.',
+)
+@click.option(
+    '--event-clients',
+    type=int,
+    help='Maximum number of clients connected to GET /events at once, each of which holds a server thread. '
+    'Must be less than --server-threads. Defaults to half of --server-threads.',
+)
 @click.option('--ssl-cert', help='Path to SSL certificate.')
 @click.option('--ssl-privkey', help='Path to SSL private key.')
 @click.option(
@@ -313,6 +755,88 @@ def prefetch():
     'files will be located in /keybase/private/<username>/paranoid.',
 )
 @click.option('--token-file', help='Path to file to load session token from.')
+@click.option(
+    '--keybase-bin',
+    default='keybase',
+    help='Command used to run the Keybase CLI. Defaults to "keybase". '
+    'Use "python fake_keybase.py" to run without a Keybase account.',
+)
+@click.option(
+    '--keybase-session',
+    help='Command for a long-lived Keybase API process that accepts JSON requests on stdin. '
+    'If set, Keybase commands are sent to this process instead of spawning a new process per command.',
+)
+@click.option(
+    '--engine',
+    type=click.Choice(ENGINES),
+    default='threads',
+    help='How Keybase commands are run. "asyncio" runs them as asyncio subprocesses on a single event loop, '
+    'instead of blocking a thread per command in flight. Defaults to "threads".',
+)
+@click.option(
+    '--decrypt-workers',
+    default=8,
+    help='Maximum number of files decrypted concurrently when reading multiple fields. Defaults to 8.',
+)
+@click.option(
+    '--keybase-workers',
+    default=8,
+    help='Maximum number of Keybase commands running at once. Defaults to 8.',
+)
+@click.option(
+    '--keybase-queue',
+    default=64,
+    help='Maximum number of Keybase commands waiting to run before requests are rejected with 503. Defaults to 64.',
+)
+@click.option(
+    '--metadata-ttl',
+    default=30,
+    help='Seconds to remember whether KBFS paths exist, to save existence checks. Defaults to 30. '
+    'Set to 0 to disable.',
+)
+@click.option(
+    '--storage',
+    type=click.Choice(['cli', 'mount', 'local']),
+    default='cli',
+    help='Backend used to read and write plain files. "cli" uses the Keybase CLI, "mount" uses the mounted KBFS '
+    'directly, and "local" uses a local directory in place of /keybase. Defaults to "cli".',
+)
+@click.option('--storage-root', help='Directory standing in for /keybase, for the "mount" and "local" storage backends.')
+@click.option(
+    '--state-dir',
+    default=os.path.join(os.path.expanduser('~'), '.paranoid'),
+    help='Directory for local daemon state, such as the write-behind journal and access history. '
+    'Defaults to ~/.paranoid.',
+)
+@click.option(
+    '--write-behind',
+    is_flag=True,
+    default=False,
+    help='Journals metadata writes locally and writes them to KBFS in the background. '
+    'Use POST /flush to wait for pending writes.',
+)
+@click.option(
+    '--write-behind-delay',
+    default=1.0,
+    help='Seconds to wait for repeated metadata writes to coalesce before writing them to KBFS. Defaults to 1.',
+)
+@click.option(
+    '--prefetch-workers',
+    default=4,
+    help='Number of threads used to prefetch the cache on startup. Defaults to 4.',
+)
+@click.option(
+    '--prefetch-foreign',
+    is_flag=True,
+    default=False,
+    help='Also resolves foreign maps when prefetching the cache.',
+)
+@click.option(
+    '--profile-startup',
+    is_flag=True,
+    default=False,
+    help='Prints the time taken by each phase of startup, once the cache is warm. See also GET /ready.',
+)
 @click.option(
     '--disable-auth',
     is_flag=True,
@@ -325,13 +849,60 @@ def prefetch():
     default=False,
     help='Disables sending of Keybase chat messages. This might be useful during development.',
 )
+@click.option(
+    '--chat-delay',
+    default=2.0,
+    help='Seconds to wait for more share requests to the same user before sending them in a single chat message. '
+    'Defaults to 2.',
+)
+@click.option(
+    '--cache-max-bytes',
+    default=DEFAULT_MAX_DATA_BYTES,
+    help='Maximum total size of decrypted values kept in the cache, in bytes. Defaults to 64 MiB.',
+)
+@click.option(
+    '--cache-snapshot-key-file',
+    help='Path to file to load a secret from, which is used to encrypt snapshots of the cache on disk. '
+    'If set, the cache is loaded from the last snapshot on startup, and revalidated in the background.',
+)
+@click.option(
+    '--cache-snapshot-interval',
+    default=300,
+    help='Seconds between snapshots of the cache. Defaults to 300.',
+)
+@click.option(
+    '--cache-ttl',
+    multiple=True,
+    metavar='SECTION=SECONDS',
+    help='Seconds after which cached entries of a section are revalidated in the background, while still being '
+    'served. Can be repeated. Sections: {}.'.format(', '.join(DEFAULT_TTLS)),
+)
 @click.option(
     '--disable-cache',
     is_flag=True,
     default=False,
     help='Disables the KBFS cache entirely. WARNING: This makes all operations extremely slow.',
 )
-def main(port, ssl_cert, ssl_privkey, base_path, token_file, disable_auth, disable_chat, disable_cache):
+def main(port, server_type, server_threads, keep_alive_timeout, event_clients, ssl_cert, ssl_privkey, base_path,
+         token_file, keybase_bin, keybase_session, engine, decrypt_workers, keybase_workers, keybase_queue,
+         metadata_ttl, storage, storage_root, state_dir, write_behind, write_behind_delay, prefetch_workers,
+         prefetch_foreign, profile_startup, disable_auth, disable_chat, chat_delay, cache_max_bytes,
+         cache_snapshot_key_file, cache_snapshot_interval, cache_ttl, disable_cache):
+    profile.start()
+
+    # Check that the HTTP server can be run
+    if not server.is_available(server_type):
+        click.secho('ERROR: {} is not installed, install it with `pip install {}`.'.format(server_type, server_type))
+        sys.exit(1)
+
+    # Leave server threads for other requests than the event stream
+    if event_clients is None:
+        event_clients = server_threads // 2
+    if not 0 <= event_clients < server_threads:
+        click.secho('ERROR: --event-clients must be at least 0 and less than --server-threads.')
+        sys.exit(1)
+    events.init(max_clients=event_clients)
+
     # Set up authorization session token.
     if disable_auth:
         click.secho(' * Authentication disabled for server.')
@@ -351,6 +922,9 @@ def main(port, ssl_cert, ssl_privkey, base_path, token_file, disable_auth, disab
         click.secho(auth.get_token())
         click.secho()
 
+    # Flask runs before_request handlers in the order that they are registered
+    app.before_request(require_default_files)
+
     # Set up SSL.
     ssl_context = None
     if ssl_cert or ssl_privkey:
@@ -363,25 +937,110 @@ def main(port, ssl_cert, ssl_privkey, base_path, token_file, disable_auth, disab
         click.secho(' * No SSL certificate specified.')
         click.secho('   WARNING: This means that secrets will be transmitted in plaintext over the network interface specified.', fg='red')
 
-    # Initialize Keybase client
-    keybase.init(base_path=base_path)
+    # Set up storage backend.
+    try:
+        storage_backend = create_storage(keybase, storage, storage_root)
+    except ValueError as e:
+        click.secho('ERROR: {}'.format(e))
+        sys.exit(1)
+
+    # Parse cache TTLs.
+    ttls = {}
+    for value in cache_ttl:
+        section, _, seconds = value.partition('=')
+        if section not in DEFAULT_TTLS or not seconds.isdigit():
+            click.secho('ERROR: Invalid cache TTL "{}", expected SECTION=SECONDS.'.format(value))
+            sys.exit(1)
+        ttls[section] = int(seconds)
+
+    # Initialize Keybase client. The logged in user is only looked up on first use.
+    with profile.phase('keybase client'):
+        keybase.init(
+            base_path=base_path,
+            executable=shlex.split(keybase_bin),
+            session_cmd=shlex.split(keybase_session) if keybase_session else None,
+            storage=storage_backend,
+            decrypt_workers=decrypt_workers,
+            max_workers=keybase_workers,
+            max_queue=keybase_queue,
+            metadata_ttl=0 if disable_cache else metadata_ttl,
+            engine=engine,
+        )
+        atexit.register(keybase.close)
+
+    # Set up write-behind journal, replaying any writes left over from the last run.
+    journal = None
+    if write_behind:
+        with profile.phase('write-behind journal'):
+            journal = WriteJournal(keybase, os.path.join(state_dir, 'journal.jsonl'), delay=write_behind_delay)
+            journal.start()
+        click.secho(' * Write-behind journal enabled.')
+
+    # Set up chat outbox, sending any share requests left over from the last run.
+    global outbox
+    if not disable_chat:
+        with profile.phase('chat outbox'):
+            outbox = ChatOutbox(keybase, os.path.join(state_dir, 'outbox.json'), paranoid.format_share_request,
+                                delay=chat_delay)
+            outbox.start()
+            atexit.register(outbox.close)
+
+    # Initialize Paranoid cache
+    cache.init(max_data_bytes=cache_max_bytes)
+    startup['cache_enabled'] = not disable_cache
+
+    # Load the cache from the last snapshot if enabled, so that requests can be served immediately.
+    warm = False
+    if cache_snapshot_key_file and not disable_cache:
+        with profile.phase('cache snapshot'):
+            with open(cache_snapshot_key_file) as f:
+                snapshot = CacheSnapshot(cache, os.path.join(state_dir, 'cache.snapshot'), f.read().strip(),
+                                         interval=cache_snapshot_interval)
+            try:
+                warm = snapshot.load()
+            except Exception as e:
+                click.secho(' * Could not load cache snapshot, starting with an empty cache: {}'.format(e), fg='red')
+        if warm:
+            click.secho(' * Cache loaded from snapshot in {:.3f}s.'.format(profile.elapsed()))
+        startup['snapshot_loaded'] = warm
+        snapshot.start()
+        atexit.register(snapshot.close)
 
     # Initialize Paranoid manager
-    paranoid.init(disable_chat=disable_chat, disable_cache=disable_cache)
+    with profile.phase('paranoid manager'):
+        revalidator.init(ttls=ttls)
+        paranoid.init(disable_chat=disable_chat, disable_cache=disable_cache, journal=journal, revalidator=revalidator,
+                      outbox=outbox, events=events)
+        atexit.register(paranoid.close)
 
-    # Initialize default files
-    init_default_files()
+        # Initialize access log and prefetcher
+        access_log.init(path=os.path.join(state_dir, 'access.json'))
+        atexit.register(access_log.close)
+        prefetcher.init(workers=prefetch_workers, foreign_maps=prefetch_foreign)
 
     if disable_cache:
         click.secho(' * KBFS cache disabled.')
         click.secho('   WARNING: This makes all operations extremely slow.', fg='red')
-    else:
-        # Prefetch in a background thread
-        prefetcher = Thread(target=prefetch)
-        prefetcher.start()
 
-    # Start Flask server
-    app.run(host='127.0.0.1', port=port, ssl_context=ssl_context)
+    # Initialize default files, then prefetch (or revalidate the cache if it was loaded from a snapshot) in a
+    # background thread, so that the server starts listening right away
+    Thread(target=warm_up, kwargs={
+        'prefetch_cache': not disable_cache,
+        'revalidate': warm,
+        'print_profile': profile_startup,
+    }).start()
+
+    # Start HTTP server
+    server_started_at = time.monotonic()
+
+    def on_listening():
+        startup['listening_at'] = time.monotonic()
+        profile.add('start server', server_started_at, startup['listening_at'] - server_started_at)
+        if profile_startup:
+            click.secho(' * Listening {:.3f}s after startup.'.format(profile.elapsed(startup['listening_at'])))
+
+    server.run(app, server_type, '127.0.0.1', port or 5000, ssl_context=ssl_context, threads=server_threads,
+               keep_alive_timeout=keep_alive_timeout, on_listening=on_listening)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,132 @@
+"""
+Metrics in the Prometheus text exposition format, served at /metrics.
+
+Metrics are registered in a module-level registry when they are created, and can have labels.
+Gauges take a function which is called on every scrape, and returns either a value or a dict of
+label value tuples to values.
+"""
+
+import math
+import threading
+
+# Default histogram buckets for latencies, in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        "Returns all metrics in the Prometheus text exposition format."
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def format_sample(self, name, labels, value, extra=()):
+        pairs = list(zip(self.labels, labels)) + list(extra)
+        if pairs:
+            name += '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in pairs) + '}'
+        return '{} {}'.format(name, format_value(value))
+
+    def render(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return [self.format_sample(self.name, labels, value) for labels, value in values]
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help, fn, labels=()):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def render(self):
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [self.format_sample(self.name, labels, value) for labels, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (math.inf, )
+        self.values = {}
+
+    def observe(self, value, *labels):
+        with self.lock:
+            if labels not in self.values:
+                self.values[labels] = ([0] * len(self.buckets), [0.0])
+            counts, total = self.values[labels]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            total[0] += value
+
+    def render(self):
+        with self.lock:
+            values = sorted((labels, (list(counts), total[0])) for labels, (counts, total) in self.values.items())
+
+        lines = []
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(self.format_sample(self.name + '_bucket', labels, cumulative, [('le', format_value(bound))]))
+            lines.append(self.format_sample(self.name + '_sum', labels, total))
+            lines.append(self.format_sample(self.name + '_count', labels, cumulative))
+        return lines
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+One-shot migrations of Paranoid files in KBFS.
+
+Usage:
+
+    python migrate.py [OPTIONS] COMMAND
+"""
+
+import shlex
+import sys
+
+import click
+
+from cache import MockCache
+from keybase import KeybaseClient
+from paranoid import FORMAT_CONSOLIDATED, ParanoidManager
+from storage import create_storage
+
+
+@click.group()
+@click.option(
+    '--base-path',
+    default='paranoid',
+    help='Base path to look up Paranoid files. Defaults to "paranoid", which means that '
+    'files will be located in /keybase/private/<username>/paranoid.',
+)
+@click.option('--keybase-bin', default='keybase', help='Command used to run the Keybase CLI. Defaults to "keybase".')
+@click.option(
+    '--storage',
+    type=click.Choice(['cli', 'mount', 'local']),
+    default='cli',
+    help='Backend used to read and write plain files. Defaults to "cli".',
+)
+@click.option('--storage-root', help='Directory standing in for /keybase, for the "mount" and "local" storage backends.')
+@click.pass_context
+def cli(ctx, base_path, keybase_bin, storage, storage_root):
+    keybase = KeybaseClient()
+    try:
+        keybase.init(
+            base_path=base_path,
+            executable=shlex.split(keybase_bin),
+            storage=create_storage(keybase, storage, storage_root),
+        )
+    except ValueError as e:
+        click.secho('ERROR: {}'.format(e))
+        sys.exit(1)
+
+    # Always read from KBFS directly
+    paranoid = ParanoidManager(keybase, MockCache())
+    paranoid.init(disable_chat=True, disable_cache=True)
+
+    ctx.obj = paranoid
+
+
+@cli.command()
+@click.pass_obj
+def envelope(paranoid):
+    "Rewrites all legacy data files in the envelope format."
+
+    migrated = 0
+    for origin in paranoid.get_origins():
+        for uid in paranoid.get_service_uids(origin):
+            identity = paranoid.get_service_identity(origin, uid)
+            if identity is None:
+                continue
+
+            for field_name, field in identity.get('fields', {}).items():
+                shared_users = field.get('shared_with', [])
+                if paranoid.migrate_data_file(origin, uid, field_name, shared_users):
+                    click.echo('Migrated {}:{}:{}'.format(origin, uid, field_name))
+                    migrated += 1
+
+    click.secho('Migrated {} data files.'.format(migrated), fg='green')
+
+
+@cli.command()
+@click.pass_obj
+def consolidate(paranoid):
+    """
+    Rewrites all services in the consolidated storage format, with a single file per service.
+    The daemon must not be running. Files in the previous format are left in place.
+    """
+
+    if paranoid.is_consolidated():
+        click.secho('Services are already stored in the consolidated format.', fg='green')
+        return
+
+    # Write all service files before switching formats, so that an interrupted migration can simply be run again
+    migrated = 0
+    for origin in paranoid.get_origins():
+        service_file = paranoid.dump_service(origin)
+        if service_file['info'] is None:
+            click.secho('Skipped {}: missing info.json'.format(origin), fg='yellow')
+            continue
+
+        paranoid.write_json(paranoid.get_service_file_path(origin), service_file)
+        click.echo('Migrated {} ({} identities)'.format(origin, len(service_file['uids'])))
+        migrated += 1
+
+    paranoid.set_format_version(FORMAT_CONSOLIDATED)
+    click.secho('Migrated {} services.'.format(migrated), fg='green')
+
+
+if __name__ == '__main__':
+    cli()
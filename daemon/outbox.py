@@ -0,0 +1,183 @@
+"""
+Chat outbox for share requests.
+
+Share requests are queued per recipient and saved to a local file before returning, and are sent via
+Keybase chat by a background thread after a short delay. Requests to the same recipient within that
+window are merged into a single chat message. Messages which fail to send are retried with
+exponential backoff, and any messages left over by a daemon that did not shut down cleanly are sent
+on start.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import click
+
+from metrics import Counter, Histogram
+
+# Metrics for chat messages.
+SENT = Counter('paranoid_outbox_sent_total', 'Chat messages sent from the outbox.')
+SEND_FAILURES = Counter('paranoid_outbox_send_failures_total', 'Attempts to send chat messages that failed.')
+SEND_LATENCY = Histogram('paranoid_outbox_send_latency_seconds',
+                         'Time from queueing a share request to sending the chat message containing it.',
+                         buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600))
+
+
+class ChatOutbox:
+    def __init__(self, keybase, path, format_message, delay=2.0, max_backoff=300):
+        self.keybase = keybase
+        self.path = path
+        self.format_message = format_message
+        self.delay = delay
+        self.max_backoff = max_backoff
+
+        # Messages by recipient, each with a list of requests, when the first request was queued, the
+        # number of failed attempts so far, and the earliest time to send it at (all times are wall clock
+        # times, since they are saved across restarts).
+        self.pending = OrderedDict()
+        self.sending = {}
+
+        self.closed = False
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.sender = threading.Thread(target=self._run, name='chat-outbox', daemon=True)
+
+    def start(self):
+        "Loads messages left behind by a previous run, then starts sending in the background."
+        os.makedirs(os.path.dirname(self.path) or '.', mode=0o700, exist_ok=True)
+
+        with self.lock:
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path) as f:
+                        self.pending = OrderedDict(json.load(f))
+                except ValueError:
+                    self.pending = OrderedDict()
+
+        self.sender.start()
+
+    def put(self, username, origin, uid, field_names):
+        "Queues a share request for a list of fields to a user."
+        now = time.time()
+        with self.lock:
+            if username not in self.pending:
+                self.pending[username] = {
+                    'requests': [],
+                    'queued_at': now,
+                    'attempts': 0,
+                    'not_before': now + self.delay,
+                }
+
+            ChatOutbox._merge(self.pending[username]['requests'],
+                              [{'origin': origin, 'uid': uid, 'field_names': list(field_names)}])
+            self._save()
+            self.cond.notify_all()
+
+    def status(self):
+        "Returns the number of queued messages and share requests, and how long the oldest one has been waiting."
+        with self.lock:
+            messages = list(self.pending.values()) + list(self.sending.values())
+
+        oldest = min((message['queued_at'] for message in messages), default=None)
+        return {
+            'messages': len(messages),
+            'requests': sum(len(message['requests']) for message in messages),
+            'oldest_age': round(time.time() - oldest, 3) if oldest is not None else None,
+        }
+
+    def flush(self):
+        "Attempts to send all queued messages right away, and blocks until done."
+        with self.lock:
+            usernames = list(self.pending)
+
+        for username in usernames:
+            self._send(username)
+
+    def close(self):
+        "Stops the background thread, and attempts to send all queued messages once. Unsent messages are kept for the next run."
+        with self.lock:
+            self.closed = True
+            self.cond.notify_all()
+        if self.sender.is_alive():
+            self.sender.join()
+
+        self.flush()
+
+    def _send(self, username):
+        with self.lock:
+            message = self.pending.pop(username, None)
+            if message is None:
+                return
+            self.sending[username] = message
+
+        try:
+            self.keybase.send_chat(username, self.format_message(username, message['requests']))
+        except Exception as e:
+            SEND_FAILURES.inc()
+            with self.lock:
+                del self.sending[username]
+
+                # Retry later with exponential backoff, together with any requests queued in the meantime
+                message['attempts'] += 1
+                message['not_before'] = time.time() + min(self.delay * 2**message['attempts'], self.max_backoff)
+                queued = self.pending.pop(username, None)
+                if queued is not None:
+                    ChatOutbox._merge(message['requests'], queued['requests'])
+                    message['not_before'] = max(message['not_before'], queued['not_before'])
+                self.pending[username] = message
+                self._save()
+
+            click.secho(' * Failed to send share request to {}, will retry: {}'.format(username, e), fg='red', err=True)
+            return
+
+        SENT.inc()
+        SEND_LATENCY.observe(time.time() - message['queued_at'])
+        with self.lock:
+            del self.sending[username]
+            self._save()
+
+    def _save(self):
+        "Saves all queued messages, including those being sent. Must be called with the lock held."
+        messages = OrderedDict(self.sending)
+        messages.update(self.pending)
+
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(list(messages.items()), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.closed:
+                    now = time.time()
+                    due = [username for username, message in self.pending.items() if message['not_before'] <= now]
+                    if due:
+                        break
+
+                    # Wait until the next message is due, or until a new one is queued
+                    next_at = min((message['not_before'] for message in self.pending.values()), default=None)
+                    self.cond.wait(next_at - now if next_at is not None else None)
+
+                if self.closed:
+                    return
+
+            for username in due:
+                self._send(username)
+
+    @staticmethod
+    def _merge(requests, new_requests):
+        "Merges share requests into a list of requests, combining the fields of requests for the same identity."
+        for new_request in new_requests:
+            for request in requests:
+                if request['origin'] == new_request['origin'] and request['uid'] == new_request['uid']:
+                    request['field_names'] += [name for name in new_request['field_names'] if name not in request['field_names']]
+                    break
+            else:
+                requests.append(dict(new_request, field_names=list(new_request['field_names'])))
@@ -51,6 +51,32 @@ Example:
   }
   ```
 
+With the consolidated storage format (format version 2, see migrate.py), each service is instead
+kept in a single file holding its info, foreign map and identities, so that a whole service can be
+loaded with one read. The format version is recorded in a marker file in the private base path,
+and defaults to version 1 (the layout above) if it is missing.
+
+Example:
+- File path:
+  /keybase/private/irvinlim/paranoid/format.json
+- Contents:
+  ```
+  {"version": 2}
+  ```
+
+- File path:
+  /keybase/private/irvinlim/paranoid/services/http@google.com@80.json (origin name)
+- Contents:
+  ```
+  {
+    "info": {"origin": "http://google.com:80"},
+    "foreign_map": [...],
+    "uids": {
+      "1": {"key": "MIIC...", "fields": {...}}
+    }
+  }
+  ```
+
 File structure for (shared) identities is stored in /keybase/public, where files are only
 signed by default. However, we enforce files to be encrypted for only the users who are
 authorized to view the contents of the file.
@@ -59,21 +85,83 @@ Example:
 - File path:
   /keybase/public/irvinlim/paranoid/ids/ac9055add1d71c8523362c02ec92232c9bb0c7fe26e46a095d4d821c56b533be
     (the hash is `sha256("http:google.com:80:1:first_name")`)
+- Contents:
+  ```
+  PARANOID ENVELOPE V1
+  {"key_id": "...", "nonce": "...", "tag": "...", "ciphertext": "..."}
+  ```
+
+The value is encrypted under a random data key, which is in turn encrypted for the authorized users
+in a separate key file next to it (see envelope.py). Data files written by older versions are
+encrypted for the authorized users directly, and are still supported for reading:
+
+- File path:
+  /keybase/public/irvinlim/paranoid/ids/ac9055add1d71c8523362c02ec92232c9bb0c7fe26e46a095d4d821c56b533be
 - Contents:
   ```
   BEGIN KEYBASE SALTPACK ENCRYPTED MESSAGE...
   ```
+
+A manifest of all data files is kept next to the ids directory, so that readers can tell which data
+files exist (and whether they have changed) from a single small file, instead of listing or stat-ing
+the ids directory. Like all files in /keybase/public, it is signed by its owner. Manifests which are
+older than the ids directory (e.g. if data files were added by an older version) are not trusted, and
+the ids directory is listed instead.
+
+Example:
+- File path:
+  /keybase/public/irvinlim/paranoid/manifest.json
+- Contents:
+  ```
+  {
+    "ids": {
+      "ac9055add1d71c8523362c02ec92232c9bb0c7fe26e46a095d4d821c56b533be": {
+        "version": 3,
+        "size": 96,
+        "format": "envelope"
+      }
+    }
+  }
+  ```
+
+The version of a data file is incremented every time a new value is written. Legacy data files are
+listed with the "legacy" format and a size of null.
 """
 
+import copy
+import fnmatch
 import json
 import os
-from typing import Dict, List
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import List
 from urllib.parse import urlencode
 
 from Crypto.Hash import SHA256
 
-from cache import MockCache, ParanoidCache
-from keybase import KeybaseClient
+import envelope
+from cache import MockCache, ParanoidCache, SingleFlight
+from envelope import KEY_SUFFIX
+from keybase import PRIORITY_REENCRYPT, KeybaseClient, KeybaseFileNotFoundException
+
+
+# Filename of the manifest of data files, next to the ids directory.
+MANIFEST_FILENAME = 'manifest.json'
+
+# Filename of the format version marker, in the private base path.
+FORMAT_FILENAME = 'format.json'
+
+# Storage formats for services: split across info.json, foreign_map.json and uids/<uid>.json in a
+# directory per service, or consolidated into a single file per service.
+FORMAT_SPLIT = 1
+FORMAT_CONSOLIDATED = 2
+
+# Number of times to read a sealed data file together with its data key, and seconds to wait in between,
+# if they were read from different writes.
+UNSEAL_ATTEMPTS = 3
+UNSEAL_RETRY_DELAY = 0.1
 
 
 class ParanoidException(Exception):
@@ -84,8 +172,32 @@ class ParanoidManager():
     def __init__(self, keybase: KeybaseClient, cache: ParanoidCache):
         self.keybase = keybase
         self.cache = cache
+        self.local = threading.local()
+
+        # Concurrent cache misses on the same key share a single load
+        self.loads = SingleFlight()
+
+        # Serializes read-modify-write cycles of foreign maps
+        self.foreign_map_lock = threading.Lock()
+
+        # Merged views of our own and foreign values by origin (see get_bundle), with a generation per origin
+        # which is bumped on every change, so that views built concurrently with a write are discarded.
+        self.bundles = {}
+        self.bundle_generations = {}
+        self.bundle_lock = threading.Lock()
+
+        # Manifests of data files by username (None for our own), together with when they were fetched
+        self.manifests = {}
+        self.manifest_lock = threading.Lock()
+        self.manifest_write_lock = threading.Lock()
+
+        # Storage format of services, read from the format marker on first use
+        self.format_version = None
 
-    def init(self, disable_chat=False, disable_cache=False):
+        # Serializes read-modify-write cycles of consolidated service files
+        self.service_file_lock = threading.RLock()
+
+    def init(self, disable_chat=False, disable_cache=False, journal=None, revalidator=None, outbox=None, events=None):
         self.disable_chat = disable_chat
         self.disable_cache = disable_cache
 
@@ -93,42 +205,102 @@ class ParanoidManager():
         if disable_cache:
             self.cache = MockCache()
 
-    def prefetch(self):
-        "Prefetches data for objects which would store them in an in-memory cache for faster first-time load."
-
-        # Nothing to prefetch if we don't have a cache
-        if self.disable_cache:
+        # Metadata writes go through the write-behind journal if set, otherwise straight to KBFS
+        self.journal = journal
+
+        # Stale cache entries are refreshed in the background if set, otherwise cache entries never expire
+        self.revalidator = revalidator
+
+        # Share requests are sent in the background through the chat outbox if set, otherwise right away
+        self.outbox = outbox
+
+        # Changes are published to clients of the event stream if set
+        self.events = events
+
+    def flush(self):
+        "Writes all metadata writes in the write-behind journal to KBFS."
+        if self.journal is not None:
+            self.journal.flush()
+
+    def close(self):
+        "Flushes and closes the write-behind journal."
+        if self.journal is not None:
+            self.journal.close()
+
+    @contextmanager
+    def revalidating(self):
+        "Within the block, reads from the current thread skip the cache, and update it with the latest data from KBFS."
+        self.local.revalidating = True
+        try:
+            yield
+        finally:
+            self.local.revalidating = False
+
+    def is_revalidating(self):
+        return getattr(self.local, 'revalidating', False)
+
+    def check_freshness(self, section, key=None):
+        "Queues a cache entry (or the entries behind the bundle of an origin) that was just served to be revalidated, if it is stale."
+        if section == 'bundle':
+            # The view does not expire by itself, so check the entries it was built from instead
+            with self.bundle_lock:
+                entries = list(self.bundles[key]['entries']) if key in self.bundles else []
+            for section, key in entries:
+                self.check_freshness(section, key)
             return
 
-        # Fetch list of all origins
-        origins = self.get_origins()
-        for origin in origins:
-            # Fetch all services and their foreign map
-            self.get_service(origin)
-            self.get_foreign_map(origin)
+        if self.revalidator is not None and not self.disable_cache and not self.is_revalidating():
+            self.revalidator.check(section, key)
+
+    def notify(self, section, key=None):
+        "Publishes a change to a cache entry to clients of the event stream, with the new version of the entry."
+        if self.events is not None:
+            version, _ = self.cache.get_version(section, key)
+            self.events.publish(section, key, version)
+
+    def get_version(self, section, key=None):
+        """
+        Returns (version, cache_hit) for a cache entry, or for the bundle of an origin if section is "bundle".
+        The version changes whenever the entry does.
+        """
+        if section == 'bundle':
+            # Derived from the versions of the entries behind the view, so that it only changes with them
+            with self.bundle_lock:
+                if key not in self.bundles:
+                    return None, False
+                entries = sorted(self.bundles[key]['entries'], key=repr)
 
-            # Fetch all service identities
-            uids = self.get_service_uids(origin)
-            for uid in uids:
-                info = self.get_service_identity(origin, uid)
+            versions = [[entry_section, entry_key, self.cache.get_version(entry_section, entry_key)[0]]
+                        for entry_section, entry_key in entries]
+            return SHA256.new(json.dumps(versions).encode('utf-8')).hexdigest()[:16], True
 
-                # Fetch all service identity fields
-                for field in info.get('fields'):
-                    self.decrypt_data_file(origin, uid, field)
+        return self.cache.get_version(section, key)
 
     def get_origins(self) -> List[str]:
         "Returns a list of origins."
 
         # Check if cache hit
         data, cache_hit = self.cache.get_origins()
-        if not cache_hit:
-            path = self.keybase.get_private('services')
+        if not cache_hit or self.is_revalidating():
+
+            def load():
+                path = self.keybase.get_private('services')
 
-            # Convert origin filenames to origin keys
-            data = [ParanoidManager.origin_filename_to_key(filename) for filename in self.keybase.list_dir(path)]
+                # Convert origin filenames to origin keys
+                if self.is_consolidated():
+                    filenames = [filename[:-5] for filename in self.list_metadata_dir(path, '*.json')]
+                else:
+                    # Skip consolidated service files left behind by an interrupted migration
+                    filenames = [filename for filename in self.list_metadata_dir(path) if not filename.endswith('.json')]
+                data = [ParanoidManager.origin_filename_to_key(filename) for filename in filenames]
 
-            # Update cache
-            self.cache.add_origins(data)
+                # Update cache
+                self.cache.set_origins(data)
+                return data
+
+            data = self.loads.do(('origin_list', None), load)
+        else:
+            self.check_freshness('origin_list')
 
         return data
 
@@ -137,27 +309,39 @@ class ParanoidManager():
 
         # Check if cache hit
         data, cache_hit = self.cache.get_service(origin)
-        if not cache_hit:
-            # Check if origin and service exists
-            path = self.get_service_path(origin)
-            if not self.keybase.exists(path):
-                return None
+        if not cache_hit or self.is_revalidating():
 
-            path = self.get_service_path(origin, 'info.json')
-            if not self.keybase.exists(path):
-                return None
+            def load():
+                if self.is_consolidated():
+                    service_file = self.load_service_file(origin)
+                    return service_file['info'] if service_file is not None else None
 
-            # Get info
-            data = self.keybase.get_json(path)
+                # Get info, if the service exists
+                path = self.get_service_path(origin, 'info.json')
+                data = self.read_json(path)
+                if data is not None:
+                    # Update cache
+                    self.cache.set_service(origin, data)
+                return data
 
-            # Update cache
-            self.cache.set_service(origin, data)
+            data = self.loads.do(('service_info', origin), load)
+        else:
+            self.check_freshness('service_info', origin)
 
         return data
 
     def set_service(self, origin, service):
         "Updates a service."
 
+        if self.is_consolidated():
+
+            def update(service_file):
+                service_file['info'] = service
+
+            self.update_service_file(origin, update)
+            self.set_service_cache(origin, service)
+            return
+
         # Make sure that paths exist
         path = self.get_service_path(origin)
         self.keybase.ensure_dir(path)
@@ -166,27 +350,49 @@ class ParanoidManager():
 
         # Save info
         path = self.get_service_path(origin, 'info.json')
-        self.keybase.put_file(path, json.dumps(service))
+        self.write_json(path, service)
 
         # Update Cache
+        self.set_service_cache(origin, service)
+
+    def set_service_cache(self, origin, service):
+        "Updates the cached copy of a service that was written, and publishes the change."
+        origins, _ = self.cache.peek('origin_list')
         self.cache.set_service(origin, service)
+        self.notify('service_info', origin)
+        if origin not in (origins or []):
+            self.notify('origin_list')
 
     def get_service_uids(self, origin) -> List[str]:
         "Returns a list of UIDs corresponding to all identities for a service."
 
         # Check if cache hit
         data, cache_hit = self.cache.get_service_uids(origin)
-        if not cache_hit:
-            # Check if origin exists
-            path = self.get_service_path(origin, 'uids')
-            if not self.keybase.exists(path):
-                return []
+        if not cache_hit or self.is_revalidating():
+
+            def load():
+                if self.is_consolidated():
+                    service_file = self.load_service_file(origin)
+                    return list(service_file['uids']) if service_file is not None else []
+
+                # Check if origin exists
+                path = self.get_service_path(origin, 'uids')
+                if not self.keybase.exists(path):
+                    return []
 
-            # Get identities
-            data = [uid[:-5] for uid in self.keybase.list_dir(path, '*.json')]
+                # Get identities
+                data = [uid[:-5] for uid in self.list_metadata_dir(path, '*.json')]
 
-            # Update cache
-            self.cache.add_service_uids(origin, data)
+                # Update cache
+                version, _ = self.cache.get_version('uid_list', origin)
+                self.cache.set_service_uids(origin, data)
+                if self.is_revalidating():
+                    self.update_bundle_if_changed(origin, {('uid_list', origin): version})
+                return data
+
+            data = self.loads.do(('uid_list', origin), load)
+        else:
+            self.check_freshness('uid_list', origin)
 
         return data
 
@@ -195,17 +401,30 @@ class ParanoidManager():
 
         # Check if cache hit
         data, cache_hit = self.cache.get_service_identity(origin, uid)
-        if not cache_hit:
-            # Check if origin and identity exists
-            path = self.get_service_path(origin, os.path.join('uids', '{}.json'.format(uid)))
-            if not self.keybase.exists(path):
-                return None
-
-            # Read service identity metadata
-            data = self.keybase.get_json(path)
-
-            # Update cache
-            self.cache.set_service_identity(origin, uid, data)
+        if not cache_hit or self.is_revalidating():
+
+            def load():
+                if self.is_consolidated():
+                    service_file = self.load_service_file(origin)
+                    return service_file['uids'].get(uid) if service_file is not None else None
+
+                # Read service identity metadata, if the identity exists
+                path = self.get_service_path(origin, os.path.join('uids', '{}.json'.format(uid)))
+                data = self.read_json(path)
+                version, _ = self.cache.get_version('service_data', (origin, uid))
+                if data is not None:
+                    # Update cache
+                    self.cache.set_service_identity(origin, uid, data)
+                if self.is_revalidating() and data is None and version is not None:
+                    # The identity is gone, and is about to be removed from the cache by the revalidator
+                    self.update_bundle(origin)
+                elif self.is_revalidating():
+                    self.update_bundle_if_changed(origin, {('service_data', (origin, uid)): version})
+                return data
+
+            data = self.loads.do(('service_data', (origin, uid)), load)
+        else:
+            self.check_freshness('service_data', (origin, uid))
 
         return data
 
@@ -217,62 +436,104 @@ class ParanoidManager():
         if service is None:
             raise ParanoidException('Service does not exist for origin: {}'.format(origin))
 
-        # Ensure parent directory exists
-        path = self.get_service_path(origin, 'uids')
-        self.keybase.ensure_dir(path)
+        if self.is_consolidated():
 
-        # Save service identity
-        path = self.get_service_path(origin, os.path.join('uids', '{}.json'.format(uid)))
-        res = self.keybase.put_file(path, json.dumps(identity))
+            def update_file(service_file):
+                service_file['uids'][uid] = identity
+
+            self.update_service_file(origin, update_file)
+        else:
+            # Ensure parent directory exists
+            path = self.get_service_path(origin, 'uids')
+            self.keybase.ensure_dir(path)
+
+            # Save service identity
+            path = self.get_service_path(origin, os.path.join('uids', '{}.json'.format(uid)))
+            self.write_json(path, identity)
 
         # Update Cache
+        uids, _ = self.cache.peek('uid_list', origin)
         self.cache.set_service_identity(origin, uid, identity)
+        self.notify('service_data', (origin, uid))
+        if uid not in (uids or {}):
+            self.notify('uid_list', origin)
 
-        return res
+        # Update bundle, dropping values of fields which were removed
+        def update(bundle):
+            values = bundle['self'].setdefault(uid, {})
+            for field_name in set(values) - set(identity.get('fields', {})):
+                del values[field_name]
+            bundle['entries'].add(('service_data', (origin, uid)))
+
+        self.update_bundle(origin, update)
 
     def get_foreign_map(self, origin):
         "Returns the unresolved foreign map for a given origin."
 
         # Check if cache hit
         data, cache_hit = self.cache.get_foreign_map(origin)
-        if not cache_hit:
-            # Check if path exists
-            path = self.get_service_path(origin, 'foreign_map.json')
-            if not self.keybase.exists(path):
-                return None
-
-            # Read all mappings for origin
-            data = self.keybase.get_json(path)
-
-            # Update cache
-            self.cache.set_foreign_map(origin, data)
+        if not cache_hit or self.is_revalidating():
+
+            def load():
+                if self.is_consolidated():
+                    service_file = self.load_service_file(origin)
+                    return service_file['foreign_map'] if service_file is not None else None
+
+                # Read all mappings for origin, if any
+                path = self.get_service_path(origin, 'foreign_map.json')
+                data = self.read_json(path)
+                version, _ = self.cache.get_version('foreign_map', origin)
+                if data is not None:
+                    # Update cache
+                    self.cache.set_foreign_map(origin, data)
+                if self.is_revalidating() and data is None and version is not None:
+                    # The foreign map is gone, and is about to be removed from the cache by the revalidator
+                    self.update_bundle(origin)
+                elif self.is_revalidating():
+                    self.update_bundle_if_changed(origin, {('foreign_map', origin): version})
+                return data
+
+            data = self.loads.do(('foreign_map', origin), load)
+        else:
+            self.check_freshness('foreign_map', origin)
 
         return data
 
     def set_foreign_map(self, origin, foreign_map):
         "Returns the unresolved foreign map for a given origin."
 
-        # Ensure that origin path exists
-        path = self.get_service_path(origin)
-        self.keybase.ensure_dir(path)
+        if self.is_consolidated():
+
+            def update(service_file):
+                service_file['foreign_map'] = foreign_map
 
-        # Save foreign map
-        path = self.get_service_path(origin, 'foreign_map.json')
-        res = self.keybase.put_file(path, json.dumps(foreign_map))
+            self.update_service_file(origin, update)
+        else:
+            # Ensure that origin path exists
+            path = self.get_service_path(origin)
+            self.keybase.ensure_dir(path)
+
+            # Save foreign map
+            path = self.get_service_path(origin, 'foreign_map.json')
+            self.write_json(path, foreign_map)
 
         # Update cache
         self.cache.set_foreign_map(origin, foreign_map)
+        self.notify('foreign_map', origin)
 
-    def resolve_foreign_map(self, origin) -> List[Dict[str, str]]:
-        "Returns a list of resolved foreign mappings for a given origin."
+    def resolve_foreign_map(self, origin):
+        """
+        Returns the resolved foreign mappings for a given origin as a dict of uid to field names to values,
+        together with a dict of usernames to the mappings which could not be resolved and why.
+        """
 
         # Read all mappings for origin
         foreign_map = self.get_foreign_map(origin)
         if foreign_map is None:
-            return {}
+            return {}, {}
 
-        # Resolve each mapping
-        resolved = {}
+        # Collect all valid mappings
+        fields = []
         for mapping in foreign_map:
             username = mapping.get('username')
             uid = mapping.get('uid')
@@ -281,8 +542,24 @@ class ParanoidManager():
             if not username or not uid or not field_name:
                 continue
 
-            # Attempt to decrypt the data file
-            value = self.decrypt_data_file(origin, uid, field_name, username=username)
+            fields.append((uid, field_name, username))
+
+        # Attempt to decrypt all data files at once, grouped by username so that each user's data files
+        # are listed once. Data files which were never written are skipped without any further calls.
+        fields.sort(key=lambda field: field[2])
+        errors = []
+        values = self.decrypt_data_files(origin, fields, errors=errors)
+
+        # Resolve each mapping, collecting failures by username
+        resolved = {}
+        failures = {}
+        for (uid, field_name, username), value, error in zip(fields, values, errors):
+            if error is not None:
+                failures.setdefault(username, []).append({
+                    'uid': uid,
+                    'field_name': field_name,
+                    'error': error,
+                })
             if value is None:
                 continue
 
@@ -291,83 +568,245 @@ class ParanoidManager():
                 resolved[uid] = {}
             resolved[uid][field_name] = value
 
-        return resolved
+        return resolved, failures
+
+    def get_foreign_map_index(self, origin):
+        "Returns the (uid, field_name, username) triples in the foreign map for a given origin, as an insertion-ordered set."
+        foreign_map = self.get_foreign_map(origin)
+        index, cache_hit = self.cache.get_foreign_map_index(origin)
+        if not cache_hit:
+            index = ParanoidCache.index_foreign_map(foreign_map or [])
+        return index
 
     def add_foreign_map(self, origin, uid, field_name, username):
         "Adds a new foreign map for a given origin."
+        self.update_foreign_map(origin, add=[(uid, field_name, username)])
 
-        # Get existing foreign map
-        foreign_map = self.get_foreign_map(origin)
-        if foreign_map is None:
-            foreign_map = []
+    def remove_foreign_map(self, origin, uid, field_name, username):
+        "Removes a new foreign map for a given origin."
+        self.update_foreign_map(origin, remove=[(uid, field_name, username)])
 
-        # Check if <uid, field_name, username> already exists in foreign map,
-        # at the same time clean up any invalid entries
-        new_map = []
-        for mapping in foreign_map:
-            map_username = mapping.get('username')
-            map_uid = mapping.get('uid')
-            map_field_name = mapping.get('field_name')
+    def update_foreign_map(self, origin, add=(), remove=()):
+        """
+        Adds and removes lists of (uid, field_name, username) mappings for a given origin, with a single write.
+        Raises ParanoidException without writing anything if any of the mappings to remove does not exist.
+        """
+
+        with self.foreign_map_lock:
+            # Get existing mappings, where any invalid entries are cleaned up
+            if self.get_foreign_map(origin) is None and remove:
+                raise ParanoidException('Foreign map does not exist for origin: {}'.format(origin))
+            index = self.get_foreign_map_index(origin)
+
+            # Check that all mappings to be removed exist first
+            for uid, field_name, username in remove:
+                if (uid, field_name, username) not in index:
+                    raise ParanoidException('Mapping does not exist for ({}, {}, {})'.format(uid, field_name, username))
+
+            changed = False
+            for triple in map(tuple, remove):
+                if triple in index:
+                    del index[triple]
+                    changed = True
+            for triple in map(tuple, add):
+                if triple not in index:
+                    index[triple] = None
+                    changed = True
+
+            # Nothing to do if all mappings to be added already exist
+            if not changed:
+                return
+
+            # Write the mapping to file
+            self.set_foreign_map(origin, [{
+                'username': username,
+                'uid': uid,
+                'field_name': field_name,
+            } for uid, field_name, username in index])
+
+            # New mappings need to be resolved, so rebuild the bundle on the next read
+            self.update_bundle(origin)
+
+    def get_bundle(self, origin):
+        """
+        Returns the merged uid -> field name -> value map of both our own and foreign identities for an origin,
+        together with the foreign mappings which could not be resolved (as for resolve_foreign_map).
 
-            if not map_username or not map_uid or not map_field_name:
+        The result is kept as a view per origin, which is updated by every write to the origin, and is only
+        built from the cache (or KBFS) on the first read.
+        """
+        with self.bundle_lock:
+            bundle = self.bundles.get(origin)
+
+        if bundle is None:
+            bundle = self.loads.do(('bundle', origin), self.load_bundle, origin)
+        else:
+            self.check_freshness('bundle', origin)
+
+        with self.bundle_lock:
+            # Foreign values take precedence over our own
+            merged = {uid: dict(values) for uid, values in bundle['self'].items()}
+            for uid, values in bundle['foreign'].items():
+                merged.setdefault(uid, {}).update(values)
+
+            return merged, bundle['errors']
+
+    def load_bundle(self, origin):
+        "Builds the view of an origin for get_bundle."
+        with self.bundle_lock:
+            generation = self.bundle_generations.get(origin, 0)
+
+        # Read our own identities, and decrypt all of their values at once
+        entries = {('uid_list', origin), ('foreign_map', origin)}
+        own = {}
+        fields = []
+        for uid in self.get_service_uids(origin):
+            identity = self.get_service_identity(origin, uid)
+            if identity is None:
                 continue
 
-            # Bail early if mapping already exists, nothing to do
-            if map_username == username and map_uid == uid and map_field_name == field_name:
-                return
+            own[uid] = {}
+            entries.add(('service_data', (origin, uid)))
+            fields += [(uid, field_name, None) for field_name in identity.get('fields', {})]
 
-            new_map.append({
-                'username': map_username,
-                'uid': map_uid,
-                'field_name': map_field_name,
-            })
+        for (uid, field_name, username), value in zip(fields, self.decrypt_data_files(origin, fields)):
+            entries.add(('decrypted_data_file', (origin, uid, field_name, username)))
+            if value is not None:
+                own[uid][field_name] = value
 
-        # Finally add the mapping
-        new_map.append({
-            'username': username,
-            'uid': uid,
-            'field_name': field_name,
-        })
+        # Resolve foreign identities
+        foreign, errors = self.resolve_foreign_map(origin)
+        for uid, field_name, username in self.get_foreign_map_index(origin):
+            entries.add(('decrypted_data_file', (origin, uid, field_name, username)))
 
-        # Write the mapping to file
-        self.set_foreign_map(origin, new_map)
+        bundle = {'self': own, 'foreign': foreign, 'errors': errors, 'entries': entries}
 
-    def remove_foreign_map(self, origin, uid, field_name, username):
-        "Removes a new foreign map for a given origin."
+        # Keep the view, unless the origin was written to in the meantime (or the cache is disabled)
+        with self.bundle_lock:
+            if not self.disable_cache and self.bundle_generations.get(origin, 0) == generation:
+                self.bundles[origin] = bundle
 
-        # Get existing foreign map
-        foreign_map = self.get_foreign_map(origin)
-        if foreign_map is None:
-            raise ParanoidException('Foreign map does not exist for origin: {}'.format(origin))
+        return bundle
 
-        # Check if <uid, field_name, username> already exists in foreign map,
-        # at the same time clean up any invalid entries
-        found = False
-        new_map = []
-        for mapping in foreign_map:
-            map_username = mapping.get('username')
-            map_uid = mapping.get('uid')
-            map_field_name = mapping.get('field_name')
+    def update_bundle_if_changed(self, origin, versions):
+        "Drops the view of an origin for get_bundle if any cache entry no longer has the version given in versions."
+        if any(self.cache.get_version(section, key)[0] != version for (section, key), version in versions.items()):
+            self.update_bundle(origin)
 
-            if not map_username or not map_uid or not map_field_name:
-                continue
+    def update_bundle(self, origin, update=None):
+        "Applies a change to the view of an origin for get_bundle, if any. If update is None, the view is dropped instead."
+        with self.bundle_lock:
+            self.bundle_generations[origin] = self.bundle_generations.get(origin, 0) + 1
+            if origin not in self.bundles:
+                return
 
-            if map_username == username and map_uid == uid and map_field_name == field_name:
-                found = True
-                continue
+            if update is None:
+                del self.bundles[origin]
+            else:
+                update(self.bundles[origin])
+
+    def get_format_version(self):
+        "Returns the storage format of services, from the format marker (or FORMAT_SPLIT if there is none)."
+        if self.format_version is None:
+            marker = self.read_json(self.keybase.get_private(FORMAT_FILENAME))
+            version = marker.get('version', FORMAT_SPLIT) if marker is not None else FORMAT_SPLIT
+            if version not in (FORMAT_SPLIT, FORMAT_CONSOLIDATED):
+                raise ParanoidException('Unsupported storage format version: {}'.format(version))
+            self.format_version = version
 
-            new_map.append({
-                'username': map_username,
-                'uid': map_uid,
-                'field_name': map_field_name,
-            })
+        return self.format_version
 
-        # If mapping was not found, throw an error
-        if not found:
-            raise ParanoidException('Mapping does not exist for ({}, {}, {})'.format(uid, field_name, username))
+    def set_format_version(self, version):
+        "Updates the format marker. Services must already be stored in the given format."
+        self.write_json(self.keybase.get_private(FORMAT_FILENAME), {'version': version})
+        self.format_version = version
 
-        # Write the mapping to file
-        return self.set_foreign_map(origin, new_map)
+    def is_consolidated(self):
+        return self.get_format_version() == FORMAT_CONSOLIDATED
+
+    def load_service_file(self, origin):
+        """
+        Reads the consolidated file of a service, and updates the cache for all of its info, foreign map and
+        identities at once. Returns None if the service does not exist.
+        """
+
+        def load():
+            data = self.read_json(self.get_service_file_path(origin))
+            if data is None:
+                return None
+
+            # Update cache, noting the versions of the entries behind the bundle of the origin beforehand
+            uids, _ = self.cache.peek('uid_list', origin)
+            entries = [('uid_list', origin), ('foreign_map', origin)]
+            entries += [('service_data', (origin, uid)) for uid in dict.fromkeys(list(uids or []) + list(data['uids']))]
+            versions = {(section, key): self.cache.get_version(section, key)[0] for section, key in entries}
+
+            self.cache.set_service(origin, data['info'])
+            self.cache.set_service_uids(origin, list(data['uids']))
+            for uid, identity in data['uids'].items():
+                self.cache.set_service_identity(origin, uid, identity)
+            if data['foreign_map'] is not None:
+                self.cache.set_foreign_map(origin, data['foreign_map'])
+
+            if self.is_revalidating():
+                self.update_bundle_if_changed(origin, versions)
+            return data
+
+        return self.loads.do(('service_file', origin), load)
+
+    def update_service_file(self, origin, update):
+        "Applies a change to the consolidated file of a service, and writes it back."
+        with self.service_file_lock:
+            service_file = self.dump_service(origin)
+            update(service_file)
+            self.write_json(self.get_service_file_path(origin), service_file)
+
+    def dump_service(self, origin):
+        "Returns the info, foreign map and identities of a service, in the format of a consolidated service file."
+        identities = {}
+        for uid in self.get_service_uids(origin):
+            identity = self.get_service_identity(origin, uid)
+            if identity is not None:
+                identities[uid] = identity
+
+        return {
+            'info': self.get_service(origin),
+            'foreign_map': self.get_foreign_map(origin),
+            'uids': identities,
+        }
+
+    def get_service_file_path(self, origin):
+        "Returns the path of the consolidated file of a service."
+        filename = ParanoidManager.origin_key_to_filename(origin)
+        return self.keybase.get_private(os.path.join('services', filename + '.json'))
+
+    def read_json(self, path):
+        "Reads a metadata file, including writes that are still in the journal. Returns None if it does not exist."
+        if self.journal is not None:
+            data = self.journal.get_file(path)
+            if data is not None:
+                return json.loads(data)
+
+        if not self.keybase.exists(path):
+            return None
+        return self.keybase.get_json(path)
+
+    def write_json(self, path, data):
+        "Writes a metadata file, through the journal if enabled."
+        if self.journal is not None:
+            self.journal.put_file(path, json.dumps(data))
+        else:
+            self.keybase.put_file(path, json.dumps(data))
+
+    def list_metadata_dir(self, path, filter=None):
+        "Lists a metadata directory, including files that are still in the journal."
+        fnames = self.keybase.list_dir(path, filter)
+        if self.journal is not None:
+            pending = self.journal.list_pending(path)
+            if filter is not None:
+                pending = fnmatch.filter(pending, filter)
+            fnames += [fname for fname in pending if fname not in fnames]
+        return fnames
 
     def validate_field_name(self, identity, field_name):
         "Validates a field name for a service identity."
@@ -380,58 +819,469 @@ class ParanoidManager():
 
     def decrypt_data_file(self, origin, uid, field_name, username=None):
         "Decrypts a data file."
+        return self.decrypt_data_files(origin, [(uid, field_name, username)])[0]
 
-        # Check if cache hit
-        data, cache_hit = self.cache.decrypt_data_file(origin, uid, field_name)
-        if not cache_hit:
-            # Construct field tuple <origin, uid, field_name>
-            field_tuple = (origin, uid, field_name)
-            field_hash = self.get_field_hash(field_tuple)
-
-            # Check if data file exists
-            data_path = self.keybase.get_public(os.path.join('ids', field_hash), username=username)
-            if not self.keybase.exists(data_path):
-                return None
-
-            # Attempt to decrypt the data file
-            data = self.keybase.decrypt(data_path)
-            if data is None:
-                return None
+    def decrypt_data_files(self, origin, fields, errors=None):
+        """
+        Decrypts multiple data files for an origin at once, given a list of (uid, field_name, username) tuples.
+        Returns a list of decrypted values in the same order, with None for data files that could not be decrypted.
+        If a list is passed as errors, it is filled with an error message for each data file that exists but
+        could not be decrypted, or None.
+        """
 
-            # Update cache
-            self.cache.encrypt_data_file(origin, uid, field_name, data)
+        # Check for cache hits first
+        values = [None] * len(fields)
+        if errors is not None:
+            errors[:] = [None] * len(fields)
+        misses = []
+        for i, (uid, field_name, username) in enumerate(fields):
+            data, cache_hit = self.cache.decrypt_data_file(origin, uid, field_name, username=username)
+            if cache_hit and not self.is_revalidating():
+                values[i] = data
+                self.check_freshness('decrypted_data_file', (origin, uid, field_name, username))
+            else:
+                misses.append(i)
+
+        if not misses:
+            return values
+
+        # Load the remaining data files, waiting for those which are already being loaded by another thread
+        loading = []
+        waiting = []
+        for i in misses:
+            key = ('decrypted_data_file', (origin, ) + tuple(fields[i]))
+            call, leader = self.loads.begin(key)
+            (loading if leader else waiting).append((i, key, call))
+
+        try:
+            loaded = self.load_data_files(origin, [fields[i] for i, _, _ in loading])
+        except Exception as e:
+            for _, key, _ in loading:
+                self.loads.finish(key, error=e)
+            raise
+
+        for (i, key, _), result in zip(loading, loaded):
+            self.loads.finish(key, result)
+        results = [(i, result) for (i, _, _), result in zip(loading, loaded)]
+        results += [(i, call.wait()) for i, _, call in waiting]
+
+        for i, (data, error) in results:
+            values[i] = data
+            if errors is not None:
+                errors[i] = error
+
+        return values
+
+    def load_data_files(self, origin, fields):
+        """
+        Decrypts multiple data files for an origin from KBFS, skipping the cache, and updates the cache.
+        Returns a list of (value, error) tuples, as for decrypt_data_files.
+        """
+        values = [None] * len(fields)
+        errors = [None] * len(fields)
+
+        # Get the data files of each user once (concurrently), to skip missing data files
+        usernames = list(dict.fromkeys(username for _, _, username in fields))
+        wanted = {}
+        for uid, field_name, username in fields:
+            wanted.setdefault(username, set()).add(self.get_field_hash((origin, uid, field_name)))
+        filenames = {}
+        for username, (listing, error) in zip(usernames, self.get_data_filenames_many(usernames, wanted)):
+            filenames[username] = listing or set()
+            if error is not None:
+                for i, (_, _, field_username) in enumerate(fields):
+                    if field_username == username:
+                        errors[i] = 'Could not list data files: {}'.format(error)
+
+        # Sort the data files by format
+        legacy = []
+        sealed = []
+        for i in range(len(fields)):
+            uid, field_name, username = fields[i]
+            field_hash = self.get_field_hash((origin, uid, field_name))
+            if field_hash + KEY_SUFFIX in filenames[username]:
+                sealed.append(i)
+            elif field_hash in filenames[username]:
+                legacy.append(i)
+
+        # Decrypt legacy data files and data keys in a single batch, then read the sealed data files
+        decrypted = self.keybase.decrypt_many([self.get_data_path(origin, *fields[i]) for i in legacy] +
+                                              [self.get_data_path(origin, *fields[i], suffix=KEY_SUFFIX) for i in sealed])
+        contents = self.keybase.get_many([self.get_data_path(origin, *fields[i]) for i in sealed])
+
+        for i, (data, error) in zip(legacy, decrypted):
+            if error is None:
+                values[i] = data
+            else:
+                errors[i] = 'Could not decrypt data file: {}'.format(error)
+
+        keys = decrypted[len(legacy):]
+        for attempt in range(UNSEAL_ATTEMPTS):
+            retry = []
+            for i, (key, key_error), (sealed_data, error) in zip(sealed, keys, contents):
+                errors[i] = None
+                if key_error is not None:
+                    errors[i] = 'Could not decrypt data key: {}'.format(key_error)
+                    continue
+                if error is not None:
+                    errors[i] = 'Could not read data file: {}'.format(error)
+                    continue
+
+                uid, field_name, username = fields[i]
+                try:
+                    values[i] = envelope.unseal(envelope.decode_key(key), sealed_data,
+                                                self.get_field_hash((origin, uid, field_name)))
+                except envelope.EnvelopeKeyMismatchException as e:
+                    errors[i] = 'Could not decrypt data file: {}'.format(e)
+                    retry.append(i)
+                except envelope.EnvelopeException as e:
+                    errors[i] = 'Could not decrypt data file: {}'.format(e)
+
+            # The data key and data file were read from different writes, while the field was being rewritten
+            sealed = retry
+            if not sealed or attempt == UNSEAL_ATTEMPTS - 1:
+                break
+            time.sleep(UNSEAL_RETRY_DELAY)
+            keys = self.keybase.decrypt_many(
+                [self.get_data_path(origin, *fields[i], suffix=KEY_SUFFIX) for i in sealed])
+            contents = self.keybase.get_many([self.get_data_path(origin, *fields[i]) for i in sealed])
 
-        return data
+        # Update cache
+        entries = [('decrypted_data_file', (origin, ) + tuple(field)) for field in fields]
+        versions = {(section, key): self.cache.get_version(section, key)[0] for section, key in entries}
+        for i in range(len(fields)):
+            uid, field_name, username = fields[i]
+            if values[i] is not None:
+                self.cache.encrypt_data_file(origin, uid, field_name, values[i], username=username)
+            elif errors[i] is None:
+                self.cache.set_missing_data_file(origin, uid, field_name, username=username)
+            elif self.is_revalidating():
+                self.cache.remove_data_file(origin, uid, field_name, username=username)
+
+        # Values may have changed since the bundle of the origin was built
+        if self.is_revalidating():
+            self.update_bundle_if_changed(origin, versions)
+
+        return list(zip(values, errors))
 
     def encrypt_data_file(self, origin, uid, field_name, data, shared_users):
-        "Encrypts a data file with a new list of shared users."
+        "Encrypts a data file under a new data key, with the data key encrypted for a list of shared users."
 
         # Construct field tuple <origin, uid, field_name>
         field_tuple = (origin, uid, field_name)
         field_hash = self.get_field_hash(field_tuple)
 
-        # If shared users is an empty list, add own username to prevent error
-        if not shared_users:
-            shared_users = [self.keybase.get_username()]
+        # Write the data key first, so that the data file is left untouched if any of the users is invalid.
+        # Readers which get the new data key with the old data file in between read both again (see envelope.py).
+        key = envelope.generate_key()
+        self.keybase.encrypt(self.get_data_path(origin, uid, field_name, suffix=KEY_SUFFIX), envelope.encode_key(key),
+                             self.get_recipients(shared_users))
 
-        # Write to the file encrypted for the list of users
-        path = self.keybase.get_public(os.path.join('ids', field_hash))
-        self.keybase.encrypt(path, data, shared_users)
+        # Write the data file sealed with the data key, then record the new version in the manifest
+        sealed_data = envelope.seal(key, data, field_hash)
+        self.keybase.put_file(self.get_data_path(origin, uid, field_name), sealed_data)
+        self.update_manifest(field_hash, len(sealed_data.encode('utf-8')))
 
         # Update cache
         self.cache.encrypt_data_file(origin, uid, field_name, data)
+        self.notify('decrypted_data_file', (origin, uid, field_name, None))
+
+        # Update bundle
+        def update(bundle):
+            bundle['self'].setdefault(uid, {})[field_name] = data
+            bundle['entries'].add(('decrypted_data_file', (origin, uid, field_name, None)))
+
+        self.update_bundle(origin, update)
 
     def reencrypt_data_file(self, origin, uid, field_name, shared_users):
-        "Re-encrypts a data file with a new list of shared users."
+        """
+        Re-encrypts a data file with a new list of shared users.
+
+        For data files in the envelope format, only the data key is re-encrypted. Every new value is sealed
+        under a new data key, so users who are removed cannot decrypt any values written after their removal.
+        Legacy data files are rewritten in the envelope format.
+        """
+
+        # Let interactive requests go first
+        with self.keybase.priority(PRIORITY_REENCRYPT):
+            key_path = self.get_data_path(origin, uid, field_name, suffix=KEY_SUFFIX)
+            if self.keybase.exists(key_path):
+                key = self.keybase.decrypt(key_path)
+                if key is None:
+                    raise ParanoidException('Could not decrypt data key for {}:{}:{}'.format(origin, uid, field_name))
+
+                # Re-encrypt only the data key with the new list of shared users
+                self.keybase.encrypt(key_path, key, self.get_recipients(shared_users))
+                return
+
+            # Fetch existing data
+            data = self.decrypt_data_file(origin, uid, field_name)
+            if data is None:
+                raise ParanoidException('Could not locate data file for {}:{}:{}'.format(origin, uid, field_name))
+
+            # Re-encrypt the file with the new list of shared users
+            self.encrypt_data_file(origin, uid, field_name, data, shared_users)
+
+    def update_shares(self, origin, uid, field_names, usernames, share=True):
+        """
+        Shares (or unshares) a list of fields of a service identity with a list of users at once.
+
+        Each field whose list of shared users changes is re-encrypted once, and the identity metadata is
+        written once for all fields which were re-encrypted. Users who already have (or do not have) access to
+        a field are skipped. Returns (shared, errors), where shared is a dict of usernames to the fields shared
+        with them, and errors is a dict of field names to the reason that they could not be re-encrypted. If
+        none of the fields could be re-encrypted, the first error is raised instead.
+        """
+
+        # Read service identity, without changing the cached copy until it has been written
+        info = self.get_service_identity(origin, uid)
+        if info is None:
+            raise ParanoidException('Service identity does not exist for {}:{}'.format(origin, uid))
+        info = copy.deepcopy(info)
+
+        for field_name in field_names:
+            self.validate_field_name(info, field_name)
+
+        # Re-encrypt each field with its new list of shared users. Fields without a value yet only need their
+        # metadata updated, since values are encrypted for the shared users in the metadata when written.
+        filenames = self.get_data_filenames(wanted={self.get_field_hash((origin, uid, field_name))
+                                                    for field_name in field_names})
+        changed = {}
+        errors = {}
+        first_error = None
+        for field_name in dict.fromkeys(field_names):
+            shared_users = info['fields'][field_name].get('shared_with', [])
+            if share:
+                new_users = [username for username in dict.fromkeys(usernames) if username not in shared_users]
+                new_shared_users = shared_users + new_users
+            else:
+                new_users = [username for username in dict.fromkeys(usernames) if username in shared_users]
+                new_shared_users = [username for username in shared_users if username not in new_users]
+            if not new_users:
+                continue
+
+            field_hash = self.get_field_hash((origin, uid, field_name))
+            try:
+                if field_hash in filenames or field_hash + KEY_SUFFIX in filenames:
+                    self.reencrypt_data_file(origin, uid, field_name, new_shared_users)
+            except Exception as e:
+                # Carry on with the other fields, leaving the metadata of this one as it was
+                errors[field_name] = str(e)
+                first_error = first_error or e
+                continue
+
+            info['fields'][field_name]['shared_with'] = new_shared_users
+            changed[field_name] = new_users
 
-        # Fetch existing data
-        data = self.decrypt_data_file(origin, uid, field_name)
+        # Update the identity metadata for all fields which were re-encrypted
+        if changed:
+            self.set_service_identity(origin, uid, info)
+        elif first_error is not None:
+            raise first_error
+
+        shared = {}
+        for field_name, new_users in changed.items():
+            for username in new_users:
+                shared.setdefault(username, []).append(field_name)
+        return shared, errors
+
+    def migrate_data_file(self, origin, uid, field_name, shared_users):
+        "Rewrites a legacy data file in the envelope format. Returns True if the data file was migrated."
+
+        field_hash = self.get_field_hash((origin, uid, field_name))
+        filenames = self.get_data_filenames(wanted={field_hash})
+        if field_hash not in filenames or field_hash + KEY_SUFFIX in filenames:
+            return False
+
+        data = self.keybase.decrypt(self.get_data_path(origin, uid, field_name))
         if data is None:
-            raise ParanoidException('Could not locate data file for {}:{}:{}'.format(origin, uid, field_name))
+            raise ParanoidException('Could not decrypt data file for {}:{}:{}'.format(origin, uid, field_name))
 
-        # Re-encrypt the file with the new list of shared users
         self.encrypt_data_file(origin, uid, field_name, data, shared_users)
+        return True
+
+    def get_recipients(self, shared_users):
+        "Returns the list of users to encrypt for, given a list of shared users."
+
+        # If shared users is an empty list, add own username to prevent error
+        if not shared_users:
+            return [self.keybase.get_username()]
+        return shared_users
+
+    def get_data_path(self, origin, uid, field_name, username=None, suffix=''):
+        "Returns the path of a data file (or a file next to it with a suffix) for a user, defaulting to our own."
+        field_hash = self.get_field_hash((origin, uid, field_name))
+        return self.keybase.get_public(os.path.join('ids', field_hash + suffix), username=username)
+
+    def get_data_filenames(self, username=None, wanted=None):
+        "Returns the set of data filenames for a user, from the manifest or a recent listing if possible."
+        listing, error = self.get_data_filenames_many([username], {username: wanted or set()})[0]
+        if error is not None:
+            raise error
+        return listing
+
+    def get_data_filenames_many(self, usernames, wanted=None):
+        """
+        Returns the sets of data filenames for multiple users, as a list of (filenames, error) tuples in the
+        same order. Data files are taken from the manifest of each user, or from a directory listing for users
+        without an up-to-date manifest.
+
+        wanted may be a dict of usernames to the data filenames that the caller is looking for. If the storage
+        backend cannot tell whether a manifest is up to date, users whose manifest lacks any of those are
+        listed as well, so that data files are never reported missing by the manifest alone.
+        """
+        wanted = wanted or {}
+        manifests = self.get_manifests(usernames)
+        results = []
+        for username in usernames:
+            result = None
+            if manifests[username]:
+                filenames = ParanoidManager.manifest_filenames(manifests[username])
+                stale = self.is_manifest_stale(username)
+                if stale is False or (stale is None and wanted.get(username, set()) <= filenames):
+                    result = (filenames, None)
+            results.append(result)
+
+        # Fall back to listing the ids directory of users without an up-to-date manifest (concurrently)
+        missing = [i for i, result in enumerate(results) if result is None]
+        listings = self.keybase.list_many([self.keybase.get_public('ids', username=usernames[i]) for i in missing])
+        for i, (listing, error) in zip(missing, listings):
+            results[i] = (set(listing) if listing is not None else None, error)
+
+        return results
+
+    def get_manifests(self, usernames, fresh=False):
+        """
+        Returns a dict of usernames (None for our own) to their manifest, or None for users without one.
+        Manifests are fetched at most once per metadata TTL, unless fresh is True.
+        """
+        now = time.monotonic()
+        manifests = {}
+        with self.manifest_lock:
+            for username in usernames:
+                fetched_at, manifest = self.manifests.get(username, (None, None))
+                if not fresh and fetched_at is not None and now - fetched_at < self.keybase.metadata.ttl:
+                    manifests[username] = manifest
+
+        # Fetch the remaining manifests concurrently
+        fetch = [username for username in dict.fromkeys(usernames) if username not in manifests]
+        contents = self.keybase.get_many([self.keybase.get_public(MANIFEST_FILENAME, username=username)
+                                          for username in fetch])
+        for username, (data, error) in zip(fetch, contents):
+            try:
+                manifests[username] = json.loads(data) if data else None
+            except ValueError:
+                manifests[username] = None
+
+            with self.manifest_lock:
+                self.manifests[username] = (now, manifests[username])
+
+        return manifests
+
+    def is_manifest_stale(self, username=None):
+        """
+        Returns True if a user's ids directory was modified after their manifest, or None if the storage
+        backend does not report modification times.
+        """
+        try:
+            manifest_mtime = self.keybase.get_mtime(self.keybase.get_public(MANIFEST_FILENAME, username=username))
+            ids_mtime = self.keybase.get_mtime(self.keybase.get_public('ids', username=username))
+        except KeybaseFileNotFoundException:
+            return False
+        if manifest_mtime is None or ids_mtime is None:
+            return None
+        return manifest_mtime < ids_mtime
+
+    def update_manifest(self, field_hash, size):
+        """
+        Records a new version of one of our own data files in our manifest. The manifest is written directly
+        rather than through the journal, so that it is never older than the data files it lists.
+        """
+        with self.manifest_write_lock:
+            # Read the manifest afresh, since other daemons of the same user may have written it meanwhile
+            manifest = self.get_manifests([None], fresh=True)[None] or self.build_manifest()
+            manifest = copy.deepcopy(manifest)
+
+            entry = manifest['ids'].get(field_hash, {})
+            manifest['ids'][field_hash] = {
+                'version': entry.get('version', 0) + 1,
+                'size': size,
+                'format': 'envelope',
+            }
+
+            self.keybase.put_file(self.keybase.get_public(MANIFEST_FILENAME), json.dumps(manifest))
+            with self.manifest_lock:
+                self.manifests[None] = (time.monotonic(), manifest)
+
+    def ensure_manifest(self):
+        """
+        Creates our manifest from the ids directory if it does not exist yet, or reconciles it with the ids
+        directory otherwise, e.g. if data files were written by an older version or the manifest lost a race
+        with another daemon. Returns True if the manifest was written.
+        """
+        with self.manifest_write_lock:
+            existing = self.get_manifests([None], fresh=True)[None]
+            manifest = self.build_manifest()
+            if existing is not None:
+                # Keep the versions of data files which did not change format, and bump the others
+                for field_hash, entry in manifest['ids'].items():
+                    existing_entry = existing.get('ids', {}).get(field_hash)
+                    if existing_entry is not None and existing_entry.get('format') == entry['format']:
+                        manifest['ids'][field_hash] = existing_entry
+                    elif existing_entry is not None:
+                        entry['version'] = existing_entry.get('version', 0) + 1
+                manifest = dict(existing, ids=manifest['ids'])
+                if manifest == existing:
+                    return False
+
+            self.keybase.put_file(self.keybase.get_public(MANIFEST_FILENAME), json.dumps(manifest))
+            with self.manifest_lock:
+                self.manifests[None] = (time.monotonic(), manifest)
+            return True
+
+    def build_manifest(self):
+        "Returns a manifest of our own data files, from a listing of the ids directory."
+        try:
+            filenames = set(self.keybase.list_dir(self.keybase.get_public('ids')))
+        except KeybaseFileNotFoundException:
+            filenames = set()
+
+        manifest = {'ids': {}}
+        for filename in sorted(filenames):
+            if filename.endswith(KEY_SUFFIX):
+                continue
+            sealed = filename + KEY_SUFFIX in filenames
+            manifest['ids'][filename] = {
+                'version': 1,
+                'size': None,
+                'format': 'envelope' if sealed else 'legacy',
+            }
+        return manifest
+
+    def get_data_versions(self, username=None):
+        "Returns a dict of data filenames (including key files) to their version from a user's manifest, or None if they have none."
+        manifest = self.get_manifests([username], fresh=True)[username]
+        if manifest is None or self.is_manifest_stale(username) is True:
+            return None
+
+        versions = {}
+        for field_hash, entry in manifest.get('ids', {}).items():
+            versions[field_hash] = entry.get('version')
+            if entry.get('format') == 'envelope':
+                versions[field_hash + KEY_SUFFIX] = entry.get('version')
+        return versions
 
+    @staticmethod
+    def manifest_filenames(manifest):
+        "Returns the set of data filenames (including key files) listed in a manifest."
+        filenames = set()
+        for field_hash, entry in manifest.get('ids', {}).items():
+            filenames.add(field_hash)
+            if entry.get('format') == 'envelope':
+                filenames.add(field_hash + KEY_SUFFIX)
+        return filenames
+
+    @lru_cache(maxsize=4096)
     def get_field_hash(self, field_tuple):
         "Return the SHA256 hash of a <origin, uid, field_name> tuple."
         origin, uid, field_name = field_tuple
@@ -445,32 +1295,44 @@ class ParanoidManager():
         filename = ParanoidManager.origin_key_to_filename(origin)
         return self.keybase.get_private(os.path.join('services', filename, path))
 
-    def send_share_request(self, origin, uid, field_name, username):
-        "Sends a share request via Keybase chat."
+    def send_share_request(self, origin, uid, field_names, username):
+        """
+        Sends a single share request for a list of fields via Keybase chat. If the chat outbox is enabled,
+        the request is queued and sent in the background, merged with other requests to the same user.
+        """
 
         if self.disable_chat:
             return
 
-        # Create share request URL query string
-        query = urlencode({
-            'origin': origin,
-            'uid': uid,
-            'field_name': field_name,
-            'username': self.keybase.get_username(),
-        })
+        if self.outbox is not None:
+            self.outbox.put(username, origin, uid, field_names)
+            return
+
+        # Send chat message
+        requests = [{'origin': origin, 'uid': uid, 'field_names': list(field_names)}]
+        self.keybase.send_chat(username, self.format_share_request(username, requests))
+
+    def format_share_request(self, username, requests):
+        "Returns the chat message for a list of share requests to a user, each with an origin, uid and field names."
+
+        # Create share request URL query strings, with the field_name parameter repeated for each field
+        urls = []
+        for request in requests:
+            query = urlencode([('origin', request['origin']), ('uid', request['uid'])] +
+                              [('field_name', field_name) for field_name in request['field_names']] +
+                              [('username', self.keybase.get_username())])
+            urls.append('web+paranoid://share_request?{}'.format(query))
 
         # Create message text
-        text = """Hi @{}, I would like to share my information with you on Paranoid! :ghost:
+        plural = 's' if len(urls) > 1 else ''
+        return """Hi @{}, I would like to share my information with you on Paranoid! :ghost:
 
-Please copy and paste the following URL into your Paranoid-enabled browser to accept my share request, thank you! :smile:
+Please copy and paste the following URL{} into your Paranoid-enabled browser to accept my share request{}, thank you! :smile:
 
 ```
-web+paranoid://share_request?{}
+{}
 ```
-""".format(username, query)
-
-        # Send chat message
-        self.keybase.send_chat(username, text)
+""".format(username, plural, plural, '\n'.join(urls))
 
     @staticmethod
     def origin_filename_to_key(filename: str):
@@ -0,0 +1,190 @@
+"""
+Parallel cache prefetching, ordered by how often each origin is accessed.
+"""
+
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+from queue import PriorityQueue
+
+import click
+
+from keybase import PRIORITY_PREFETCH
+
+
+class AccessLog:
+    """
+    Records how often each origin is accessed, so that the most visited origins can be prefetched first.
+    Counts are saved to a local file at most every `save_interval` seconds, and on close.
+    """
+    def __init__(self):
+        self.path = None
+        self.save_interval = 30
+        self.counts = {}
+        self.dirty = False
+        self.last_saved = time.monotonic()
+        self.lock = threading.Lock()
+
+    def init(self, path=None, save_interval=30):
+        "Loads previously saved counts from the given path, if any."
+        self.path = path
+        self.save_interval = save_interval
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.counts = json.load(f)
+            except ValueError:
+                self.counts = {}
+
+    def record(self, origin):
+        "Records an access to an origin."
+        with self.lock:
+            self.counts[origin] = self.counts.get(origin, 0) + 1
+            self.dirty = True
+            if time.monotonic() - self.last_saved >= self.save_interval:
+                self._save()
+
+    def rank(self, origins):
+        "Sorts origins by their number of accesses, most accessed first."
+        with self.lock:
+            return sorted(origins, key=lambda origin: -self.counts.get(origin, 0))
+
+    def close(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        self.last_saved = time.monotonic()
+        if self.path is None or not self.dirty:
+            return
+
+        os.makedirs(os.path.dirname(self.path) or '.', mode=0o700, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.counts, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+class Prefetcher:
+    """
+    Prefetches all services, identities and data files into the cache using a pool of worker threads.
+
+    Work for more frequently accessed origins is always picked up first, including work that is
+    discovered along the way (e.g. the identities of an origin). Keybase commands are issued with
+    prefetch priority, so that they do not hold up interactive requests.
+    """
+    def __init__(self, paranoid, access_log):
+        self.paranoid = paranoid
+        self.access_log = access_log
+        self.workers = 4
+        self.foreign_maps = False
+        self.revalidate = False
+        self.queue = None
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.progress = {
+            'state': 'idle',
+            'total': 0,
+            'done': 0,
+            'failed': 0,
+            'started_at': None,
+            'finished_at': None,
+        }
+
+    def init(self, workers=4, foreign_maps=False):
+        self.workers = workers
+        self.foreign_maps = foreign_maps
+
+    def run(self, revalidate=False):
+        "Prefetches everything, and blocks until done. If revalidate is True, cached entries are refreshed from KBFS."
+        with self.lock:
+            self.revalidate = revalidate
+            self.queue = PriorityQueue()
+            self.progress.update(state='running', total=0, done=0, failed=0, started_at=time.time(), finished_at=None)
+
+        # Rank origins by accesses, then prefetch each of them in order
+        self._submit(-1, self._prefetch_origins)
+
+        threads = [threading.Thread(target=self._work, name='prefetch-{}'.format(i)) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        self.queue.join()
+        for _ in threads:
+            self.queue.put((float('inf'), next(self.counter), None, ()))
+        for thread in threads:
+            thread.join()
+
+        with self.lock:
+            self.progress.update(state='done', finished_at=time.time())
+
+    def status(self):
+        "Returns the progress of the current or last prefetch."
+        with self.lock:
+            status = dict(self.progress)
+
+        status['elapsed'] = None
+        status['items_per_second'] = None
+        if status['started_at'] is not None:
+            elapsed = (status['finished_at'] or time.time()) - status['started_at']
+            status['elapsed'] = round(elapsed, 3)
+            status['items_per_second'] = round(status['done'] / elapsed, 3) if elapsed > 0 else None
+
+        return status
+
+    def _submit(self, rank, fn, *args):
+        with self.lock:
+            self.progress['total'] += 1
+        self.queue.put((rank, next(self.counter), fn, args))
+
+    def _work(self):
+        revalidating = self.paranoid.revalidating() if self.revalidate else nullcontext()
+        with self.paranoid.keybase.priority(PRIORITY_PREFETCH), revalidating:
+            while True:
+                rank, _, fn, args = self.queue.get()
+                if fn is None:
+                    self.queue.task_done()
+                    return
+
+                failed = False
+                try:
+                    fn(rank, *args)
+                except Exception as e:
+                    failed = True
+                    click.secho(' * Prefetch failed for {}: {}'.format(args, e), fg='red', err=True)
+
+                with self.lock:
+                    self.progress['failed' if failed else 'done'] += 1
+                self.queue.task_done()
+
+    def _prefetch_origins(self, rank):
+        for i, origin in enumerate(self.access_log.rank(self.paranoid.get_origins())):
+            self._submit(i, self._prefetch_origin, origin)
+
+    def _prefetch_origin(self, rank, origin):
+        # Fetch the service and its foreign map
+        self.paranoid.get_service(origin)
+        self.paranoid.get_foreign_map(origin)
+        if self.foreign_maps:
+            self._submit(rank, self._prefetch_foreign_map, origin)
+
+        # Fetch all service identities
+        for uid in self.paranoid.get_service_uids(origin):
+            self._submit(rank, self._prefetch_identity, origin, uid)
+
+    def _prefetch_identity(self, rank, origin, uid):
+        info = self.paranoid.get_service_identity(origin, uid)
+        if info is None:
+            return
+
+        # Fetch all service identity fields
+        self.paranoid.decrypt_data_files(origin, [(uid, field, None) for field in info.get('fields')])
+
+    def _prefetch_foreign_map(self, rank, origin):
+        self.paranoid.resolve_foreign_map(origin)
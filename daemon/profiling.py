@@ -0,0 +1,72 @@
+"""
+Timing of daemon startup, by phase.
+
+Each phase records when it started (relative to startup), how long it took, and how many Keybase
+commands were run meanwhile. Phases in the background run after the server starts listening, so
+they only delay the cache from being warm, and commands from requests served meanwhile are counted
+towards them too.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from keybase import COMMANDS
+
+
+class StartupProfile():
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.phases = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        "Starts timing from now, discarding any phases recorded so far."
+        with self.lock:
+            self.started_at = time.monotonic()
+            self.phases = []
+
+    @contextmanager
+    def phase(self, name, background=False):
+        "Times the block as a phase of startup."
+        commands = StartupProfile.count_commands()
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, started_at, time.monotonic() - started_at, StartupProfile.count_commands() - commands,
+                     background)
+
+    def add(self, name, started_at, elapsed, commands=0, background=False):
+        with self.lock:
+            self.phases.append({
+                'name': name,
+                'started': round(started_at - self.started_at, 6),
+                'elapsed': round(elapsed, 6),
+                'commands': commands,
+                'background': background,
+            })
+
+    def elapsed(self, until=None):
+        "Returns the number of seconds from startup until a monotonic time, or until now."
+        return (until if until is not None else time.monotonic()) - self.started_at
+
+    def status(self):
+        "Returns a list of all phases recorded so far, in the order that they finished."
+        with self.lock:
+            return [dict(phase) for phase in self.phases]
+
+    def format(self):
+        "Returns a table of all phases recorded so far."
+        lines = ['   {:<34} {:>9} {:>9} {:>9}'.format('phase', 'start', 'time', 'commands')]
+        for phase in self.status():
+            name = phase['name'] + (' (background)' if phase['background'] else '')
+            lines.append('   {:<34} {:>8.3f}s {:>8.3f}s {:>9}'.format(name, phase['started'], phase['elapsed'],
+                                                                    phase['commands']))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def count_commands():
+        "Returns the total number of Keybase commands run so far."
+        with COMMANDS.lock:
+            return sum(COMMANDS.values.values())
@@ -0,0 +1,229 @@
+"""
+Cache freshness for ParanoidManager.
+
+Each cache section has its own TTL. Stale entries are still served immediately, while a
+background thread refreshes them (stale-while-revalidate).
+
+Revalidation works a directory at a time: the directory holding the files behind all queued
+entries is listed once, and only files whose modification time changed since the previous listing
+are read again. Unchanged entries are simply marked as fresh. For data files, the versions in the
+owner's manifest are compared instead of modification times. Storage backends that do not report
+modification times (i.e. the Keybase CLI) fall back to reading every other queued entry again.
+
+With the consolidated storage format, all metadata of a service is in a single file, so a single
+listing of the services directory covers every service, and each changed service is read once.
+
+Entries whose versions changed after being read again are published to the event stream (see events.py).
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import click
+
+from keybase import PRIORITY_PREFETCH, KeybaseFileNotFoundException
+
+# Default TTLs in seconds for each cache section. Data files shared by other users are tracked
+# separately from our own, since they can change without us knowing.
+DEFAULT_TTLS = {
+    'origin_list': 60,
+    'service_info': 300,
+    'uid_list': 60,
+    'service_data': 60,
+    'foreign_map': 60,
+    'decrypted_data_file': 300,
+    'foreign_data_file': 30,
+}
+
+
+class Revalidator:
+    def __init__(self, paranoid):
+        self.paranoid = paranoid
+        self.ttls = dict(DEFAULT_TTLS)
+        self.queue = OrderedDict()
+        self.mtimes = {}
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.worker = None
+
+    def init(self, ttls=None):
+        "Overrides the TTLs of some cache sections."
+        self.ttls.update(ttls or {})
+
+    def check(self, section, key=None):
+        "Queues an entry to be revalidated in the background if it is stale. Called on every cache hit."
+        ttl_section = section
+        if section == 'decrypted_data_file' and key[3] is not None:
+            ttl_section = 'foreign_data_file'
+
+        # Entries of a disabled cache (which has no ages) are never fresh
+        age = self.paranoid.cache.age(section, key)
+        if isinstance(age, (int, float)) and age < self.ttls[ttl_section]:
+            return
+
+        path = self._get_dir(section, key)
+        with self.lock:
+            self.queue.setdefault(path, set()).add((section, key))
+            self.cond.notify_all()
+
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, name='revalidator', daemon=True)
+                self.worker.start()
+
+    def revalidate_dir(self, path, entries):
+        "Revalidates entries whose files are in the given directory."
+        versions = self._get_versions(entries)
+        try:
+            self._revalidate_dir(path, entries, versions)
+        finally:
+            self._notify_changes(versions)
+
+    def _revalidate_dir(self, path, entries, versions):
+        # Sections that are listings of the directory itself are always reloaded
+        listing_sections = ('origin_list', ) if self.paranoid.is_consolidated() else ('origin_list', 'uid_list')
+        listings = [(section, key) for section, key in entries if section in listing_sections]
+        files = [(section, key) for section, key in entries if section not in listing_sections]
+        for section, key in listings:
+            self._reload(section, key)
+        if not files:
+            return
+
+        # List the directory once (or fetch the manifest for data files), and compare modification times
+        # (or versions) with the previous listing
+        mtimes = None
+        if all(section == 'decrypted_data_file' for section, _ in files):
+            mtimes = self.paranoid.get_data_versions(files[0][1][3])
+        if mtimes is None:
+            try:
+                mtimes = self.paranoid.keybase.list_dir_mtimes(path)
+            except KeybaseFileNotFoundException:
+                mtimes = {}
+
+        with self.lock:
+            previous = self.mtimes.get(path, {})
+            self.mtimes[path] = mtimes
+
+        service_files = {}
+        for section, key in files:
+            changed = False
+            for filename in self._get_filenames(section, key):
+                mtime = mtimes.get(filename)
+                if mtime is None or mtime != previous.get(filename):
+                    changed = True
+
+            if not changed:
+                self.paranoid.cache.touch(section, key)
+            elif section != 'decrypted_data_file' and self.paranoid.is_consolidated():
+                self._reload_service_file(section, key, service_files, versions)
+            else:
+                self._reload(section, key)
+
+    def _reload(self, section, key):
+        "Reads an entry from KBFS again, replacing it in the cache (or removing it if it no longer exists)."
+        paranoid = self.paranoid
+        with paranoid.revalidating():
+            if section == 'origin_list':
+                data = paranoid.get_origins()
+            elif section == 'uid_list':
+                data = paranoid.get_service_uids(key)
+            elif section == 'service_info':
+                data = paranoid.get_service(key)
+            elif section == 'foreign_map':
+                data = paranoid.get_foreign_map(key)
+            elif section == 'service_data':
+                data = paranoid.get_service_identity(*key)
+            else:
+                origin, uid, field_name, username = key
+                data = paranoid.decrypt_data_files(origin, [(uid, field_name, username)])[0]
+
+        # Data files which no longer exist are already recorded as missing by the reload
+        if data is None and section != 'decrypted_data_file':
+            paranoid.cache.invalidate(section, key)
+
+    def _reload_service_file(self, section, key, service_files, versions):
+        """
+        Reloads an entry from a consolidated service file, which is read at most once per origin in service_files.
+        The versions of all other cached entries from the file are added to versions, since they are reloaded too.
+        """
+        origin = key[0] if section == 'service_data' else key
+        if origin not in service_files:
+            uids, _ = self.paranoid.cache.peek('uid_list', origin)
+            entries = [('service_info', origin), ('uid_list', origin), ('foreign_map', origin)]
+            entries += [('service_data', (origin, uid)) for uid in list(uids or [])]
+            for entry, version in self._get_versions(entries).items():
+                versions.setdefault(entry, version)
+
+            with self.paranoid.revalidating():
+                service_files[origin] = self.paranoid.load_service_file(origin)
+
+        service_file = service_files[origin]
+        if service_file is None:
+            data = None
+        elif section == 'service_info':
+            data = service_file['info']
+        elif section == 'foreign_map':
+            data = service_file['foreign_map']
+        elif section == 'service_data':
+            data = service_file['uids'].get(key[1])
+        else:
+            data = list(service_file['uids'])
+
+        if data is None:
+            self.paranoid.cache.invalidate(section, key)
+
+    def _get_versions(self, entries):
+        "Returns a dict of (section, key) entries to their current versions."
+        return {(section, key): self.paranoid.get_version(section, key)[0] for section, key in entries}
+
+    def _notify_changes(self, versions):
+        "Publishes the entries whose versions are no longer those given by a dict of (section, key) entries to versions."
+        for (section, key), version in versions.items():
+            if self.paranoid.get_version(section, key)[0] != version:
+                self.paranoid.notify(section, key)
+
+    def _get_dir(self, section, key):
+        "Returns the directory holding the file (or listing) behind a cache entry."
+        paranoid = self.paranoid
+        if section == 'origin_list':
+            return paranoid.keybase.get_private('services')
+        if section != 'decrypted_data_file' and paranoid.is_consolidated():
+            return os.path.dirname(paranoid.get_service_file_path(key[0] if section == 'service_data' else key))
+        if section == 'uid_list':
+            return paranoid.get_service_path(key, 'uids')
+        if section in ('service_info', 'foreign_map'):
+            return os.path.normpath(paranoid.get_service_path(key))
+        if section == 'service_data':
+            return paranoid.get_service_path(key[0], 'uids')
+
+        username = key[3]
+        return paranoid.keybase.get_public('ids', username=username)
+
+    def _get_filenames(self, section, key):
+        "Returns the filenames behind a cache entry, relative to its directory."
+        if section != 'decrypted_data_file' and self.paranoid.is_consolidated():
+            origin = key[0] if section == 'service_data' else key
+            return [os.path.basename(self.paranoid.get_service_file_path(origin))]
+        if section == 'service_info':
+            return ['info.json']
+        if section == 'foreign_map':
+            return ['foreign_map.json']
+        if section == 'service_data':
+            return ['{}.json'.format(key[1])]
+
+        origin, uid, field_name, username = key
+        field_hash = self.paranoid.get_field_hash((origin, uid, field_name))
+        return [field_hash, field_hash + '.key']
+
+    def _run(self):
+        with self.paranoid.keybase.priority(PRIORITY_PREFETCH):
+            while True:
+                with self.lock:
+                    while not self.queue:
+                        self.cond.wait()
+                    path, entries = self.queue.popitem(last=False)
+
+                try:
+                    self.revalidate_dir(path, entries)
+                except Exception as e:
+                    click.secho(' * Failed to revalidate {}: {}'.format(path, e), fg='red', err=True)
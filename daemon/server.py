@@ -0,0 +1,57 @@
+"""
+Production HTTP server for the daemon, as an alternative to the Flask development server.
+
+Runs the Flask app under cheroot (the WSGI server of CherryPy), which serves requests from a fixed
+pool of threads and keeps connections open between requests, so that the extension does not pay for
+a new connection (and TLS handshake) on every request. Idle connections are watched by a selector
+instead of holding on to a thread. With TLS, all connections share a single SSL context, so clients
+can resume earlier sessions with session IDs or tickets instead of doing a full handshake.
+
+cheroot is an optional dependency, which only needs to be installed to run with `--server cheroot`.
+"""
+
+import click
+
+try:
+    from cheroot import wsgi
+    from cheroot.ssl.builtin import BuiltinSSLAdapter
+except ImportError:
+    wsgi = None
+
+SERVERS = ('dev', 'cheroot')
+
+
+def is_available(server):
+    "Returns whether the dependencies of a server are installed."
+    return server != 'cheroot' or wsgi is not None
+
+
+def run(app, server, host, port, ssl_context=None, threads=16, keep_alive_timeout=30, on_listening=None):
+    """
+    Serves a Flask app until interrupted. ssl_context is a (certificate, private key) tuple as for app.run,
+    and threads and keep_alive_timeout only apply to production servers. on_listening is called once the
+    server is bound to its port, or right before starting the development server.
+    """
+
+    if server == 'dev':
+        if on_listening is not None:
+            on_listening()
+        app.run(host=host, port=port, ssl_context=ssl_context)
+        return
+
+    httpd = wsgi.Server((host, port), app, numthreads=threads, max=threads, timeout=keep_alive_timeout,
+                        request_queue_size=64, server_name='paranoid')
+    if ssl_context is not None:
+        httpd.ssl_adapter = BuiltinSSLAdapter(*ssl_context)
+
+    click.secho(' * Running on {}://{}:{}/ (cheroot, {} threads)'.format('https' if ssl_context else 'http', host, port,
+                                                                        threads))
+    try:
+        httpd.prepare()
+        if on_listening is not None:
+            on_listening()
+        httpd.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.stop()
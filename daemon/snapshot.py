@@ -0,0 +1,101 @@
+"""
+Encrypted on-disk snapshots of the Paranoid cache, for warm restarts.
+
+The snapshot holds decrypted values, so it is encrypted with AES-GCM under a key derived with scrypt
+from a secret supplied by the user, and is only readable by the current user.
+
+File format:
+  ```
+  PARANOID CACHE SNAPSHOT V1
+  {"salt": "...", "nonce": "...", "tag": "...", "ciphertext": "..."}
+  ```
+"""
+
+import base64
+import json
+import os
+import threading
+
+import click
+from Crypto.Cipher import AES
+from Crypto.Protocol.KDF import scrypt
+from Crypto.Random import get_random_bytes
+
+SNAPSHOT_HEADER = 'PARANOID CACHE SNAPSHOT V1\n'
+
+
+class SnapshotException(Exception):
+    pass
+
+
+class CacheSnapshot:
+    def __init__(self, cache, path, secret, interval=300):
+        self.cache = cache
+        self.path = path
+        self.secret = secret.encode('utf-8')
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.writer = threading.Thread(target=self._run, name='cache-snapshot', daemon=True)
+
+    def load(self):
+        "Loads the snapshot into the cache. Returns False if there is no snapshot."
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path) as f:
+            contents = f.read()
+        if not contents.startswith(SNAPSHOT_HEADER):
+            raise SnapshotException('Malformed cache snapshot: {}'.format(self.path))
+
+        try:
+            sealed = json.loads(contents[len(SNAPSHOT_HEADER):])
+            key = self._derive_key(base64.b64decode(sealed['salt']))
+            cipher = AES.new(key, AES.MODE_GCM, nonce=base64.b64decode(sealed['nonce']))
+            data = cipher.decrypt_and_verify(base64.b64decode(sealed['ciphertext']), base64.b64decode(sealed['tag']))
+        except (ValueError, KeyError, TypeError):
+            raise SnapshotException('Could not decrypt cache snapshot, was the secret changed?')
+
+        self.cache.load(json.loads(data.decode('utf-8')))
+        return True
+
+    def save(self):
+        "Writes the contents of the cache to the snapshot."
+        data = json.dumps(self.cache.dump()).encode('utf-8')
+
+        salt = get_random_bytes(16)
+        cipher = AES.new(self._derive_key(salt), AES.MODE_GCM)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+
+        os.makedirs(os.path.dirname(self.path) or '.', mode=0o700, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(SNAPSHOT_HEADER)
+            json.dump({
+                'salt': base64.b64encode(salt).decode('ascii'),
+                'nonce': base64.b64encode(cipher.nonce).decode('ascii'),
+                'tag': base64.b64encode(tag).decode('ascii'),
+                'ciphertext': base64.b64encode(ciphertext).decode('ascii'),
+            }, f)
+        os.replace(tmp_path, self.path)
+
+    def start(self):
+        "Starts writing snapshots periodically in the background."
+        self.writer.start()
+
+    def close(self):
+        "Stops the background writer, and writes a final snapshot."
+        self.stopped.set()
+        if self.writer.is_alive():
+            self.writer.join()
+        self.save()
+
+    def _derive_key(self, salt):
+        return scrypt(self.secret, salt, 32, N=2**15, r=8, p=1)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.save()
+            except Exception as e:
+                click.secho(' * Failed to write cache snapshot: {}'.format(e), fg='red', err=True)
@@ -0,0 +1,193 @@
+"""
+Storage backends for plain (unencrypted by us) KBFS files.
+
+KeybaseClient delegates reading, writing and listing files to one of these backends, while
+encryption and decryption always go through the Keybase CLI.
+
+- CliStorage: Uses `keybase fs ...` commands. Works everywhere, but costs a Keybase call per operation,
+  and does not report modification times in listings.
+- MountStorage: Uses the filesystem directly on a mounted KBFS (e.g. /keybase on Linux).
+- LocalStorage: Uses a plain local directory in place of /keybase. Useful for development together
+  with fake_keybase.py, which maps /keybase onto a local directory in the same way.
+"""
+
+import os
+import platform
+import uuid
+
+from keybase import KeybaseCliException, KeybaseFileNotFoundException
+
+# Prefix for temporary files written by MountStorage.put_file, which are hidden from listings.
+TMP_PREFIX = '.paranoid-tmp-'
+
+
+class StorageBackend:
+    "Interface for storage backends."
+
+    def stat(self, path):
+        "Stats a dirent, raising KeybaseFileNotFoundException if it does not exist."
+        raise NotImplementedError
+
+    def get_file(self, path):
+        "Reads a file."
+        raise NotImplementedError
+
+    def put_file(self, path, data):
+        "Writes to a file."
+        raise NotImplementedError
+
+    def mkdir(self, path):
+        "Creates a new directory."
+        raise NotImplementedError
+
+    def list_dir(self, path):
+        "Returns a list of filenames in a directory."
+        raise NotImplementedError
+
+    def list_dir_mtimes(self, path):
+        "Returns a dict of filenames in a directory to their modification times, or None if not supported."
+        return dict.fromkeys(self.list_dir(path))
+
+    def get_mtime(self, path):
+        "Returns the modification time of a dirent, or None if not supported."
+        return None
+
+
+class CliStorage(StorageBackend):
+    def __init__(self, keybase):
+        self.keybase = keybase
+
+    def stat(self, path):
+        try:
+            self.keybase._run_cmd(['fs', 'stat', path])
+        except KeybaseCliException as e:
+            if 'file does not exist' in e.stderr:  # file not found
+                raise KeybaseFileNotFoundException(path)
+            if "doesn't exist" in e.stderr:  # dir not found
+                raise KeybaseFileNotFoundException(path)
+            if 'The system cannot find the file specified.' in e.stderr:  #windows file not found
+                raise KeybaseFileNotFoundException(path)
+            raise e
+
+    def get_file(self, path):
+        try:
+            return self.keybase._run_cmd(['fs', 'read', path])
+        except KeybaseCliException as e:
+            if 'file does not exist' in e.stderr:
+                raise KeybaseFileNotFoundException(path)
+            raise e
+
+    async def get_file_async(self, path):
+        "Fetches a file on the asyncio engine of the Keybase client."
+        try:
+            return await self.keybase.engine.exec_cmd(['fs', 'read', path])
+        except KeybaseCliException as e:
+            if 'file does not exist' in e.stderr:
+                raise KeybaseFileNotFoundException(path)
+            raise e
+
+    def put_file(self, path, data):
+        self.keybase._run_cmd(['fs', 'write', path], data)
+
+    def mkdir(self, path):
+        self.keybase._run_cmd(['fs', 'mkdir', path])
+
+    def list_dir(self, path):
+        if platform.system() == 'Windows':
+            path = '\\keybase' + path[2:]
+        try:
+            res = self.keybase._run_cmd(['fs', 'ls', path, '-1', '--nocolor']).strip()
+            if not res:
+                return []
+            return res.split('\n')
+        except KeybaseCliException as e:
+            if 'file does not exist' in e.stderr:
+                raise KeybaseFileNotFoundException(path)
+            raise e
+
+
+class MountStorage(StorageBackend):
+    def __init__(self, root=None):
+        # Paths are passed in as KBFS paths, which are already valid paths on the mount by default.
+        self.root = root
+
+    def local_path(self, path):
+        "Maps a KBFS path onto the local filesystem."
+        if self.root is None:
+            return path
+
+        for prefix in ('/keybase', 'K:'):
+            if path == prefix or path.startswith(prefix + '/') or path.startswith(prefix + '\\'):
+                return os.path.join(self.root, path[len(prefix):].lstrip('/\\'))
+
+        raise KeybaseFileNotFoundException(path)
+
+    def stat(self, path):
+        try:
+            return os.stat(self.local_path(path))
+        except FileNotFoundError:
+            raise KeybaseFileNotFoundException(path)
+
+    def get_mtime(self, path):
+        return self.stat(path).st_mtime
+
+    def get_file(self, path):
+        try:
+            with open(self.local_path(path), encoding='utf-8', newline='') as f:
+                return f.read()
+        except (FileNotFoundError, IsADirectoryError):
+            raise KeybaseFileNotFoundException(path)
+
+    def put_file(self, path, data):
+        "Writes to a temporary file next to the destination, then renames it over the destination atomically."
+        local_path = self.local_path(path)
+        dirname, filename = os.path.split(local_path)
+        tmp_path = os.path.join(dirname, '{}{}-{}'.format(TMP_PREFIX, uuid.uuid4().hex, filename))
+
+        try:
+            with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, local_path)
+        except FileNotFoundError:
+            raise KeybaseFileNotFoundException(path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def mkdir(self, path):
+        os.mkdir(self.local_path(path))
+
+    def list_dir(self, path):
+        return sorted(self.list_dir_mtimes(path))
+
+    def list_dir_mtimes(self, path):
+        try:
+            with os.scandir(self.local_path(path)) as it:
+                return {
+                    entry.name: entry.stat().st_mtime
+                    for entry in it if not entry.name.startswith(TMP_PREFIX)
+                }
+        except (FileNotFoundError, NotADirectoryError):
+            raise KeybaseFileNotFoundException(path)
+
+
+class LocalStorage(MountStorage):
+    def __init__(self, root):
+        super().__init__(os.path.abspath(root))
+
+    def mkdir(self, path):
+        # Unlike KBFS, top-level folders such as /keybase/private/<username> do not exist up front.
+        os.makedirs(self.local_path(path), exist_ok=True)
+
+
+def create_storage(keybase, name, root=None):
+    "Creates a storage backend by name."
+    if name == 'local':
+        if not root:
+            raise ValueError('A root directory needs to be provided for local storage.')
+        return LocalStorage(root)
+    if name == 'mount':
+        return MountStorage(root)
+    return CliStorage(keybase)
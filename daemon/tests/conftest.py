@@ -0,0 +1,61 @@
+import os
+import sys
+
+import pytest
+
+# Modules of the daemon are imported by their flat names, as when running main.py
+DAEMON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DAEMON_DIR)
+
+from cache import ParanoidCache
+from keybase import KeybaseClient
+from paranoid import ParanoidManager
+from storage import LocalStorage
+
+
+@pytest.fixture
+def keybase_root(tmp_path, monkeypatch):
+    "Local directory standing in for /keybase, for the fake Keybase CLI."
+    root = str(tmp_path / 'keybase')
+    monkeypatch.setenv('FAKE_KEYBASE_ROOT', root)
+    monkeypatch.delenv('FAKE_KEYBASE_USER', raising=False)
+    return root
+
+
+@pytest.fixture
+def make_keybase(keybase_root):
+    "Returns a function which creates Keybase clients running the fake Keybase CLI."
+    clients = []
+
+    def make_keybase(**kwargs):
+        keybase = KeybaseClient()
+        kwargs.setdefault('metadata_ttl', 0)
+        keybase.init(executable=[sys.executable, os.path.join(DAEMON_DIR, 'fake_keybase.py')],
+                     storage=LocalStorage(keybase_root), **kwargs)
+        clients.append(keybase)
+        return keybase
+
+    yield make_keybase
+
+    for keybase in clients:
+        keybase.close()
+
+
+@pytest.fixture
+def keybase(make_keybase):
+    return make_keybase()
+
+
+@pytest.fixture
+def make_paranoid(keybase):
+    "Returns a function which creates Paranoid managers, with the default directories in place."
+    keybase.ensure_dir(keybase.get_private('services'))
+    keybase.ensure_dir(keybase.get_public('ids'))
+
+    def make_paranoid(**kwargs):
+        kwargs.setdefault('disable_chat', True)
+        paranoid = ParanoidManager(keybase, ParanoidCache())
+        paranoid.init(**kwargs)
+        return paranoid
+
+    return make_paranoid
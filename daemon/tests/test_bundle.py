@@ -0,0 +1,68 @@
+from revalidate import Revalidator
+
+ORIGIN = 'http:example.com:80'
+
+
+def create_identity(paranoid, value):
+    paranoid.set_service(ORIGIN, {'origin': 'http://example.com:80'})
+    paranoid.set_service_identity(ORIGIN, '1', {'key': 'K', 'fields': {'email': {'type': 'str', 'shared_with': []}}})
+    paranoid.encrypt_data_file(ORIGIN, '1', 'email', value, [])
+
+
+def test_bundle_with_cache_disabled(make_paranoid):
+    paranoid = make_paranoid(disable_cache=True)
+    paranoid.init(disable_chat=True, disable_cache=True, revalidator=Revalidator(paranoid))
+    create_identity(paranoid, 'a@example.com')
+
+    bundle, errors = paranoid.get_bundle(ORIGIN)
+    assert bundle == {'1': {'email': 'a@example.com'}}
+    assert not errors
+
+    # Views are not kept without a cache, so changes made elsewhere show up on the next read
+    other = make_paranoid()
+    other.encrypt_data_file(ORIGIN, '1', 'email', 'b@example.com', [])
+    bundle, _ = paranoid.get_bundle(ORIGIN)
+    assert bundle == {'1': {'email': 'b@example.com'}}
+    assert paranoid.bundles == {}
+
+
+def test_bundle_kept_when_revalidated_unchanged(make_paranoid):
+    paranoid = make_paranoid()
+    create_identity(paranoid, 'a@example.com')
+    paranoid.get_bundle(ORIGIN)
+    version, _ = paranoid.get_version('bundle', ORIGIN)
+
+    def revalidate():
+        with paranoid.revalidating():
+            paranoid.get_service_uids(ORIGIN)
+            paranoid.get_service_identity(ORIGIN, '1')
+            paranoid.get_foreign_map(ORIGIN)
+            paranoid.decrypt_data_files(ORIGIN, [('1', 'email', None)])
+
+    # Nothing changed in KBFS, so the view and its version are kept
+    revalidate()
+    assert ORIGIN in paranoid.bundles
+    assert paranoid.get_version('bundle', ORIGIN) == (version, True)
+
+    # A change made elsewhere drops the view
+    make_paranoid().encrypt_data_file(ORIGIN, '1', 'email', 'b@example.com', [])
+    revalidate()
+    assert ORIGIN not in paranoid.bundles
+    bundle, _ = paranoid.get_bundle(ORIGIN)
+    assert bundle == {'1': {'email': 'b@example.com'}}
+
+
+def test_bundle_version_follows_content(make_paranoid):
+    paranoid = make_paranoid()
+    create_identity(paranoid, 'a@example.com')
+    paranoid.get_bundle(ORIGIN)
+    version, _ = paranoid.get_version('bundle', ORIGIN)
+
+    # Rebuilding the view from the same entries gives the same version
+    paranoid.update_bundle(ORIGIN)
+    assert paranoid.get_version('bundle', ORIGIN) == (None, False)
+    paranoid.get_bundle(ORIGIN)
+    assert paranoid.get_version('bundle', ORIGIN) == (version, True)
+
+    paranoid.encrypt_data_file(ORIGIN, '1', 'email', 'b@example.com', [])
+    assert paranoid.get_version('bundle', ORIGIN)[0] != version
@@ -0,0 +1,72 @@
+import json
+
+from cache import ParanoidCache
+
+
+def test_evicted_data_files_are_forgotten():
+    cache = ParanoidCache()
+    cache.init(max_data_bytes=100)
+
+    keys = [('https:example.com:443', '1', 'field{}'.format(i), None) for i in range(50)]
+    for key in keys:
+        cache.encrypt_data_file(*key[:3], 'x' * 10)
+
+    data_files = cache.cache['decrypted_data_file']
+    assert data_files.size <= 100
+    assert 0 < len(data_files) < len(keys)
+    cached = [('decrypted_data_file', key) for key in keys if key in data_files]
+    assert sorted(k for k in cache.loaded_at if k[0] == 'decrypted_data_file') == sorted(cached)
+    assert sorted(k for k in cache.versions if k[0] == 'decrypted_data_file') == sorted(cached)
+
+    # Values larger than the budget are not cached, nor remembered
+    cache.encrypt_data_file(*keys[-1][:3], 'x' * 1000)
+    assert keys[-1] not in data_files
+    assert ('decrypted_data_file', keys[-1]) not in cache.loaded_at
+    assert ('decrypted_data_file', keys[-1]) not in cache.versions
+
+
+def test_missing_data_files_are_bounded():
+    cache = ParanoidCache()
+    cache.init(max_data_bytes=100)
+    cache.max_missing_data_files = 10
+
+    keys = [('https:example.com:443', '1', 'field{}'.format(i), None) for i in range(50)]
+    for key in keys:
+        cache.set_missing_data_file(*key[:3])
+
+    assert list(cache.missing_data_files) == keys[-10:]
+    assert sorted(k[1] for k in cache.versions if k[0] == 'decrypted_data_file') == sorted(keys[-10:])
+    assert sorted(k[1] for k in cache.loaded_at if k[0] == 'decrypted_data_file') == sorted(keys[-10:])
+
+
+def test_stats_track_sizes():
+    cache = ParanoidCache()
+    cache.set_service('a', {'origin': 'https://a.com'})
+    cache.set_service('b', {'origin': 'https://b.com'})
+    cache.set_service('a', {'origin': 'https://a.com', 'name': 'A'})
+    cache.set_service_identity('a', '1', {'key': 'K', 'fields': {}})
+    cache.set_service_identity('a', '2', {'key': 'K', 'fields': {'email': {}}})
+    cache.set_foreign_map('a', [{'username': 'bob', 'uid': '1', 'field_name': 'email'}])
+    cache.set_service_uids('b', [])
+    cache.invalidate('service_data', ('a', '1'))
+    cache.invalidate('service_info', 'b')
+
+    # Sizes are the same as when serializing every entry
+    def expected(cache):
+        identities = [identity for uids in cache.cache['service_data'].values() for identity in uids.values()]
+        return {
+            'service_info': sum(len(json.dumps(entry)) for entry in cache.cache['service_info'].values()),
+            'foreign_map': sum(len(json.dumps(entry)) for entry in cache.cache['foreign_map'].values()),
+            'uid_list': sum(len(json.dumps(entry)) for entry in cache.cache['uid_list'].values()),
+            'service_data': sum(len(json.dumps(identity)) for identity in identities),
+            'origin_list': len(json.dumps(cache.cache['origin_list'])),
+        }
+
+    stats = cache.stats()
+    assert {section: size for section, (_, size) in stats.items() if section in expected(cache)} == expected(cache)
+    assert stats['service_data'][0] == 1
+    assert stats['origin_list'][0] == 2
+
+    restored = ParanoidCache()
+    restored.load(cache.dump())
+    assert restored.stats() == stats
@@ -0,0 +1,44 @@
+import threading
+
+import pytest
+
+import envelope
+from envelope import KEY_SUFFIX
+
+ORIGIN = 'http:example.com:80'
+
+
+def test_unseal_with_another_key():
+    key, other_key = envelope.generate_key(), envelope.generate_key()
+    sealed = envelope.seal(key, 'value', 'hash')
+    assert envelope.unseal(key, sealed, 'hash') == 'value'
+
+    with pytest.raises(envelope.EnvelopeKeyMismatchException):
+        envelope.unseal(other_key, sealed, 'hash')
+
+    # Corrupt data files are not mistaken for a mismatched key
+    with pytest.raises(envelope.EnvelopeException) as e:
+        envelope.unseal(key, sealed, 'other hash')
+    assert not isinstance(e.value, envelope.EnvelopeKeyMismatchException)
+
+
+def test_read_while_rewritten(make_paranoid):
+    writer = make_paranoid()
+    writer.set_service(ORIGIN, {'origin': 'http://example.com:80'})
+    writer.set_service_identity(ORIGIN, '1', {'key': 'K', 'fields': {'email': {'type': 'str', 'shared_with': []}}})
+    writer.encrypt_data_file(ORIGIN, '1', 'email', 'a@example.com', [])
+
+    # Only the data key of the next value has been written so far
+    key = envelope.generate_key()
+    writer.keybase.encrypt(writer.get_data_path(ORIGIN, '1', 'email', suffix=KEY_SUFFIX), envelope.encode_key(key),
+                           writer.get_recipients([]))
+    field_hash = writer.get_field_hash((ORIGIN, '1', 'email'))
+    write = threading.Timer(0.05, writer.keybase.put_file,
+                            (writer.get_data_path(ORIGIN, '1', 'email'), envelope.seal(key, 'b@example.com', field_hash)))
+    write.start()
+
+    reader = make_paranoid()
+    errors = []
+    assert reader.decrypt_data_files(ORIGIN, [('1', 'email', None)], errors=errors) == ['b@example.com']
+    assert errors == [None]
+    write.join()
@@ -0,0 +1,54 @@
+import pytest
+
+import main
+from events import EventStream, EventStreamFullException
+
+
+def test_clients_are_capped():
+    stream = EventStream('run', max_clients=2)
+    first = stream.listen()
+    second = stream.listen()
+    with pytest.raises(EventStreamFullException):
+        stream.listen()
+
+    # Clients free up their slot once closed, even if they never read anything
+    first.close()
+    third = stream.listen()
+    assert stream.clients == 2
+
+    for subscription in (second, third):
+        subscription.close()
+    assert stream.clients == 0
+
+
+def test_events_route_returns_503_when_full():
+    main.events.init(max_clients=1)
+    client = main.app.test_client()
+    try:
+        res = client.get('/events', buffered=False)
+        assert res.status_code == 200
+        assert res.mimetype == 'text/event-stream'
+
+        full = client.get('/events')
+        assert full.status_code == 503
+        assert full.headers['Retry-After'] == '5'
+
+        res.close()
+        assert main.events.clients == 0
+    finally:
+        main.events.init(max_clients=None)
+
+
+def test_missed_events_are_replayed():
+    stream = EventStream('run')
+    stream.publish('service_info', 'http:example.com:80', 1)
+    stream.publish('service_data', ('http:example.com:80', '1'), 2)
+
+    messages = iter(stream.listen('run-1'))
+    assert next(messages) == 'retry: 3000\n\n'
+    assert next(messages) == 'event: identity\nid: run-2\ndata: {"origin": "http:example.com:80", "uid": "1", ' \
+        '"version": 2}\n\n'
+
+    messages = iter(stream.listen('other-1'))
+    next(messages)
+    assert next(messages).startswith('event: reset\n')
@@ -0,0 +1,26 @@
+import json
+import os
+import subprocess
+import sys
+
+FAKE_KEYBASE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fake_keybase.py')
+
+
+def test_session_answers_malformed_requests(keybase_root):
+    requests = [
+        '{"id": 1, "args": ["id", "--json"]}',
+        'not json',
+        '[1, 2]',
+        '{"id": 2, "args": 3}',
+        '{"id": 3, "args": ["id", "--json"]}',
+    ]
+    res = subprocess.run([sys.executable, FAKE_KEYBASE, '--session'],
+                         input='\n'.join(requests) + '\n', capture_output=True, text=True, timeout=30)
+    assert res.returncode == 0
+
+    replies = [json.loads(line) for line in res.stdout.splitlines()]
+    assert len(replies) == len(requests)
+    by_id = {reply['id']: reply for reply in replies if reply['id'] is not None}
+    assert by_id[1]['returncode'] == 0 and by_id[3]['returncode'] == 0
+    assert by_id[2]['returncode'] == 1
+    assert [reply['returncode'] for reply in replies if reply['id'] is None] == [1, 1]
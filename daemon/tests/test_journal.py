@@ -0,0 +1,45 @@
+import threading
+
+from journal import WriteJournal
+
+
+class SlowKeybase:
+    "Stands in for a Keybase client, where the first write blocks until released."
+    def __init__(self):
+        self.files = {}
+        self.writing = threading.Event()
+        self.release = threading.Event()
+        self.writes = 0
+
+    def put_file(self, path, data):
+        self.writes += 1
+        if self.writes == 1:
+            self.writing.set()
+            self.release.wait(5)
+        self.files[path] = data
+
+
+def test_overlapping_flushes_keep_latest_write(tmp_path):
+    keybase = SlowKeybase()
+    journal = WriteJournal(keybase, str(tmp_path / 'journal.jsonl'), delay=60)
+    journal.start()
+
+    # The first flush writes v1, and is held up in KBFS
+    journal.put_file('/keybase/private/alice/paranoid/services/a/info.json', 'v1')
+    first = threading.Thread(target=journal.flush)
+    first.start()
+    assert keybase.writing.wait(5)
+
+    # A second flush starts while the first is still writing
+    journal.put_file('/keybase/private/alice/paranoid/services/a/info.json', 'v2')
+    second = threading.Thread(target=journal.flush)
+    second.start()
+    second.join(0.2)
+
+    keybase.release.set()
+    first.join(5)
+    second.join(5)
+
+    assert keybase.files == {'/keybase/private/alice/paranoid/services/a/info.json': 'v2'}
+    assert journal.get_file('/keybase/private/alice/paranoid/services/a/info.json') is None
+    journal.close()
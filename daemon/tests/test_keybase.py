@@ -0,0 +1,86 @@
+import sys
+import threading
+import time
+
+import pytest
+
+from cache import ParanoidCache
+from keybase import PRIORITY_PREFETCH, KeybaseBusyException, KeybaseSessionException
+from paranoid import ParanoidManager
+
+ORIGIN = 'http:example.com:80'
+
+
+def encrypt_files(keybase, count):
+    paths = [keybase.get_private('{}.txt'.format(i)) for i in range(count)]
+    keybase.ensure_dir(keybase.get_private(''))
+    for i, path in enumerate(paths):
+        keybase.encrypt(path, 'value-{}'.format(i), [keybase.get_username()])
+    return paths
+
+
+def test_interactive_batches_go_ahead_of_prefetch(make_keybase, monkeypatch):
+    keybase = make_keybase(max_workers=1, decrypt_workers=2)
+    paths = encrypt_files(keybase, 4)
+    monkeypatch.setenv('FAKE_KEYBASE_LATENCY', '0.05')
+
+    # Queue a large batch of prefetch work first
+    def prefetch():
+        with keybase.priority(PRIORITY_PREFETCH):
+            keybase.decrypt_many(paths * 8)
+
+    prefetcher = threading.Thread(target=prefetch)
+    prefetcher.start()
+    time.sleep(0.2)
+
+    # An interactive batch is decrypted while most of the prefetch work is still queued
+    started_at = time.monotonic()
+    results = keybase.decrypt_many(paths[:2])
+    elapsed = time.monotonic() - started_at
+    assert prefetcher.is_alive()
+    assert elapsed < 1
+    assert results == [('value-0', None), ('value-1', None)]
+    prefetcher.join()
+
+
+def test_batches_are_rejected_when_busy(make_keybase, monkeypatch):
+    keybase = make_keybase(max_workers=1, max_queue=2, decrypt_workers=8)
+    paths = encrypt_files(keybase, 8)
+    monkeypatch.setenv('FAKE_KEYBASE_LATENCY', '0.2')
+
+    # Only one command runs and two wait, so the others are rejected, failing the whole batch
+    with pytest.raises(KeybaseBusyException):
+        keybase.decrypt_many(paths)
+
+
+def test_identity_is_not_partially_read_when_busy(make_keybase, monkeypatch):
+    keybase = make_keybase(max_workers=1, max_queue=2, decrypt_workers=8)
+    keybase.ensure_dir(keybase.get_private('services'))
+    keybase.ensure_dir(keybase.get_public('ids'))
+    fields = ['f{}'.format(i) for i in range(8)]
+    writer = ParanoidManager(keybase, ParanoidCache())
+    writer.init(disable_chat=True)
+    for field_name in fields:
+        writer.encrypt_data_file(ORIGIN, '1', field_name, 'value-' + field_name, [])
+
+    monkeypatch.setenv('FAKE_KEYBASE_LATENCY', '0.2')
+    paranoid = ParanoidManager(keybase, ParanoidCache())
+    paranoid.init(disable_chat=True)
+    with pytest.raises(KeybaseBusyException):
+        paranoid.decrypt_data_files(ORIGIN, [('1', field_name, None) for field_name in fields])
+
+
+def test_stuck_session_times_out(make_keybase):
+    # A session which reads requests but never replies
+    keybase = make_keybase(session_cmd=[sys.executable, '-c', 'import sys\nfor line in sys.stdin: pass'])
+    keybase.session.timeout = 0.5
+
+    # Read-only commands are run again without the session
+    started_at = time.monotonic()
+    assert keybase.get_username() == 'alice'
+    assert time.monotonic() - started_at < 5
+    assert not keybase.session.is_alive()
+
+    # Other commands may have been run by the session already, so they are not
+    with pytest.raises(KeybaseSessionException):
+        keybase._run_cmd(['chat', 'send', '--private', 'bob,alice', 'hello'])
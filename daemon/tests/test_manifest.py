@@ -0,0 +1,87 @@
+import json
+import os
+import time
+
+from cache import ParanoidCache
+from journal import WriteJournal
+from paranoid import MANIFEST_FILENAME, ParanoidManager
+
+ORIGIN = 'http:example.com:80'
+
+
+def test_manifest_is_not_journaled(make_paranoid, tmp_path):
+    paranoid = make_paranoid()
+    journal = WriteJournal(paranoid.keybase, str(tmp_path / 'journal.jsonl'), delay=60)
+    journal.start()
+    paranoid.init(disable_chat=True, journal=journal)
+    paranoid.encrypt_data_file(ORIGIN, '1', 'email', 'a@example.com', [])
+
+    assert paranoid.keybase.get_json(paranoid.keybase.get_public(MANIFEST_FILENAME)) is not None
+    assert not journal.pending
+    journal.close()
+
+
+def test_stale_manifest_falls_back_to_listing(make_paranoid):
+    paranoid = make_paranoid()
+    paranoid.ensure_manifest()
+    paranoid.encrypt_data_file(ORIGIN, '1', 'email', 'a@example.com', [])
+
+    # A data file is added without updating the manifest, e.g. by an older version
+    time.sleep(0.01)
+    path = paranoid.keybase.get_public(os.path.join('ids', 'f' * 64))
+    paranoid.keybase.put_file(path, 'legacy')
+
+    reader = make_paranoid()
+    assert 'f' * 64 in reader.get_data_filenames()
+    assert reader.get_data_versions() is None
+
+
+def test_manifest_keeps_entries_of_other_daemons(make_keybase, make_paranoid):
+    make_paranoid()
+    daemons = []
+    for _ in range(2):
+        paranoid = ParanoidManager(make_keybase(metadata_ttl=60), ParanoidCache())
+        paranoid.init(disable_chat=True)
+        daemons.append(paranoid)
+
+    # Both daemons have the manifest cached before either writes
+    daemons[0].ensure_manifest()
+    for paranoid in daemons:
+        paranoid.get_data_filenames()
+
+    daemons[0].encrypt_data_file(ORIGIN, '1', 'email', 'a@example.com', [])
+    daemons[1].encrypt_data_file(ORIGIN, '1', 'name', 'Alice', [])
+
+    manifest = daemons[0].keybase.get_json(daemons[0].keybase.get_public(MANIFEST_FILENAME))
+    field_hashes = {daemons[0].get_field_hash((ORIGIN, '1', field_name)) for field_name in ('email', 'name')}
+    assert set(manifest['ids']) == field_hashes
+
+
+def test_ensure_manifest_reconciles_with_listing(make_paranoid):
+    paranoid = make_paranoid()
+    paranoid.ensure_manifest()
+    paranoid.encrypt_data_file(ORIGIN, '1', 'email', 'a@example.com', [])
+    paranoid.keybase.put_file(paranoid.keybase.get_public(os.path.join('ids', 'f' * 64)), 'legacy')
+
+    assert paranoid.ensure_manifest()
+    manifest = paranoid.keybase.get_json(paranoid.keybase.get_public(MANIFEST_FILENAME))
+    assert manifest['ids']['f' * 64]['format'] == 'legacy'
+    assert manifest['ids'][paranoid.get_field_hash((ORIGIN, '1', 'email'))]['version'] == 1
+    assert not paranoid.ensure_manifest()
+
+
+def test_manifest_miss_is_checked_without_mtimes(make_paranoid, monkeypatch):
+    paranoid = make_paranoid()
+    paranoid.ensure_manifest()
+    paranoid.encrypt_data_file(ORIGIN, '1', 'email', 'a@example.com', [])
+
+    # The data file is left out of the manifest, as by another daemon, and the storage backend cannot tell
+    path = paranoid.keybase.get_public(MANIFEST_FILENAME)
+    paranoid.keybase.put_file(path, json.dumps({'ids': {}}))
+    monkeypatch.setattr(paranoid.keybase.storage, 'get_mtime', lambda path: None)
+
+    reader = make_paranoid()
+    errors = []
+    values = reader.decrypt_data_files(ORIGIN, [('1', 'email', None), ('1', 'name', None)], errors=errors)
+    assert values == ['a@example.com', None]
+    assert errors == [None, None]
@@ -0,0 +1,31 @@
+import pytest
+
+from paranoid import KEY_SUFFIX
+
+ORIGIN = 'http:example.com:80'
+
+
+def test_update_shares_continues_past_failed_fields(make_paranoid, monkeypatch):
+    paranoid = make_paranoid()
+    paranoid.set_service(ORIGIN, {'origin': 'http://example.com:80'})
+    fields = {field_name: {'type': 'str', 'shared_with': []} for field_name in ('email', 'name', 'phone')}
+    paranoid.set_service_identity(ORIGIN, '1', {'key': 'K', 'fields': fields})
+    for field_name in fields:
+        paranoid.encrypt_data_file(ORIGIN, '1', field_name, 'value', [])
+
+    # Re-encrypting the name fails, in the middle of the list of fields
+    field_hash = paranoid.get_field_hash((ORIGIN, '1', 'name'))
+    monkeypatch.setenv('FAKE_KEYBASE_FAIL', 'encrypt -o *{}{}*'.format(field_hash, KEY_SUFFIX))
+
+    shared, errors = paranoid.update_shares(ORIGIN, '1', ['email', 'name', 'phone'], ['bob'])
+    assert shared == {'bob': ['email', 'phone']}
+    assert list(errors) == ['name']
+
+    info = paranoid.get_service_identity(ORIGIN, '1')
+    assert info['fields']['email']['shared_with'] == ['bob']
+    assert info['fields']['name']['shared_with'] == []
+    assert info['fields']['phone']['shared_with'] == ['bob']
+
+    # Nothing was shared, so the error is raised
+    with pytest.raises(Exception):
+        paranoid.update_shares(ORIGIN, '1', ['name'], ['bob'])
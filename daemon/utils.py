@@ -1,7 +1,7 @@
 from flask import jsonify
 
 
-def JsonResponse(data=None):
+def JsonResponse(data=None, errors=None):
     res = {
         'status': 'success',
     }
@@ -9,4 +9,8 @@ def JsonResponse(data=None):
     if data is not None:
         res['data'] = data
 
+    # Partial failures, for responses which are still successful overall
+    if errors:
+        res['errors'] = errors
+
     return jsonify(res)
@@ -15,3 +15,14 @@ chrome.browserAction.onClicked.addListener(function() {
   const settingsURL = `chrome-extension://${chrome.runtime.id}/views/settings/index.html`;
   chrome.tabs.create({ url: settingsURL });
 });
+
+// Content scripts keep the last response for each daemon URL in extension storage. Responses hold
+// decrypted values, so they are dropped whenever the browser starts.
+chrome.runtime.onStartup.addListener(function() {
+  chrome.storage.local.get(null, function(items) {
+    const keys = Object.keys(items).filter(
+      key => key.startsWith('response_cache:') || key === 'response_cache_urls'
+    );
+    chrome.storage.local.remove(keys);
+  });
+});
@@ -1,5 +1,8 @@
 const SESSION_TOKEN_KEY = 'session_token';
 const DAEMON_URL_KEY = 'daemon_url';
+const RESPONSE_CACHE_PREFIX = 'response_cache:';
+const RESPONSE_CACHE_URLS_KEY = 'response_cache_urls';
+const RESPONSE_CACHE_MAX_ENTRIES = 500;
 
 class ParanoidStorage {
   static async checkAlive() {
@@ -121,16 +124,38 @@ class ParanoidStorage {
     );
   }
 
+  static async shareServiceIdentityMaps(origin, uid, fields, usernames) {
+    return await this._postJSON(`services/${this.originToKey(origin)}/shares/${uid}`, {
+      fields,
+      usernames,
+    });
+  }
+
+  static async unshareServiceIdentityMaps(origin, uid, fields, usernames) {
+    return await this._removeJSON(`services/${this.originToKey(origin)}/shares/${uid}`, {
+      fields,
+      usernames,
+    });
+  }
+
   static async getServiceForeignMap(origin) {
     return await this._get(`services/${this.originToKey(origin)}/foreign_map`);
   }
 
+  static async getServiceBundle(origin) {
+    return await this._get(`services/${this.originToKey(origin)}/bundle`);
+  }
+
   static async addServiceForeignMap(origin, uid, field_name, username) {
     return await this._post(
       `services/${this.originToKey(origin)}/foreign_map/${uid}/${field_name}/${username}`
     );
   }
 
+  static async addServiceForeignMaps(origin, mappings) {
+    return await this._postJSON(`services/${this.originToKey(origin)}/foreign_map`, mappings);
+  }
+
   static async removeServiceForeignMap(origin, uid, field_name, username) {
     return await this._remove(
       `services/${this.originToKey(origin)}/foreign_map/${uid}/${field_name}/${username}`
@@ -161,6 +186,18 @@ class ParanoidStorage {
     });
   }
 
+  static async removeLocal(keys) {
+    return new Promise((resolve, reject) => {
+      chrome.storage.local.remove(keys, function() {
+        if (chrome.runtime.lastError) {
+          reject(chrome.runtime.lastError);
+        } else {
+          resolve();
+        }
+      });
+    });
+  }
+
   static async getDaemonURL() {
     return await this.getLocal(DAEMON_URL_KEY);
   }
@@ -179,12 +216,57 @@ class ParanoidStorage {
 
   static async _get(path) {
     const url = new URL(path, await this.getDaemonURL());
-    const res = await sendXHR('GET', url.href, null, {
-      headers: {
-        Authorization: await this.getSessionToken(),
-      },
-    });
-    return res.data;
+    const headers = {
+      Authorization: await this.getSessionToken(),
+    };
+
+    // The last response with an ETag is kept in extension storage, so that it survives page loads
+    const cached = await this._getCachedResponse(url.href);
+    if (cached) {
+      headers['If-None-Match'] = cached.etag;
+    }
+
+    const res = await sendXHR('GET', url.href, null, { headers, conditional: true });
+
+    // Copy cached data, so that callers cannot modify it
+    if (res.notModified) {
+      return JSON.parse(cached.body);
+    }
+
+    if (res.etag && res.json.data !== undefined) {
+      await this._setCachedResponse(url.href, {
+        etag: res.etag,
+        body: JSON.stringify(res.json.data),
+      });
+    } else if (cached) {
+      await this._setCachedResponse(url.href, null);
+    }
+    return res.json.data;
+  }
+
+  static async _getCachedResponse(url) {
+    return await this.getLocal(RESPONSE_CACHE_PREFIX + url);
+  }
+
+  static async _setCachedResponse(url, response) {
+    const urls = ((await this.getLocal(RESPONSE_CACHE_URLS_KEY)) || []).filter(u => u !== url);
+    let removed = [];
+    if (response) {
+      // Evict the oldest responses
+      urls.push(url);
+      removed = urls.splice(0, Math.max(0, urls.length - RESPONSE_CACHE_MAX_ENTRIES));
+      try {
+        await this.setLocal(RESPONSE_CACHE_PREFIX + url, response);
+      } catch {
+        // Caching is best effort, e.g. when storage is full
+        urls.pop();
+        removed.push(url);
+      }
+    } else {
+      removed.push(url);
+    }
+    await this.removeLocal(removed.map(u => RESPONSE_CACHE_PREFIX + u));
+    await this.setLocal(RESPONSE_CACHE_URLS_KEY, urls);
   }
 
   static async _postJSON(path, data) {
@@ -218,6 +300,17 @@ class ParanoidStorage {
     });
   }
 
+  static async _removeJSON(path, data) {
+    const url = new URL(path, await this.getDaemonURL());
+    const json = JSON.stringify(data);
+    await sendXHR('DELETE', url.href, json, {
+      headers: {
+        Authorization: await this.getSessionToken(),
+        'Content-Type': 'application/json',
+      },
+    });
+  }
+
   static keyToOrigin(key) {
     const regExp = new RegExp(
       /^(?<scheme>[a-z]+):(?<hostname>[a-z0-9]+[a-z0-9-]*(?:\.[a-z0-9-]+)*):(?<port>\d+)$/
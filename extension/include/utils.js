@@ -4,6 +4,12 @@ async function sendXHR(method, dest, data, options) {
 
     // Define what happens on successful data submission
     XHR.addEventListener('load', function(event) {
+      // Conditional requests are answered with 304 and no body if not modified
+      if (event.target.status === 304 && options && options.conditional) {
+        resolve({ notModified: true });
+        return;
+      }
+
       // Check for 200 status code
       if (event.target.status !== 200) {
         reject(new Error('Non-200 status code returned: ' + event.target.status));
@@ -28,7 +34,11 @@ async function sendXHR(method, dest, data, options) {
         }
       }
 
-      // Resolve with parsed JSON object.
+      // Resolve with parsed JSON object, together with its ETag for conditional requests.
+      if (options && options.conditional) {
+        resolve({ json, etag: event.target.getResponseHeader('ETag') });
+        return;
+      }
       resolve(json);
     });
 
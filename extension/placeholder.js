@@ -15,29 +15,12 @@ function replaceTag(tag, data) {
   shadow.appendChild(placeholder_replacement);
 }
 
-async function getSelfIdentities(origin) {
-  const identities = await ParanoidStorage.getServiceIdentities(origin);
-
-  // Preprocess service identities into a map
-  const identityMap = {};
-  for (let identity of identities) {
-    const uid = identity.uid.toString();
-    identityMap[uid] = identity.map;
-  }
-
-  return identityMap;
-}
-
-async function getForeignIdentities(origin) {
-  return await ParanoidStorage.getServiceForeignMap(origin);
-}
-
 (async () => {
   // Use current window origin for replacement.
   const origin = window.origin;
 
-  // Get both self and foreign identities in parallel.
-  const identityMaps = await Promise.all([getSelfIdentities(origin), getForeignIdentities(origin)]);
+  // Get both self and foreign identities in a single request, merged by uid.
+  const bundle = (await ParanoidStorage.getServiceBundle(origin)) || {};
 
   // Replace all paranoid tags.
   const tags = document.getElementsByTagName('paranoid');
@@ -45,10 +28,8 @@ async function getForeignIdentities(origin) {
     const uid = tag.getAttribute('uid');
     const attribute = tag.getAttribute('attribute');
 
-    for (let map of identityMaps) {
-      if (uid in map && attribute in map[uid]) {
-        replaceTag(tag, map[uid][attribute]);
-      }
+    if (uid in bundle && attribute in bundle[uid]) {
+      replaceTag(tag, bundle[uid][attribute]);
     }
   }
 })();
@@ -16,12 +16,15 @@ const setText = text => el => {
   el.innerHTML = text;
 };
 
-async function approve(origin, uid, field_name, username) {
+async function approve(origin, uid, field_names, username) {
   document.querySelector('#confirm-error-container').style.display = 'none';
 
   try {
-    // Add to foreign map.
-    await ParanoidStorage.addServiceForeignMap(origin, uid, field_name, username);
+    // Add all fields to foreign map at once.
+    await ParanoidStorage.addServiceForeignMaps(
+      origin,
+      field_names.map(field_name => ({ uid, field_name, username }))
+    );
 
     // Close the window.
     window.close();
@@ -39,13 +42,14 @@ function deny() {
 document.addEventListener('DOMContentLoaded', async function() {
   const origin = params.get('origin');
   const uid = params.get('uid');
-  const field_name = params.get('field_name');
+  // A single share request may contain multiple fields.
+  const field_names = params.getAll('field_name');
   const username = params.get('username');
 
   // Replace template tags
   document.querySelectorAll('.origin').forEach(setText(origin));
   document.querySelectorAll('.uid').forEach(setText(uid));
-  document.querySelectorAll('.field_name').forEach(setText(field_name));
+  document.querySelectorAll('.field_name').forEach(setText(field_names.join(', ')));
   document.querySelectorAll('.username').forEach(setText(username));
   document.querySelector('#confirm-error-container').style.display = 'none';
 
@@ -63,7 +67,7 @@ document.addEventListener('DOMContentLoaded', async function() {
     buttons[0].innerHTML = '<div class="loader">Processing...</div>';
     buttons[1].disabled = true;
     buttons[1].style.display = 'none';
-    await approve(origin, uid, field_name, username);
+    await approve(origin, uid, field_names, username);
   });
   document.querySelector('button.deny').addEventListener('click', deny);
 });